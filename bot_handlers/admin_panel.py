@@ -1,109 +1,186 @@
-import telebot
-from telebot import types
-import json
 import base64
-from db_manager import db_execute, get_table_data, get_single_record, is_admin, is_fantom, get_game_info
-from bot_handlers.common import get_user_link, get_user_name, escape_html, send
+import json
+from telebot import types
+from db_manager import db_execute, get_table_page, get_table_row_count, adjust_table_row_count, get_table_meta, quote_identifier, get_single_record, get_browsable_tables, search_users, search_wishes, is_admin, is_fantom, get_game_info, get_game_participants, get_game_exclusions, toggle_game_exclusion, get_dead_outbox, requeue_dead_outbox, invalidate_user_cache, load_roles
+from bot_handlers.common import get_user_link, get_user_links, get_user_name, get_user_names, escape_html, send, edit_message
+from bot_handlers.outbound import wake_outbox
+from bot_handlers.user_refresh import start_user_refresh
+from bot_handlers.table_export import start_table_export
+from bot_handlers.callback_codec import packed, tokenized, token_batch
 
 PAGE_SIZE = 10 
 
 def admin_panel(bot, message):
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("📦 Просмотр БД", callback_data='admin_view_db'))
+    markup.add(types.InlineKeyboardButton("🔎 Поиск пользователей и пожеланий", callback_data='admin_search'))
     markup.add(types.InlineKeyboardButton("🎲 Назначить пары (Setup)", callback_data='admin_tweak_pairs'))
+    markup.add(types.InlineKeyboardButton("📮 Недоставленные сообщения", callback_data='admin_outbox_dead'))
     markup.add(types.InlineKeyboardButton("⬅️ Главное меню", callback_data='menu'))
 
     try:
-        bot.edit_message_text("👑 <b>Панель Администратора</b>", message.chat.id, message.message_id, reply_markup=markup, parse_mode='HTML')
+        edit_message(bot, "👑 <b>Панель Администратора</b>", message.chat.id, message.message_id, reply_markup=markup, parse_mode='HTML')
     except:
         send(bot, message.chat.id, "ὅ1 <b>Панель Администратора</b>", reply_markup=markup, parse_mode='HTML')
 
-def get_db_pages_markup(table_name, current_page, total_count):
+def get_db_pages_markup(table_name, page, rows, has_prev, has_next, total_count):
+    """Кнопки листания: курсоры — ключи первой/последней строки страницы, page — только для подписи."""
     markup = types.InlineKeyboardMarkup()
-    total_pages = (total_count + PAGE_SIZE - 1) // PAGE_SIZE
+    total_pages = max((total_count + PAGE_SIZE - 1) // PAGE_SIZE, page + 1)
     
-    if total_pages > 1:
+    if has_prev or has_next:
         row = []
-        if current_page > 0:
-            row.append(types.InlineKeyboardButton("⬅️ Назад", callback_data=f'admin_db_page_{table_name}_{current_page - 1}'))
+        if has_prev and rows:
+            row.append(types.InlineKeyboardButton("⬅️ Назад", callback_data=tokenized('adt', table_name=table_name, before=rows[0][0], page=page - 1)))
         
-        row.append(types.InlineKeyboardButton(f"Стр. {current_page + 1}/{total_pages}", callback_data='noop'))
+        row.append(types.InlineKeyboardButton(f"Стр. {page + 1}/~{total_pages}", callback_data='noop'))
         
-        if current_page < total_pages - 1:
-            row.append(types.InlineKeyboardButton("Вперед ➡️", callback_data=f'admin_db_page_{table_name}_{current_page + 1}'))
+        if has_next and rows:
+            row.append(types.InlineKeyboardButton("Вперед ➡️", callback_data=tokenized('adt', table_name=table_name, after=rows[-1][0], page=page + 1)))
         
         markup.add(*row)
         
+    markup.add(
+        types.InlineKeyboardButton("📤 CSV", callback_data=tokenized('axp', table_name=table_name, fmt='csv', compress=False)),
+        types.InlineKeyboardButton("CSV.gz", callback_data=tokenized('axp', table_name=table_name, fmt='csv', compress=True)),
+        types.InlineKeyboardButton("📤 JSONL", callback_data=tokenized('axp', table_name=table_name, fmt='jsonl', compress=False)),
+        types.InlineKeyboardButton("JSONL.gz", callback_data=tokenized('axp', table_name=table_name, fmt='jsonl', compress=True)),
+    )
     markup.add(types.InlineKeyboardButton("❌ Закрыть / Назад в таблицы", callback_data='admin_view_db'))
     return markup
 
 def admin_view_db_tables(bot, call):
     if not is_admin(call.from_user.id): return
     
-    tables = db_execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'", fetch_all=True)
+    tables = get_browsable_tables()
     
     text = "📂 <b>Выберите таблицу для просмотра/изменения:</b>"
     markup = types.InlineKeyboardMarkup()
     
-    for table in tables:
-        markup.add(types.InlineKeyboardButton(table[0], callback_data=f'admin_db_table_{table[0]}_0'))
+    for table_name in tables:
+        markup.add(types.InlineKeyboardButton(table_name, callback_data=tokenized('adt', table_name=table_name)))
         
     markup.add(types.InlineKeyboardButton("⬅️ Назад в Админ-панель", callback_data='admin_menu'))
-    try:
-        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
-    except telebot.apihelper.ApiTelegramException as e:
-        if 'message is not modified' not in str(e):
-            raise e
+    edit_message(bot, text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
 
-def admin_view_table_data(bot, call, table_name, page):
+def admin_view_table_data(bot, call, table_name, after=None, before=None, page=0):
     if not is_admin(call.from_user.id): return
     
-    columns, data, total_count = get_table_data(table_name, page, PAGE_SIZE)
-    
-    text = f"📋 <b>Таблица: {table_name}</b> (Всего записей: {total_count})\n"
-    
-    main_markup = types.InlineKeyboardMarkup()
-    
-    if data:
-        text += "\nВыберите запись для <b>изменения</b>:"
+    result = get_table_page(table_name, after, before, PAGE_SIZE)
+    if result is None:
+        bot.answer_callback_query(call.id, f"Таблица '{table_name}' не найдена.")
+        admin_view_db_tables(bot, call)
+        return
+    columns, data, has_prev, has_next = result
+    if not data and (after is not None or before is not None):
+        # Строки за курсором удалили после отрисовки кнопки — показываем первую страницу
+        columns, data, has_prev, has_next = get_table_page(table_name, page_size=PAGE_SIZE)
+    # Вернулись назад до начала таблицы (строки перед первой удалили) — это первая страница
+    if not has_prev:
+        page = 0
+    total_count = get_table_row_count(table_name)
+    
+    text = f"📋 <b>Таблица: {table_name}</b> (Всего записей: ~{total_count})\n"
+    
+    # Токены кнопок (для текстовых ключей) сохраняются одной транзакцией до отправки
+    with token_batch():
+        main_markup = types.InlineKeyboardMarkup()
+    
+        if data:
+            text += "\nВыберите запись для <b>изменения</b>:"
         
-        for row in data:
-            record_id = row[0] 
+            for record_id, row in data:
             
-            desc_parts = []
-            for i, col_name in enumerate(columns):
-                if i < 4: 
-                    value = str(row[i])
-                    if len(value) > 15:
-                         value = value[:15] + '...'
+                desc_parts = []
+                for i, col_name in enumerate(columns):
+                    if i < 4: 
+                        value = str(row[i])
+                        if len(value) > 15:
+                             value = value[:15] + '...'
                     
-                    desc_parts.append(f"{col_name}: {value}")
+                        desc_parts.append(f"{col_name}: {value}")
 
-            button_text = ' | '.join(desc_parts)
+                button_text = ' | '.join(desc_parts)
             
-            main_markup.add(
-                types.InlineKeyboardButton(
-                    button_text, 
-                    callback_data=f'admin_edit_record_{table_name}_{record_id}'
+                main_markup.add(
+                    types.InlineKeyboardButton(
+                        button_text, 
+                        callback_data=tokenized('aer', table_name=table_name, record_id=record_id)
+                    )
                 )
-            )
             
-    else:
-        text += "\nНет данных в этой таблице."
+        else:
+            text += "\nНет данных в этой таблице."
         
-    pagination_markup = get_db_pages_markup(table_name, page, total_count)
+        pagination_markup = get_db_pages_markup(table_name, page, data, has_prev, has_next, total_count)
     
     final_markup = types.InlineKeyboardMarkup()
     final_markup.keyboard.extend(main_markup.keyboard)
     final_markup.keyboard.extend(pagination_markup.keyboard)
     
     try:
-        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=final_markup, parse_mode='HTML')
+        edit_message(bot, text, call.message.chat.id, call.message.message_id, reply_markup=final_markup, parse_mode='HTML')
     except Exception as e:
         bot.answer_callback_query(call.id, f"Ошибка отображения: {e}")
         admin_view_db_tables(bot, call)
 
 
+def admin_export_table(bot, call, table_name, fmt, compress=False):
+    if not is_admin(call.from_user.id): return
+    
+    if get_table_meta(table_name) is None:
+        bot.answer_callback_query(call.id, f"Таблица '{table_name}' не найдена.")
+        return
+    start_table_export(bot, call.message.chat.id, table_name, fmt, compress)
+    bot.answer_callback_query(call.id, "⏳ Выгрузка запущена, файл придёт отдельным сообщением.")
+
+
+def admin_search_prompt(bot, call, user_states):
+    if not is_admin(call.from_user.id): return
+    
+    text = (
+        "🔎 <b>Поиск</b>\n\n"
+        "Пришлите username, имя/фамилию, Telegram ID или слова из пожелания. "
+        "Также можно написать /search &lt;запрос&gt;. Нажмите /cancel, чтобы отменить."
+    )
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("⬅️ Назад в Админ-панель", callback_data='admin_menu'))
+    edit_message(bot, text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
+    user_states[call.from_user.id] = ('waiting_admin_search', {})
+
+
+def admin_search(bot, chat_id, query):
+    """Отправить результаты поиска: кнопки ведут сразу к редактированию записи."""
+    users = search_users(query)
+    wishes = search_wishes(query)
+    
+    text = f"🔎 <b>Поиск:</b> <code>{escape_html(query)}</code>\n\nПользователи: {len(users)}\nПожелания: {len(wishes)}"
+    markup = types.InlineKeyboardMarkup()
+    
+    for record_id, tg_id, username, first_name, last_name in users:
+        name = ' '.join(part for part in (first_name, last_name) if part)
+        label = f"👤 {'@' + username if username else '—'} {name} ({tg_id})"
+        markup.add(types.InlineKeyboardButton(label[:64], callback_data=tokenized('aer', table_name='users', record_id=record_id)))
+    
+    for record_id, user_tg_id, game_id, fragment in wishes:
+        label = f"🎁 #{game_id} {user_tg_id}: {fragment}"
+        markup.add(types.InlineKeyboardButton(label[:64], callback_data=tokenized('aer', table_name='wishes', record_id=record_id)))
+    
+    if not users and not wishes:
+        text += "\n\nНичего не найдено."
+    markup.add(types.InlineKeyboardButton("🔎 Новый поиск", callback_data='admin_search'))
+    markup.add(types.InlineKeyboardButton("⬅️ Назад в Админ-панель", callback_data='admin_menu'))
+    send(bot, chat_id, text, reply_markup=markup, parse_mode='HTML')
+
+
+def handle_admin_search_input(bot, message, user_states):
+    tg_id = message.chat.id
+    user_states.discard(tg_id)
+    if not is_admin(message.from_user.id): return
+    
+    admin_search(bot, tg_id, message.text or '')
+
+
 def admin_edit_record_view(bot, call, table_name, record_id):
     if not is_admin(call.from_user.id): return
     
@@ -113,33 +190,28 @@ def admin_edit_record_view(bot, call, table_name, record_id):
         admin_view_db_tables(bot, call)
         return
         
-    text = f"📝 <b>Редактирование записи в {table_name}</b> (ID: {record[0]})\n\n"
+    text = f"📝 <b>Редактирование записи в {table_name}</b> (ID: {record_id})\n\n"
     
     edit_markup = types.InlineKeyboardMarkup()
     
-    for i, (col_name, value) in enumerate(zip(columns, record)):
-        escaped_value = escape_html(value)
-        text += f"<b>{col_name}:</b> <code>{escaped_value}</code>\n" 
-        
-        if i > 0:
-            # Кодируем payload в base64(JSON(...)) чтобы безопасно передавать имена полей
-            payload = base64.urlsafe_b64encode(json.dumps([table_name, record[0], col_name]).encode()).decode()
-            edit_markup.add(
-                types.InlineKeyboardButton(
-                    f"✏️ Изменить поле {col_name}", 
-                    callback_data=f'admin_prompt_edit_{payload}'
+    with token_batch():
+        for i, (col_name, value) in enumerate(zip(columns, record)):
+            escaped_value = escape_html(value)
+            text += f"<b>{col_name}:</b> <code>{escaped_value}</code>\n" 
+            
+            if i > 0:
+                edit_markup.add(
+                    types.InlineKeyboardButton(
+                        f"✏️ Изменить поле {col_name}", 
+                        callback_data=tokenized('ape', table_name=table_name, record_id=record_id, col_name=col_name)
+                    )
                 )
-            )
 
-    edit_markup.add(types.InlineKeyboardButton("🗑️ Удалить запись", callback_data=f'admin_delete_record_{table_name}_{record[0]}'))
-    edit_markup.add(types.InlineKeyboardButton("⬅️ Назад к таблице", callback_data=f'admin_db_table_{table_name}_0'))
+        edit_markup.add(types.InlineKeyboardButton("🗑️ Удалить запись", callback_data=tokenized('adr', table_name=table_name, record_id=record_id)))
+        edit_markup.add(types.InlineKeyboardButton("⬅️ Назад к таблице", callback_data=tokenized('adt', table_name=table_name)))
     
     if call.message and call.message.message_id:
-        try:
-            bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=edit_markup, parse_mode='HTML')
-        except telebot.apihelper.ApiTelegramException as e:
-            if 'message is not modified' not in str(e):
-                raise e
+        edit_message(bot, text, call.message.chat.id, call.message.message_id, reply_markup=edit_markup, parse_mode='HTML')
     else:
         send(bot, call.message.chat.id, text, reply_markup=edit_markup, parse_mode='HTML')
 
@@ -168,7 +240,7 @@ def admin_prompt_edit_value(bot, call, table_name, record_id, col_name, user_sta
 def handle_admin_edit_input(bot, message, user_states):
     tg_id = message.chat.id
     
-    if tg_id not in user_states or user_states[tg_id][0] != 'waiting_admin_edit':
+    if user_states.state_of(tg_id) != 'waiting_admin_edit':
         return 
         
     context = user_states[tg_id][1]
@@ -178,15 +250,20 @@ def handle_admin_edit_input(bot, message, user_states):
     col_name = context['col_name']
     new_value = message.text.strip()
     
-    columns = db_execute(f"PRAGMA table_info({table_name})", fetch_all=True)
-    pk_name = columns[0][1] 
-    
-    query = f"UPDATE {table_name} SET {col_name} = ? WHERE {pk_name} = ?"
+    meta = get_table_meta(table_name)
+    if meta is None or col_name not in meta['columns']:
+        user_states.discard(tg_id)
+        send(bot, tg_id, "❌ Таблица или поле больше не существуют.")
+        return
+    query = f"UPDATE {quote_identifier(table_name)} SET {quote_identifier(col_name)} = ? WHERE {meta['key_sql']} = ?"
     
     try:
         db_execute(query, (new_value, record_id), commit=True)
+        if table_name == 'users':
+            invalidate_user_cache()
+            load_roles()
         
-        del user_states[tg_id]
+        user_states.discard(tg_id)
         
         send(
             bot, tg_id, 
@@ -210,7 +287,7 @@ def handle_admin_edit_input(bot, message, user_states):
         except Exception:
             # В крайнем случае показываем таблицу (страница 0)
             try:
-                admin_view_table_data(bot, call_obj, table_name, 0)
+                admin_view_table_data(bot, call_obj, table_name)
             except Exception:
                 # если и это не удалось — просто отправим сообщение подтверждения
                 send(bot, tg_id, f"✅ Поле '{col_name}' обновлено (ID: {record_id}).", parse_mode='HTML')
@@ -228,14 +305,10 @@ def admin_confirm_delete_record(bot, call, table_name, record_id):
 
     text = f"⚠️ <b>Подтвердите удаление записи</b>\nТаблица: <b>{table_name}</b>, ID: <b>{record_id}</b>\n\nЭто действие необратимо."
     markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("✅ Удалить", callback_data=f'admin_execute_delete_record_{table_name}_{record_id}'))
-    markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data=f'admin_edit_record_{table_name}_{record_id}'))
+    markup.add(types.InlineKeyboardButton("✅ Удалить", callback_data=tokenized('axd', table_name=table_name, record_id=record_id)))
+    markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data=tokenized('aer', table_name=table_name, record_id=record_id)))
 
-    try:
-        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
-    except telebot.apihelper.ApiTelegramException as e:
-        if 'message is not modified' not in str(e):
-            raise e
+    edit_message(bot, text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
 
 
 def admin_execute_delete_record(bot, call, table_name, record_id):
@@ -245,36 +318,26 @@ def admin_execute_delete_record(bot, call, table_name, record_id):
         admin_view_db_tables(bot, call)
         return
 
-    # Проверим, есть ли такая таблица в БД
-    exists = db_execute("SELECT name FROM sqlite_master WHERE type='table' AND name = ?", (table_name,), fetch_one=True)
-    if not exists:
+    meta = get_table_meta(table_name)
+    if meta is None:
         bot.answer_callback_query(call.id, f"Таблица '{table_name}' не найдена.")
         admin_view_db_tables(bot, call)
         return
 
-    # Безопасно экранируем идентификаторы (удаляем/экранируем двойные кавычки)
-    safe_table = '"' + table_name.replace('"', '""') + '"'
-
-    # Узнаём имя первичного ключа (через PRAGMA для безопасной таблицы)
-    cols = db_execute(f"PRAGMA table_info({safe_table})", fetch_all=True)
-    if not cols:
-        bot.answer_callback_query(call.id, "Не удалось получить информацию о таблице (PRAGMA вернуло пусто).")
-        admin_view_db_tables(bot, call)
-        return
-
-    pk_name = cols[0][1]
-    safe_pk = '"' + pk_name.replace('"', '""') + '"'
-
     try:
-        db_execute(f"DELETE FROM {safe_table} WHERE {safe_pk} = ?", (record_id,), commit=True)
+        db_execute(f"DELETE FROM {quote_identifier(table_name)} WHERE {meta['key_sql']} = ?", (record_id,), commit=True)
+        adjust_table_row_count(table_name, -1)
+        if table_name == 'users':
+            invalidate_user_cache()
+            load_roles()
         bot.answer_callback_query(call.id, f"✅ Запись {record_id} удалена из таблицы {table_name}.")
-        # Показать таблицу заново (страница 0)
-        admin_view_table_data(bot, call, table_name, 0)
+        # Показать таблицу заново (первая страница)
+        admin_view_table_data(bot, call, table_name)
     except Exception as e:
         bot.answer_callback_query(call.id, f"Ошибка при удалении: {e}")
-        admin_view_table_data(bot, call, table_name, 0)
+        admin_view_table_data(bot, call, table_name)
 
-def get_admin_game_select_markup(callback_prefix):
+def get_admin_game_select_markup(tag):
     games = db_execute("SELECT id, name FROM games WHERE status = 'setup'", fetch_all=True)
     markup = types.InlineKeyboardMarkup()
     
@@ -282,15 +345,15 @@ def get_admin_game_select_markup(callback_prefix):
         markup.add(types.InlineKeyboardButton("Нет игр в статусе 'Setup' для назначения пар", callback_data='noop'))
     else:
         for game_id, name in games:
-            markup.add(types.InlineKeyboardButton(name, callback_data=f'{callback_prefix}_{game_id}'))
+            markup.add(types.InlineKeyboardButton(name, callback_data=packed(tag, game_id)))
             
     markup.add(types.InlineKeyboardButton("⬅️ Назад в Админ-панель", callback_data='admin_menu'))
     return markup
 
 def admin_tweak_pairs_select_game(bot, call):
     if not is_admin(call.from_user.id): return
-    markup = get_admin_game_select_markup('admin_tweak_game')
-    bot.edit_message_text("Выберите игру для назначения пар (статус 'setup'):", call.message.chat.id, call.message.message_id, reply_markup=markup)
+    markup = get_admin_game_select_markup('atg')
+    edit_message(bot, "Выберите игру для назначения пар (статус 'setup'):", call.message.chat.id, call.message.message_id, reply_markup=markup)
 
 def admin_tweak_pairs_show(bot, call, game_id):
     if not is_admin(call.from_user.id): return
@@ -298,16 +361,17 @@ def admin_tweak_pairs_show(bot, call, game_id):
     if not game: return
     
     admin_pairs = db_execute("SELECT santa_tg_id, recipient_tg_id FROM pairs WHERE game_id = ? AND is_admin_pair = 1", (game_id,), fetch_all=True)
-    participants_json = game[4]
-    participants = json.loads(participants_json)
+    participants = get_game_participants(game_id)
+    links = get_user_links([p_id for pair in admin_pairs for p_id in pair])
+    names = get_user_names(participants)
     
-    text = f"<b>Ручное назначение пар в игре: {game[1]}</b>\n"
+    text = f"<b>Ручное назначение пар в игре: {game.name}</b>\n"
     
     if admin_pairs:
         text += "\n<b>Текущие назначенные пары:</b>\n"
         for santa_id, recipient_id, in admin_pairs:
-            santa_link = get_user_link(santa_id)
-            recipient_link = get_user_link(recipient_id)
+            santa_link = links[santa_id]
+            recipient_link = links[recipient_id]
             text += f"<b>{santa_link}</b> ➡️ <b>{recipient_link}</b>\n"
     else:
         text += "\nПока нет вручную назначенных пар.\n"
@@ -317,28 +381,24 @@ def admin_tweak_pairs_show(bot, call, game_id):
     markup = types.InlineKeyboardMarkup()
     
     for participant_id in participants:
-        button_text = f"Санта: {get_user_name(participant_id)}" 
+        button_text = f"Санта: {names[participant_id]}" 
         
         markup.add(
             types.InlineKeyboardButton(
                 button_text, 
-                callback_data=f'admin_assign_recipient_start_{game_id}_{participant_id}'
+                callback_data=packed('aas', game_id, participant_id)
             )
         )
         
-    markup.add(types.InlineKeyboardButton("❌ Удалить все ручные пары", callback_data=f'admin_delete_manual_pairs_{game_id}'))
-    markup.add(types.InlineKeyboardButton("⬅️ Назад к выбору игр", callback_data=f'admin_tweak_pairs'))
+    markup.add(types.InlineKeyboardButton("🚫 Запреты пар", callback_data=packed('aeg', game_id)))
+    markup.add(types.InlineKeyboardButton("❌ Удалить все ручные пары", callback_data=packed('amp', game_id)))
+    markup.add(types.InlineKeyboardButton("⬅️ Назад к выбору игр", callback_data='admin_tweak_pairs'))
     
-    try:
-        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
-    except telebot.apihelper.ApiTelegramException as e:
-        if 'message is not modified' not in str(e):
-            raise e
+    edit_message(bot, text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
 
 def admin_assign_recipient_start(bot, call, game_id, santa_id):
     if not is_admin(call.from_user.id): return
-    game = get_game_info(game_id)
-    participants = json.loads(game[4])
+    participants = get_game_participants(game_id)
     
     santa_link = get_user_link(santa_id)
 
@@ -346,22 +406,19 @@ def admin_assign_recipient_start(bot, call, game_id, santa_id):
     markup = types.InlineKeyboardMarkup()
     
     available_recipients = [p for p in participants if p != santa_id]
+    names = get_user_names(available_recipients)
     
     for recipient_id in available_recipients:
         markup.add(
             types.InlineKeyboardButton(
-                get_user_name(recipient_id), 
-                callback_data=f'admin_assign_recipient_execute_{game_id}_{santa_id}_{recipient_id}'
+                names[recipient_id], 
+                callback_data=packed('aae', game_id, santa_id, recipient_id)
             )
         )
         
-    markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data=f'admin_tweak_game_{game_id}'))
+    markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data=packed('atg', game_id)))
     
-    try:
-        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
-    except telebot.apihelper.ApiTelegramException as e:
-        if 'message is not modified' not in str(e):
-            raise e
+    edit_message(bot, text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
     
 def admin_assign_recipient_execute(bot, call, game_id, santa_id, recipient_id):
     if not is_admin(call.from_user.id): return
@@ -389,187 +446,238 @@ def admin_delete_manual_pairs_action(bot, call, game_id):
     bot.answer_callback_query(call.id, "❌ Все ручные пары удалены!")
     admin_tweak_pairs_show(bot, call, game_id)
 
-def callback_admin_panel(bot, call, user_states):
+def admin_exclusions_show(bot, call, game_id):
+    if not is_admin(call.from_user.id): return
+    game = get_game_info(game_id)
+    if not game: return
+    
+    exclusions = get_game_exclusions(game_id)
+    participants = get_game_participants(game_id)
+    
+    links = get_user_links([p_id for pair in exclusions for p_id in pair])
+    names = get_user_names(participants)
+    
+    text = f"<b>Запреты пар в игре: {game.name}</b>\n"
+    
+    if exclusions:
+        text += "\n<b>Не дарят друг другу:</b>\n"
+        for tg_id_a, tg_id_b in exclusions:
+            text += f"{links[tg_id_a]} ⛔ {links[tg_id_b]}\n"
+    else:
+        text += "\nЗапретов пока нет.\n"
+        
+    text += "\nВыберите участника, чтобы добавить или снять запрет:"
+    
+    markup = types.InlineKeyboardMarkup()
+    
+    for participant_id in participants:
+        markup.add(
+            types.InlineKeyboardButton(
+                names[participant_id], 
+                callback_data=packed('aep', game_id, participant_id)
+            )
+        )
+        
+    if exclusions:
+        markup.add(types.InlineKeyboardButton("❌ Удалить все запреты", callback_data=packed('aec', game_id)))
+    markup.add(types.InlineKeyboardButton("⬅️ Назад к парам", callback_data=packed('atg', game_id)))
+    
+    edit_message(bot, text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
+
+def admin_exclusion_pick(bot, call, game_id, tg_id_a):
+    if not is_admin(call.from_user.id): return
+    participants = get_game_participants(game_id)
+    excluded = set()
+    for tg_id_1, tg_id_2 in get_game_exclusions(game_id):
+        if tg_id_1 == tg_id_a:
+            excluded.add(tg_id_2)
+        elif tg_id_2 == tg_id_a:
+            excluded.add(tg_id_1)
+    
+    text = (
+        f"<b>Запреты для {get_user_link(tg_id_a)}</b>\n\n"
+        f"Отмеченные ⛔ участники не будут дарить друг другу. Нажмите, чтобы переключить:"
+    )
+    markup = types.InlineKeyboardMarkup()
+    names = get_user_names(participants)
+    
+    for participant_id in participants:
+        if participant_id == tg_id_a:
+            continue
+        mark = "⛔ " if participant_id in excluded else ""
+        markup.add(
+            types.InlineKeyboardButton(
+                f"{mark}{names[participant_id]}", 
+                callback_data=packed('aet', game_id, tg_id_a, participant_id)
+            )
+        )
+        
+    markup.add(types.InlineKeyboardButton("⬅️ Назад к запретам", callback_data=packed('aeg', game_id)))
+    
+    edit_message(bot, text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
+
+def admin_exclusion_toggle(bot, call, game_id, tg_id_a, tg_id_b):
+    if not is_admin(call.from_user.id): return
+    
+    if toggle_game_exclusion(game_id, tg_id_a, tg_id_b):
+        bot.answer_callback_query(call.id, f"⛔ {get_user_name(tg_id_a)} и {get_user_name(tg_id_b)} не будут дарить друг другу.")
+    else:
+        bot.answer_callback_query(call.id, "✅ Запрет снят.")
+    admin_exclusion_pick(bot, call, game_id, tg_id_a)
+
+def admin_exclusions_clear(bot, call, game_id):
+    if not is_admin(call.from_user.id): return
+    
+    db_execute("DELETE FROM game_exclusions WHERE game_id = ?", (game_id,), commit=True)
+    
+    bot.answer_callback_query(call.id, "❌ Все запреты удалены!")
+    admin_exclusions_show(bot, call, game_id)
+
+def admin_outbox_dead_view(bot, call):
+    if not is_admin(call.from_user.id): return
+    
+    total, rows = get_dead_outbox(PAGE_SIZE)
+    
+    text = f"📮 <b>Недоставленные сообщения</b> (всего: {total})\n"
+    markup = types.InlineKeyboardMarkup()
+    
+    if rows:
+        links = get_user_links([row[1] for row in rows])
+        text += "\nПоследние:\n"
+        for message_id, chat_id, attempts, last_error, created_at in rows:
+            text += f"#{message_id} → {links[chat_id]} (попыток: {attempts})\n<code>{escape_html(last_error)}</code>\n"
+            markup.add(types.InlineKeyboardButton(f"🔁 Повторить #{message_id}", callback_data=packed('aor', message_id)))
+        markup.add(types.InlineKeyboardButton("🔁 Повторить все", callback_data='admin_outbox_retry_all'))
+    else:
+        text += "\nВсе сообщения доставлены."
+        
+    markup.add(types.InlineKeyboardButton("⬅️ Назад в Админ-панель", callback_data='admin_menu'))
+    
+    edit_message(bot, text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
+
+def admin_outbox_retry(bot, call, message_id=None):
+    if not is_admin(call.from_user.id): return
+    
+    count = requeue_dead_outbox(message_id)
+    wake_outbox()
+    
+    bot.answer_callback_query(call.id, f"🔁 Повторно поставлено в очередь: {count}.")
+    admin_outbox_dead_view(bot, call)
+
+def admin_only(bot, call, **kwargs):
+    """Guard для админских маршрутов роутера."""
     if is_fantom(call.from_user.id):
         bot.answer_callback_query(call.id, "❌ Вам запрещено использовать этот бот.", show_alert=True)
-        return
+        return False
     
     if not is_admin(call.from_user.id):
         bot.answer_callback_query(call.id, "У вас нет прав администратора.", show_alert=True)
-        return
-        
-    data = call.data
-    
-    if data == 'admin_menu':
-        admin_panel(bot, call.message)
-    elif data == 'admin_tweak_pairs':
-        admin_tweak_pairs_select_game(bot, call)
-    elif data.startswith('admin_tweak_game_'):
-        payload = data[len('admin_tweak_game_'):]
-        try:
-            game_id = int(payload)
-        except Exception:
-            bot.answer_callback_query(call.id, "Неверный идентификатор игры.")
-            return
-        admin_tweak_pairs_show(bot, call, game_id)
-    elif data.startswith('admin_assign_recipient_start_'):
-        payload = data[len('admin_assign_recipient_start_'):]
-        try:
-            game_id_str, santa_id_str = payload.split('_', 1)
-            game_id, santa_id = int(game_id_str), int(santa_id_str)
-        except Exception:
-            bot.answer_callback_query(call.id, "Неверные параметры назначения получателя.")
-            return
-        admin_assign_recipient_start(bot, call, game_id, santa_id)
-    elif data.startswith('admin_assign_recipient_execute_'):
-        payload = data[len('admin_assign_recipient_execute_'):]
-        try:
-            parts = payload.split('_')
-            game_id, santa_id, recipient_id = int(parts[0]), int(parts[1]), int(parts[2])
-        except Exception:
-            bot.answer_callback_query(call.id, "Неверные параметры назначения получателя.")
-            return
-        admin_assign_recipient_execute(bot, call, game_id, santa_id, recipient_id)
-    elif data.startswith('admin_delete_manual_pairs_'):
-        payload = data[len('admin_delete_manual_pairs_'):]
-        try:
-            game_id = int(payload)
-        except Exception:
-            bot.answer_callback_query(call.id, "Неверный идентификатор игры.")
-            return
-        admin_delete_manual_pairs_action(bot, call, game_id)
-    elif data == 'admin_view_db':
-        admin_view_db_tables(bot, call)
-    elif data.startswith('admin_db_table_'):
-        payload = data[len('admin_db_table_'):]
-        try:
-            table_name, page_str = payload.rsplit('_', 1)
-            page = int(page_str)
-        except Exception:
-            bot.answer_callback_query(call.id, "Неверные параметры таблицы.")
-            return
-        admin_view_table_data(bot, call, table_name, page)
-    elif data.startswith('admin_db_page_'):
-        payload = data[len('admin_db_page_'):]
-        try:
-            table_name, page_str = payload.rsplit('_', 1)
-            page = int(page_str)
-        except Exception:
-            bot.answer_callback_query(call.id, "Неверные параметры страницы.")
-            return
-        admin_view_table_data(bot, call, table_name, page)
-    elif data.startswith('admin_prompt_edit_'):
-        payload = data[len('admin_prompt_edit_'):]
-        try:
-            decoded = base64.urlsafe_b64decode(payload.encode()).decode()
-            table_name, record_id, col_name = json.loads(decoded)
-            record_id = int(record_id)
-        except Exception:
-            bot.answer_callback_query(call.id, "Неверные параметры редактирования.")
-            return
-        admin_prompt_edit_value(bot, call, table_name, record_id, col_name, user_states)
-    elif data.startswith('admin_edit_record_'):
-        payload = data[len('admin_edit_record_'):]
-        try:
-            table_name, record_id_str = payload.rsplit('_', 1)
-            record_id = int(record_id_str)
-        except Exception:
-            bot.answer_callback_query(call.id, "Неверные параметры просмотра записи.")
-            return
-        admin_edit_record_view(bot, call, table_name, record_id)
-    elif data.startswith('admin_delete_record_'):
-        payload = data[len('admin_delete_record_'):]
-        try:
-            table_name, record_id_str = payload.rsplit('_', 1)
-            record_id = int(record_id_str)
-        except Exception:
-            bot.answer_callback_query(call.id, "Неверные параметры удаления записи.")
-            return
-        admin_confirm_delete_record(bot, call, table_name, record_id)
-    elif data.startswith('admin_execute_delete_record_'):
-        payload = data[len('admin_execute_delete_record_'):]
-        try:
-            table_name, record_id_str = payload.rsplit('_', 1)
-            record_id = int(record_id_str)
-        except Exception:
-            bot.answer_callback_query(call.id, "Неверные параметры удаления записи.")
-            return
-        admin_execute_delete_record(bot, call, table_name, record_id)
-    else:
-        bot.answer_callback_query(call.id, f"Действие '{data}' пока не реализовано.")
+        return False
+    return True
+
+def decode_edit_payload(payload):
+    """Разобрать аргумент старого admin_prompt_edit_: base64(json [table_name, record_id, col_name])."""
+    decoded = base64.urlsafe_b64decode(payload.encode()).decode()
+    table_name, record_id, col_name = json.loads(decoded)
+    return table_name, int(record_id), col_name
+
+def register_legacy_admin_routes(router, user_states):
+    """
+    Старые форматы callback_data админ-панели — для кнопок в уже отправленных сообщениях.
+    Номер страницы старых кнопок листания (OFFSET) не переводится в курсор: открывается первая страница.
+    """
+    router.add_converter('edit_payload', r'[A-Za-z0-9_=-]+', decode_edit_payload)
+    
+    def add(pattern, handler):
+        router.add(pattern, handler, guard=admin_only)
+    
+    add('admin_tweak_game_{game_id:int}', admin_tweak_pairs_show)
+    add('admin_assign_recipient_start_{game_id:int}_{santa_id:int}', admin_assign_recipient_start)
+    add('admin_assign_recipient_execute_{game_id:int}_{santa_id:int}_{recipient_id:int}', admin_assign_recipient_execute)
+    add('admin_delete_manual_pairs_{game_id:int}', admin_delete_manual_pairs_action)
+    add('admin_excl_game_{game_id:int}', admin_exclusions_show)
+    add('admin_excl_pick_{game_id:int}_{tg_id_a:int}', admin_exclusion_pick)
+    add('admin_excl_toggle_{game_id:int}_{tg_id_a:int}_{tg_id_b:int}', admin_exclusion_toggle)
+    add('admin_excl_clear_{game_id:int}', admin_exclusions_clear)
+    add('admin_outbox_retry_{message_id:int}', admin_outbox_retry)
+    add('admin_db_table_{table_name}_{page:int}', lambda bot, call, table_name, page: admin_view_table_data(bot, call, table_name))
+    add('admin_db_page_{table_name}_{page:int}', lambda bot, call, table_name, page: admin_view_table_data(bot, call, table_name))
+    add(
+        'admin_prompt_edit_{edit:edit_payload}',
+        lambda bot, call, edit: admin_prompt_edit_value(bot, call, *edit, user_states)
+    )
+    add('admin_edit_record_{table_name}_{record_id:int}', admin_edit_record_view)
+    add('admin_delete_record_{table_name}_{record_id:int}', admin_confirm_delete_record)
+    add('admin_execute_delete_record_{table_name}_{record_id:int}', admin_execute_delete_record)
+
+def register_admin_routes(router, user_states):
+    """Зарегистрировать callback-маршруты админ-панели (форматы — bot_handlers.callback_codec)."""
+    router.add('admin_menu', lambda bot, call: admin_panel(bot, call.message), guard=admin_only)
+    router.add('admin_tweak_pairs', admin_tweak_pairs_select_game, guard=admin_only)
+    router.add('admin_outbox_dead', admin_outbox_dead_view, guard=admin_only)
+    router.add('admin_outbox_retry_all', admin_outbox_retry, guard=admin_only)
+    router.add('admin_view_db', admin_view_db_tables, guard=admin_only)
+    router.add('admin_search', lambda bot, call: admin_search_prompt(bot, call, user_states), guard=admin_only)
+    router.add('admin_execute_update_users', admin_execute_update_users_action, guard=admin_only)
+    
+    router.add_packed('atg', ('game_id',), admin_tweak_pairs_show, guard=admin_only)
+    router.add_packed('aas', ('game_id', 'santa_id'), admin_assign_recipient_start, guard=admin_only)
+    router.add_packed('aae', ('game_id', 'santa_id', 'recipient_id'), admin_assign_recipient_execute, guard=admin_only)
+    router.add_packed('amp', ('game_id',), admin_delete_manual_pairs_action, guard=admin_only)
+    router.add_packed('aeg', ('game_id',), admin_exclusions_show, guard=admin_only)
+    router.add_packed('aep', ('game_id', 'tg_id_a'), admin_exclusion_pick, guard=admin_only)
+    router.add_packed('aet', ('game_id', 'tg_id_a', 'tg_id_b'), admin_exclusion_toggle, guard=admin_only)
+    router.add_packed('aec', ('game_id',), admin_exclusions_clear, guard=admin_only)
+    router.add_packed('aor', ('message_id',), admin_outbox_retry, guard=admin_only)
+    
+    # Имя таблицы и целые ключи/курсоры помещаются в callback_data, токены — только для текстовых ключей
+    router.add_token('adt', admin_view_table_data, guard=admin_only, inline=(('table_name',), ('page', 'after', 'before')))
+    router.add_token('aer', admin_edit_record_view, guard=admin_only, inline=(('table_name',), ('record_id',)))
+    router.add_token('adr', admin_confirm_delete_record, guard=admin_only, inline=(('table_name',), ('record_id',)))
+    router.add_token('axd', admin_execute_delete_record, guard=admin_only, inline=(('table_name',), ('record_id',)))
+    router.add_token('axp', admin_export_table, guard=admin_only, inline=(('table_name', 'fmt'), ('compress',)))
+    router.add_token(
+        'ape',
+        lambda bot, call, table_name, record_id, col_name: admin_prompt_edit_value(bot, call, table_name, record_id, col_name, user_states),
+        guard=admin_only,
+        inline=(('table_name', 'col_name'), ('record_id',))
+    )
+    register_legacy_admin_routes(router, user_states)
 
-def admin_update_all_users_data(bot, message):
-    if is_fantom(message.from_user.id):
+def admin_update_all_users_data(bot, chat_id, requester_id, progress_message_id=None):
+    """
+    Запустить фоновое обновление профилей всех пользователей (bot_handlers.user_refresh).
+    Прогресс показывается в сообщении progress_message_id (или в новом сообщении).
+    
+    Returns:
+        tuple: (текст для ответа, запущено ли обновление)
+    """
+    if is_fantom(requester_id):
         return "❌ Вам запрещено использовать этот бот.", False
     
-    if not is_admin(message.from_user.id):
+    if not is_admin(requester_id):
         return "❌ У вас нет прав администратора.", False
 
-    # Получаем все tg_id из базы данных
-    all_user_ids = db_execute("SELECT tg_id FROM users", fetch_all=True)
-    
-    if not all_user_ids:
-        return "⚠️ В базе данных нет пользователей для обновления.", False
-
-    updated_count = 0
-    
-    # Отправляем сообщение, чтобы избежать таймаута при длительной операции
-    status_msg = send(bot, message.chat.id, "🔄 **Начинаю обновление данных всех пользователей...**", parse_mode='Markdown')
+    if progress_message_id is None:
+        status_msg = send(bot, chat_id, "🔄 <b>Запускаю обновление данных пользователей...</b>", parse_mode='HTML')
+        progress_message_id = status_msg.message_id
 
-    for user_id_tuple in all_user_ids:
-        tg_id = user_id_tuple[0]
-        try:
-            # Получаем актуальную информацию из Telegram API
-            member = bot.get_chat_member(tg_id, tg_id)
-            user = member.user
-            
-            # Подготовка данных
-            username = user.username
-            first_name = user.first_name
-            last_name = user.last_name
-            
-            # Обновление записи в БД
-            db_execute(
-                "UPDATE users SET username = ?, first_name = ?, last_name = ? WHERE tg_id = ?",
-                (username, first_name, last_name, tg_id),
-                commit=True
-            )
-            updated_count += 1
-            
-        except telebot.apihelper.ApiTelegramException as e:
-            # Обработка случаев, когда бот не может получить информацию
-            # Например, если пользователь заблокировал бота, tg_id становится недоступным
-            if 'user not found' in str(e) or 'is not a member' in str(e):
-                # Можно добавить логику для пометки или удаления "мертвых" аккаунтов
-                pass
-            else:
-                pass 
-        except Exception:
-            pass
-            
-    bot.delete_message(message.chat.id, status_msg.message_id)
+    if not start_user_refresh(bot, chat_id, progress_message_id):
+        return "⏳ Обновление уже выполняется — прогресс в его сообщении.", False
 
-    return f"✅ **Успешно обновлено {updated_count}** из {len(all_user_ids)} записей пользователей.", True
+    return "🔄 Обновление запущено в фоне, прогресс будет обновляться в сообщении.", True
 
-# Добавьте эту функцию в callback_admin_panel, чтобы можно было вызывать ее из меню
+# Подтверждение обновления пользователей; кнопка ведёт на маршрут admin_execute_update_users (register_admin_routes)
 def admin_prompt_update_all_users(bot, call):
     text = "⚠️ **Вы уверены, что хотите обновить данные всех пользователей?** Это может занять некоторое время."
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("✅ ДА, обновить сейчас", callback_data='admin_execute_update_users'))
     markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data='admin_menu'))
 
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='Markdown')
+    edit_message(bot, text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='Markdown')
 
 def admin_execute_update_users_action(bot, call):
-    tg_id = call.from_user.id
-    bot.answer_callback_query(call.id, "Начинаю обновление...", show_alert=False)
-    
-    result_text, success = admin_update_all_users_data(bot, call.message)
-    
-    bot.edit_message_text(
-        result_text, 
-        tg_id, 
-        call.message.message_id,
-        reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("⬅️ Назад", callback_data='admin_menu')),
-        parse_mode='Markdown'
-    )
\ No newline at end of file
+    result_text, success = admin_update_all_users_data(
+        bot, call.message.chat.id, call.from_user.id, progress_message_id=call.message.message_id
+    )
+    bot.answer_callback_query(call.id, result_text, show_alert=not success)
\ No newline at end of file
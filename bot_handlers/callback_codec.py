@@ -0,0 +1,232 @@
+"""
+Компактное кодирование callback_data (Telegram ограничивает его 64 байтами).
+
+Два формата, оба вида '<тег>_<данные>':
+- packed: целые аргументы (id игр, tg_id, страницы) упакованы zigzag-varint и
+  записаны в base64url без выравнивания: три tg_id занимают ~20 символов;
+- token: произвольная JSON-нагрузка (имена таблиц и полей) хранится в таблице
+  callback_tokens, в кнопку попадает только короткий токен. Токен — хэш
+  нагрузки, поэтому повторная отрисовка той же кнопки не плодит записи.
+  Если для тега объявлен inline-формат (register_inline) и нагрузка в него
+  укладывается, tokenized обходится без БД: '<тег>_<строки через '.'>.<packed>',
+  например 'adt_game_participants.BgIU'. Токены, записанные внутри token_batch(),
+  сохраняются одним executemany при выходе из блока.
+
+Теги короткие, без '_' и не совпадают с первым словом старых маршрутов
+(join, org, draw, admin и т.д.), чтобы роутер не путал форматы.
+"""
+import base64
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from db_manager import save_callback_token, save_callback_tokens, load_callback_token, purge_callback_tokens
+
+MAX_CALLBACK_DATA = 64
+TOKEN_TTL = 30 * 24 * 60 * 60
+TOKEN_REFRESH_INTERVAL = 24 * 60 * 60
+TOKEN_CACHE_SIZE = 5000
+
+# token -> (payload, время последней записи в БД)
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+# тег -> (строковые поля, целые поля) inline-формата
+_inline_formats = {}
+_INLINE_STR = re.compile(r'[A-Za-z0-9_]+')
+# Отложенные записи токенов текущего потока (token_batch)
+_batch = threading.local()
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def encode_ints(values):
+    """Упаковать целые числа в строку base64url (zigzag + varint)."""
+    out = bytearray()
+    for value in values:
+        value = -2 * value - 1 if value < 0 else 2 * value
+        while True:
+            byte = value & 0x7F
+            value >>= 7
+            if value:
+                out.append(byte | 0x80)
+            else:
+                out.append(byte)
+                break
+    return _b64encode(bytes(out))
+
+
+def decode_ints(text):
+    """
+    Распаковать строку encode_ints.
+
+    Raises:
+        ValueError: Строка повреждена
+    """
+    values = []
+    value = shift = 0
+    data = _b64decode(text)
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            if shift > 70:
+                raise ValueError("Слишком длинное число в callback_data")
+            continue
+        values.append((value >> 1) ^ -(value & 1))
+        value = shift = 0
+    if shift:
+        raise ValueError("Обрезанное число в callback_data")
+    return values
+
+
+def _checked(data):
+    if len(data.encode('utf-8')) > MAX_CALLBACK_DATA:
+        raise ValueError(f"callback_data длиннее {MAX_CALLBACK_DATA} байт: {data}")
+    return data
+
+
+def packed(tag, *values):
+    """callback_data с целыми аргументами: packed('aae', game_id, santa_id, recipient_id)."""
+    return _checked(f"{tag}_{encode_ints(values)}")
+
+
+def register_inline(tag, str_fields, int_fields):
+    """
+    Объявить inline-формат тега: str_fields — обязательные строки-идентификаторы,
+    int_fields — необязательные целые (None и отсутствие равнозначны).
+    """
+    _inline_formats[tag] = (tuple(str_fields), tuple(int_fields))
+
+
+def _inline(tag, payload):
+    """callback_data inline-формата или None, если нагрузка в него не укладывается."""
+    str_fields, int_fields = _inline_formats[tag]
+    if not set(payload) <= set(str_fields) | set(int_fields):
+        return None
+    strings = [payload.get(field) for field in str_fields]
+    if not all(isinstance(value, str) and _INLINE_STR.fullmatch(value) for value in strings):
+        return None
+    # Первое число — маска присутствующих целых полей
+    mask, values = 0, []
+    for bit, field in enumerate(int_fields):
+        value = payload.get(field)
+        if value is None:
+            continue
+        if not isinstance(value, int):
+            return None
+        mask |= 1 << bit
+        values.append(int(value))
+    data = f"{tag}_{'.'.join(strings)}.{encode_ints([mask] + values)}"
+    return data if len(data.encode('utf-8')) <= MAX_CALLBACK_DATA else None
+
+
+def decode_inline(tag, text):
+    """
+    Нагрузка inline-формата тега (dict).
+
+    Raises:
+        ValueError: Строка повреждена
+    """
+    str_fields, int_fields = _inline_formats[tag]
+    parts = text.split('.')
+    if len(parts) != len(str_fields) + 1:
+        raise ValueError("Неверное число полей в callback_data")
+    payload = dict(zip(str_fields, parts))
+    values = decode_ints(parts[-1])
+    if not values:
+        raise ValueError("Нет маски полей в callback_data")
+    mask, values = values[0], iter(values[1:])
+    for bit, field in enumerate(int_fields):
+        if mask & (1 << bit):
+            payload[field] = next(values, None)
+            if payload[field] is None:
+                raise ValueError("Обрезанные поля в callback_data")
+    return payload
+
+
+def tokenized(tag, **payload):
+    """callback_data с произвольной JSON-нагрузкой: inline, если возможно, иначе через таблицу токенов."""
+    if tag in _inline_formats:
+        data = _inline(tag, payload)
+        if data is not None:
+            return data
+    payload_json = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    token = _b64encode(hashlib.sha256(f"{tag}:{payload_json}".encode('utf-8')).digest()[:9])
+    data = _checked(f"{tag}_{token}")
+    now = time.time()
+    with _token_cache_lock:
+        cached = _token_cache.get(token)
+    if cached is None or now - cached[1] > TOKEN_REFRESH_INTERVAL:
+        pending = getattr(_batch, 'pending', None)
+        if pending is not None:
+            pending[token] = (payload_json, payload)
+        else:
+            save_callback_token(token, payload_json)
+            _remember_token(token, payload, now)
+    return data
+
+
+@contextmanager
+def token_batch():
+    """Копить записи токенов и сохранить их одной транзакцией в конце блока (вложенные блоки — часть внешнего)."""
+    if getattr(_batch, 'pending', None) is not None:
+        yield
+        return
+    _batch.pending = {}
+    try:
+        yield
+        pending = _batch.pending
+    finally:
+        _batch.pending = None
+    if pending:
+        now = time.time()
+        save_callback_tokens([(token, payload_json) for token, (payload_json, _) in pending.items()], now)
+        for token, (_, payload) in pending.items():
+            _remember_token(token, payload, now)
+
+
+def _remember_token(token, payload, saved_at):
+    with _token_cache_lock:
+        _token_cache[token] = (payload, saved_at)
+        _token_cache.move_to_end(token)
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+
+
+def resolve_token(token):
+    """
+    Нагрузка токена (dict).
+
+    Raises:
+        ValueError: Токен неизвестен или не перерисовывался дольше TOKEN_TTL
+    """
+    now = time.time()
+    with _token_cache_lock:
+        cached = _token_cache.get(token)
+    if cached is None:
+        row = load_callback_token(token)
+        if row is None:
+            raise ValueError("Кнопка устарела")
+        cached = (json.loads(row[0]), row[1])
+        _remember_token(token, cached[0], cached[1])
+    if now - cached[1] > TOKEN_TTL:
+        # Запись в БД удалит purge_expired_tokens при следующем запуске
+        with _token_cache_lock:
+            _token_cache.pop(token, None)
+        raise ValueError("Кнопка устарела")
+    return dict(cached[0])
+
+
+def purge_expired_tokens():
+    """Удалить токены, которые не перерисовывались дольше TOKEN_TTL (вызывается при старте)."""
+    return purge_callback_tokens(time.time() - TOKEN_TTL)
@@ -2,18 +2,13 @@ import telebot
 from telebot import types
 import string
 import random
-from db_manager import db_execute, get_user_info, is_fantom
-
-# Контекст для /sudo: {'target': tg_id, 'admin': admin_tg_id}
-SUDO_CONTEXT = None
-
-def set_sudo_context(target_tg_id, admin_tg_id):
-    global SUDO_CONTEXT
-    SUDO_CONTEXT = {'target': target_tg_id, 'admin': admin_tg_id}
-
-def clear_sudo_context():
-    global SUDO_CONTEXT
-    SUDO_CONTEXT = None
+import hashlib
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from db_manager import db_execute, get_user_info, get_users_info, invalidate_user_cache, set_user_reachable, is_fantom
+from bot_handlers.context import current_context
 
 CURRENCIES = {
     'RUB': '₽ (Российский рубль)',
@@ -22,6 +17,44 @@ CURRENCIES = {
     'KZT': '₸ (Казахстанский тенге)'
 }
 
+# Данные бота (get_me) кэшируются: панели не делают сетевых запросов ради ссылки-приглашения
+BOT_IDENTITY_REFRESH_INTERVAL = 6 * 60 * 60
+_bot_identity = None
+_invite_link_prefix = None
+_bot_identity_lock = threading.Lock()
+
+def load_bot_identity(bot):
+    """Запросить get_me и обновить кэш. Возвращает объект User бота."""
+    global _bot_identity, _invite_link_prefix
+    me = bot.get_me()
+    with _bot_identity_lock:
+        _bot_identity = me
+        _invite_link_prefix = f"https://t.me/{me.username}?start="
+    return me
+
+def get_bot_identity(bot):
+    """Кэшированный get_me (при первом обращении — запрос к Telegram)."""
+    return _bot_identity or load_bot_identity(bot)
+
+def start_bot_identity_refresh(bot, interval=BOT_IDENTITY_REFRESH_INTERVAL):
+    """Периодически обновлять кэш get_me в фоне (username бота может смениться)."""
+    def refresh():
+        while True:
+            time.sleep(interval)
+            try:
+                load_bot_identity(bot)
+            except Exception:
+                traceback.print_exc()
+    threading.Thread(target=refresh, name="bot-identity", daemon=True).start()
+
+def get_invite_link(bot, invite_code):
+    """Ссылка-приглашение в игру (префикс с username бота вычислен заранее)."""
+    prefix = _invite_link_prefix
+    if prefix is None:
+        load_bot_identity(bot)
+        prefix = _invite_link_prefix
+    return prefix + invite_code
+
 def escape_html(text):
     if text is None:
         return 'NULL'
@@ -32,28 +65,42 @@ def generate_invite_code(length=8):
     characters = string.ascii_letters + string.digits
     return ''.join(random.choice(characters) for i in range(length))
 
-def get_user_name(tg_id):
-    user = get_user_info(tg_id)
+def _format_user_name(tg_id, user):
     if user:
-        name = user[3] or user[2] or f"ID: {user[1]}"
+        name = user.first_name or user.username or f"ID: {user.tg_id}"
         return name
     return f"Неизвестный пользователь ID:{tg_id}"
 
-def get_user_link(tg_id):
-    user = get_user_info(tg_id)
+def _format_user_link(tg_id, user):
     if user:
-        first = user[3] or ''
-        last = user[4] or ''
-        username = user[2] or ''
+        first = user.first_name or ''
+        last = user.last_name or ''
+        username = user.username or ''
         # Prefer first+last, fall back to username, then to ID
         full = (first + (' ' + last if last else '')).strip()
-        name = full or username or f"ID: {user[1]}"
+        name = full or username or f"ID: {user.tg_id}"
     else:
         name = f"ID: {tg_id}"
 
     # Always return an HTML link (escape display name)
     return f'<a href="tg://user?id={tg_id}">{escape_html(name)}</a>'
 
+def get_user_name(tg_id):
+    return _format_user_name(tg_id, get_user_info(tg_id))
+
+def get_user_link(tg_id):
+    return _format_user_link(tg_id, get_user_info(tg_id))
+
+def get_user_names(tg_ids):
+    """Имена для списка пользователей одним запросом: dict tg_id -> имя."""
+    users = get_users_info(tg_ids)
+    return {tg_id: _format_user_name(tg_id, users.get(tg_id)) for tg_id in tg_ids}
+
+def get_user_links(tg_ids):
+    """HTML-ссылки для списка пользователей одним запросом: dict tg_id -> ссылка."""
+    users = get_users_info(tg_ids)
+    return {tg_id: _format_user_link(tg_id, users.get(tg_id)) for tg_id in tg_ids}
+
 def main_menu_markup():
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("🎄 Создать новую игру", callback_data='create_game'))
@@ -73,6 +120,8 @@ def check_fantom(bot, chat_id):
 def send(bot, chat_id, text, reply_markup=None, parse_mode=None):
     """
     Отправить сообщение пользователю с предварительной проверкой роли fantom.
+    Отправка синхронная — для ответа в чат текущего апдейта; сообщения в другие
+    чаты и рассылки ставятся в очередь (bot_handlers.outbound.send_later, outbox).
     
     Args:
         bot: Объект бота Telebot
@@ -88,10 +137,11 @@ def send(bot, chat_id, text, reply_markup=None, parse_mode=None):
         # Не пытаться отправлять сообщения фантомам — просто молча пропускаем отправку
         return None
 
-    # Если мы в /sudo контексте и сообщение адресовано цели sudo,
+    # Если текущий апдейт выполняется в /sudo и сообщение адресовано цели sudo,
     # перенаправляем текст администратору вместо прямой отправки (чтобы не вызывать "chat not found").
-    if SUDO_CONTEXT and chat_id == SUDO_CONTEXT.get('target'):
-        admin_id = SUDO_CONTEXT.get('admin')
+    ctx = current_context()
+    if ctx and ctx.sudo_admin is not None and chat_id == ctx.sudo_target:
+        admin_id = ctx.sudo_admin
         try:
             prefixed = f"[to {chat_id}] {text}"
             return bot.send_message(admin_id, prefixed, reply_markup=reply_markup, parse_mode=parse_mode)
@@ -101,17 +151,88 @@ def send(bot, chat_id, text, reply_markup=None, parse_mode=None):
 
     return bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
 
+# Хэши последнего отрисованного содержимого сообщений: (chat_id, message_id) -> digest.
+# Все правки сообщений бота должны идти через edit_message, иначе хэш устареет.
+EDIT_CACHE_SIZE = 10000
+_rendered = OrderedDict()
+_rendered_lock = threading.Lock()
+
+def _render_digest(text, reply_markup, parse_mode, kwargs):
+    digest = hashlib.sha1(text.encode('utf-8'))
+    digest.update(f"\0{parse_mode}\0{reply_markup.to_json() if reply_markup else ''}\0{sorted(kwargs.items())}".encode('utf-8'))
+    return digest.digest()
+
+def forget_rendered(chat_id, message_id):
+    """Забыть хэш сообщения (после удаления или правки в обход edit_message)."""
+    with _rendered_lock:
+        _rendered.pop((chat_id, message_id), None)
+
+def edit_message(bot, text, chat_id, message_id, reply_markup=None, parse_mode=None, **kwargs):
+    """
+    Отредактировать сообщение, пропустив запрос к Telegram, если текст и
+    клавиатура не изменились с прошлой отрисовки (общий помощник для панелей).
+    
+    Returns:
+        Message | bool | None: Результат edit_message_text или None, если правка не понадобилась
+    """
+    key = (chat_id, message_id)
+    digest = _render_digest(text, reply_markup, parse_mode, kwargs)
+    with _rendered_lock:
+        if _rendered.get(key) == digest:
+            _rendered.move_to_end(key)
+            return None
+    
+    try:
+        result = bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup, parse_mode=parse_mode, **kwargs)
+    except telebot.apihelper.ApiTelegramException as e:
+        if 'message is not modified' not in str(e):
+            forget_rendered(chat_id, message_id)
+            raise
+        result = None
+    
+    with _rendered_lock:
+        _rendered[key] = digest
+        _rendered.move_to_end(key)
+        while len(_rendered) > EDIT_CACHE_SIZE:
+            _rendered.popitem(last=False)
+    return result
+
+def note_user_activity(update, tg_id):
+    """
+    Обновить users.is_reachable по входящему апдейту (разобранный telebot.types.Update).
+
+    Любое действие пользователя (сообщение, кнопка) снимает отметку недоступности,
+    поставленную обновлением профилей. my_chat_member в личном чате — это
+    блокировка/разблокировка бота: флаг выставляется по новому статусу.
+    """
+    if tg_id is None:
+        return
+    user = get_user_info(tg_id)
+    if not user:
+        return
+    member_update = getattr(update, 'my_chat_member', None)
+    if member_update is not None:
+        if member_update.chat.type != 'private':
+            return
+        reachable = member_update.new_chat_member.status not in ('kicked', 'left')
+    else:
+        reachable = True
+    if bool(user.is_reachable) != reachable:
+        set_user_reachable(tg_id, reachable)
+
 def register_user(message):
     tg_id = message.from_user.id
     username = message.from_user.username
     first_name = message.from_user.first_name
     last_name = message.from_user.last_name
     
-    if not get_user_info(tg_id):
+    user = get_user_info(tg_id)
+    if not user:
         query = """
             INSERT INTO users (tg_id, username, first_name, last_name, role) 
             VALUES (?, ?, ?, ?, ?)
         """
         db_execute(query, (tg_id, username, first_name, last_name, 'user'), commit=True)
+        invalidate_user_cache(tg_id)
         return True
     return False
\ No newline at end of file
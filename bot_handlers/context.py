@@ -0,0 +1,82 @@
+"""
+Контекст обработки одного апдейта на contextvars.
+
+Заменяет глобальный SUDO_CONTEXT: действующий пользователь и цель /sudo живут
+только в пределах обработки своего апдейта. Каждый поток (и каждая
+asyncio-задача) видит собственное значение, поэтому sudo-сессия одного
+администратора не перенаправляет сообщения других пользователей.
+
+Роли здесь не кэшируются: is_admin/is_fantom и так отвечают из реестра ролей
+в памяти (db_manager). Фоновые потоки, отправляющие сообщения от имени
+апдейта (очередь исходящих, outbox), восстанавливают его контекст через use_context.
+"""
+import contextvars
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar('request_context', default=None)
+
+
+class RequestContext:
+    """
+    Данные текущего апдейта.
+
+    Args:
+        user_id (int): ID действующего пользователя
+        sudo_target (int): ID пользователя, от лица которого выполняется /sudo (опционально)
+        sudo_admin (int): ID администратора, запустившего /sudo (опционально)
+    """
+
+    def __init__(self, user_id=None, sudo_target=None, sudo_admin=None):
+        self.user_id = user_id
+        self.sudo_target = sudo_target
+        self.sudo_admin = sudo_admin
+
+
+def current_context():
+    """Контекст текущего апдейта или None вне обработки апдейта."""
+    return _current.get()
+
+
+@contextmanager
+def request_context(user_id=None):
+    """Открыть контекст для обработки одного апдейта от user_id."""
+    ctx = RequestContext(user_id)
+    token = _current.set(ctx)
+    try:
+        yield ctx
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def sudo_context(target_tg_id, admin_tg_id):
+    """
+    Вложенный контекст /sudo: действующим пользователем становится target_tg_id,
+    а сообщения, адресованные ему, send() перенаправляет администратору.
+    """
+    ctx = RequestContext(target_tg_id, sudo_target=target_tg_id, sudo_admin=admin_tg_id)
+    token = _current.set(ctx)
+    try:
+        yield ctx
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def use_context(ctx):
+    """Сделать уже созданный контекст текущим (в потоке, выполняющем действие апдейта)."""
+    token = _current.set(ctx)
+    try:
+        yield ctx
+    finally:
+        _current.reset(token)
+
+
+def update_user_id(update):
+    """ID пользователя, от которого пришёл разобранный telebot.types.Update (или None)."""
+    for field in ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                  'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request'):
+        event = getattr(update, field, None)
+        if event and getattr(event, 'from_user', None):
+            return event.from_user.id
+    return None
@@ -1,10 +1,12 @@
-import json
-import random
 import sqlite3
 from telebot import types
-from db_manager import db_execute, get_game_info, is_admin, is_fantom # <-- Добавлен is_fantom
-from bot_handlers.common import get_user_link, get_user_name, main_menu_markup, send
+from db_manager import db_execute, db_executemany, transaction, delete_game, get_game_info, is_admin, is_fantom, get_game_participants, is_game_participant, add_game_participant, get_game_exclusions, create_outbox_batch
+from bot_handlers.common import get_user_link, get_user_links, get_user_name, get_user_names, main_menu_markup, send, edit_message
+from bot_handlers.outbound import wake_outbox, send_later
+from bot_handlers.context import current_context
+from bot_handlers.callback_codec import packed
 from bot_handlers.game_panels import organizer_panel
+from pairing import solve_pairs, PairingError
 
 def join_game_prompt(bot, message, game_id):
     tg_id = message.chat.id
@@ -14,11 +16,10 @@ def join_game_prompt(bot, message, game_id):
         send(bot, tg_id, "Игра не найдена. Возможно, она была удалена.")
         return
         
-    game_name, budget, organizer_id, participants_json, status, invite_code, currency = game[1], game[2], game[3], game[4], game[5], game[6], game[7]
+    game_name, budget, organizer_id, participants_count, currency = game.name, game.budget, game.organizer_id, game.participants_count, game.currency
     organizer_link = get_user_link(organizer_id)
-    participants = json.loads(participants_json)
     
-    if tg_id in participants:
+    if is_game_participant(game_id, tg_id):
         send(bot, tg_id, f"Вы уже являетесь участником игры <b>'{game_name}'</b>.", parse_mode='HTML')
         return
 
@@ -26,11 +27,11 @@ def join_game_prompt(bot, message, game_id):
         f"Вас пригласили в игру Тайного Санты <b>'{game_name}'</b>!\n\n"
         f"<i>Организатор:</i> {organizer_link}\n"
         f"<i>Максимальный бюджет:</i> <b>{budget} {currency}</b>\n"
-        f"<i>Участников сейчас:</i> {len(participants)}"
+        f"<i>Участников сейчас:</i> {participants_count}"
     )
 
     markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("✅ Присоединиться", callback_data=f'join_{game_id}'))
+    markup.add(types.InlineKeyboardButton("✅ Присоединиться", callback_data=packed('j', game_id)))
     markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data='menu'))
 
     send(bot, tg_id, text, reply_markup=markup, parse_mode='HTML')
@@ -40,44 +41,55 @@ def join_game_action(bot, call, game_id):
     game = get_game_info(game_id)
     
     if not game:
-        bot.edit_message_text("Ошибка: Игра не найдена.", call.message.chat.id, call.message.message_id)
+        edit_message(bot, "Ошибка: Игра не найдена.", call.message.chat.id, call.message.message_id)
         return
         
-    game_name = game[1]
-    participants_json = game[4]
-    participants = json.loads(participants_json)
+    game_name = game.name
     
-    if tg_id not in participants:
-        participants.append(tg_id)
-        new_participants_json = json.dumps(participants)
-        
-        db_execute(
-            "UPDATE games SET participants_json = ? WHERE id = ?", 
-            (new_participants_json, game_id), 
-            commit=True
-        )
-        
-        bot.edit_message_text(
+    if add_game_participant(game_id, tg_id):
+        edit_message(bot,
             f"Вы успешно присоединились к игре <b>'{game_name}'</b>!", 
             call.message.chat.id, 
             call.message.message_id, 
             parse_mode='HTML',
             reply_markup=main_menu_markup()
         )
-        organizer_id = game[3]
-        send(bot, organizer_id, f"🔔 {get_user_name(tg_id)} присоединился(ась) к игре <b>'{game_name}'</b>.", parse_mode='HTML')
+        organizer_id = game.organizer_id
+        # Уведомление уходит в чужой чат: через очередь, чтобы волна входов по ссылке не упёрлась в лимиты
+        send_later(bot, organizer_id, f"🔔 {get_user_name(tg_id)} присоединился(ась) к игре <b>'{game_name}'</b>.", parse_mode='HTML')
     else:
         bot.answer_callback_query(call.id, "Вы уже в этой игре.")
 
+def describe_pairing_error(error, limit=10):
+    """Текст ошибки жеребьёвки с именами участников, которым не хватает получателей."""
+    santas = getattr(error, 'santas', None)
+    if santas is None:
+        return str(error)
+    
+    user_names = get_user_names(santas[:limit] + error.recipients[:limit])
+    
+    def names(tg_ids):
+        shown = ', '.join(user_names[p_id] for p_id in tg_ids[:limit])
+        if len(tg_ids) > limit:
+            shown += f" и ещё {len(tg_ids) - limit}"
+        return shown or '—'
+    
+    return (
+        f"Невозможно составить пары с учётом запретов. "
+        f"Участники ({len(santas)}): {names(santas)} — "
+        f"могут дарить только {len(error.recipients)} получателям: {names(error.recipients)}. "
+        f"Снимите часть запретов или ручных пар."
+    )
+
 def draw_pairs(bot, game_id, tg_id):
     game = get_game_info(game_id)
     
     # *** ИЗМЕНЕНИЕ: Проверка на Администратора, если tg_id не является Организатором ***
-    if not game or (game[3] != tg_id and not is_admin(tg_id)):
+    if not game or (game.organizer_id != tg_id and not is_admin(tg_id)):
         return "Ошибка: Игра не найдена или у вас нет прав организатора/администратора.", False
     
-    game_name, budget, organizer_id, participants_json, status, invite_code, currency = game[1], game[2], game[3], game[4], game[5], game[6], game[7]
-    all_participants = json.loads(game[4])
+    game_name, budget, currency = game.name, game.budget, game.currency
+    all_participants = get_game_participants(game_id)
     
     if len(all_participants) < 2:
         return "Недостаточно участников для жеребьёвки (нужно минимум 2).", False
@@ -89,60 +101,27 @@ def draw_pairs(bot, game_id, tg_id):
     )
     admin_pairs = list(admin_pairs_tuple) if admin_pairs_tuple else []
     
-    manual_santas = {santa for santa, recipient in admin_pairs}
-    manual_recipients = {recipient for santa, recipient in admin_pairs}
-    
-    remaining_participants = [p for p in all_participants if p not in manual_santas and p not in manual_recipients]
-    
-    if not set(all_participants).issuperset(manual_santas.union(manual_recipients)):
-         return "Ошибка: Неверно назначены пары. В ручных парах есть участники, не входящие в игру.", False
-
-    remaining_santas = list(remaining_participants)
-    remaining_recipients = list(remaining_participants)
-    
-    if remaining_santas:
-        random.shuffle(remaining_recipients)
-        
-        count = 0
-        while any(s == r for s, r in zip(remaining_santas, remaining_recipients)):
-            random.shuffle(remaining_recipients)
-            count += 1
-            if count > 1000:
-                 return "Ошибка: Невозможно составить пары для оставшихся участников без конфликтов.", False
-                 
-        random_pairs = list(zip(remaining_santas, remaining_recipients))
-    else:
-        random_pairs = []
+    try:
+        random_pairs = solve_pairs(all_participants, admin_pairs, get_game_exclusions(game_id))
+    except PairingError as e:
+        return f"Ошибка: {describe_pairing_error(e)}", False
 
     final_pairs = admin_pairs + random_pairs
-    
-    db_execute("DELETE FROM pairs WHERE game_id = ?", (game_id,), commit=True)
+    manual_pair_set = set(admin_pairs)
     
     try:
-        for santa, recipient in final_pairs:
-            santa_id, recipient_id = santa, recipient 
-            is_admin_pair = 1 if (santa_id, recipient_id) in admin_pairs_tuple else 0
-            
-            db_execute(
-                "INSERT INTO pairs (santa_tg_id, recipient_tg_id, game_id, is_admin_pair) VALUES (?, ?, ?, ?)",
-                (santa_id, recipient_id, game_id, is_admin_pair),
-                commit=True
-            )
+        wishes = dict(db_execute(
+            "SELECT user_tg_id, text FROM wishes WHERE game_id = ?", 
+            (game_id,), 
+            fetch_all=True
+        ) or [])
         
-        db_execute("UPDATE games SET status = 'running' WHERE id = ?", (game_id,), commit=True)
-        
-        successful_sends = []
-        failed_sends = []
+        links = get_user_links(all_participants)
         
+        messages = []
         for santa, recipient in final_pairs:
-            recipient_link = get_user_link(recipient)
-            recipient_wishes = db_execute(
-                "SELECT text FROM wishes WHERE user_tg_id = ? AND game_id = ?", 
-                (recipient, game_id), 
-                fetch_one=True
-            )
-            
-            wish_text = recipient_wishes[0] if recipient_wishes else "Пожелания пока не указаны."
+            recipient_link = links[recipient]
+            wish_text = wishes.get(recipient) or "Пожелания пока не указаны."
             
             message_text = (
                 f"🚨 <b>ЖЕРЕБЬЁВКА В ИГРЕ '{game_name}' ЗАВЕРШЕНА!</b> 🚨\n\n"
@@ -151,14 +130,34 @@ def draw_pairs(bot, game_id, tg_id):
                 f"<i>{wish_text}</i>\n\n"
                 f"💰 <i>Максимальный бюджет: {budget} {currency}</i>"
             )
-            
-            try:
-                send(bot, santa, message_text, parse_mode='HTML')
-                successful_sends.append(santa)
-            except Exception as e:
-                failed_sends.append((santa, e))
+            messages.append((santa, message_text, 'HTML'))
+        
+        # Старые пары, новые пары, смена статуса и уведомления в outbox фиксируются
+        # одним коммитом: сбой посередине не оставит наполовину записанную жеребьёвку,
+        # а рассылка переживёт перезапуск бота.
+        ctx = current_context()
+        sudo = (ctx.sudo_target, ctx.sudo_admin) if ctx and ctx.sudo_admin is not None else None
+        with transaction():
+            db_execute("DELETE FROM pairs WHERE game_id = ?", (game_id,))
+            db_executemany(
+                "INSERT INTO pairs (santa_tg_id, recipient_tg_id, game_id, is_admin_pair) VALUES (?, ?, ?, ?)",
+                [
+                    (santa, recipient, game_id, 1 if (santa, recipient) in manual_pair_set else 0)
+                    for santa, recipient in final_pairs
+                ]
+            )
+            db_execute("UPDATE games SET status = 'running' WHERE id = ?", (game_id,))
+            create_outbox_batch(
+                messages,
+                notify_chat_id=tg_id,
+                title=f"результатов жеребьёвки '{game_name}'",
+                batch_key=f"draw:{game_id}",
+                sudo=sudo
+            )
+        
+        wake_outbox()
                 
-        return (f"✅ Жеребьёвка успешно проведена!\nРазослано {len(successful_sends)} результатов. \nНе удалось разослать {len(failed_sends)}.", True)
+        return (f"✅ Жеребьёвка успешно проведена!\nРассылка {len(final_pairs)} результатов запущена, итог придёт отдельным сообщением.", True)
 
     except sqlite3.IntegrityError:
         return "Ошибка БД: Дубликат в парах. Попробуйте пережеребьёвку.", False
@@ -170,12 +169,12 @@ def finish_game_action(bot, call, game_id):
     tg_id = call.from_user.id
     game = get_game_info(game_id)
     
-    if not game or (game[3] != tg_id and not is_admin(tg_id)):
+    if not game or (game.organizer_id != tg_id and not is_admin(tg_id)):
         bot.answer_callback_query(call.id, "У вас нет прав.")
         return
         
     db_execute("UPDATE games SET status = 'finished' WHERE id = ?", (game_id,), commit=True)
-    bot.answer_callback_query(call.id, f"Игра '{game[1]}' завершена!")
+    bot.answer_callback_query(call.id, f"Игра '{game.name}' завершена!")
     organizer_panel(bot, tg_id, game_id, call.message.message_id)
 
 # *** НОВАЯ ФУНКЦИЯ для команды /admin_action finish ***
@@ -189,30 +188,28 @@ def finish_game_action_admin(bot, game_id, tg_id):
 def delete_game_confirm(bot, call, game_id):
     game = get_game_info(game_id)
     
-    if not game or (game[3] != call.from_user.id and not is_admin(call.from_user.id)):
+    if not game or (game.organizer_id != call.from_user.id and not is_admin(call.from_user.id)):
         bot.answer_callback_query(call.id, "У вас нет прав.")
         return
         
-    text = f"⚠️ <b>Внимание!</b> Вы уверены, что хотите <b>безвозвратно</b> удалить игру <b>'{game[1]}'</b>?"
+    text = f"⚠️ <b>Внимание!</b> Вы уверены, что хотите <b>безвозвратно</b> удалить игру <b>'{game.name}'</b>?"
     markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("✅ ДА, удалить", callback_data=f'confirm_delete_{game_id}'))
-    markup.add(types.InlineKeyboardButton("❌ НЕТ, отмена", callback_data=f'org_panel_{game_id}'))
+    markup.add(types.InlineKeyboardButton("✅ ДА, удалить", callback_data=packed('cd', game_id)))
+    markup.add(types.InlineKeyboardButton("❌ НЕТ, отмена", callback_data=packed('op', game_id)))
     
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
+    edit_message(bot, text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
 
 def delete_game_action(bot, call, game_id):
     tg_id = call.from_user.id
     game = get_game_info(game_id)
     
-    if not game or (game[3] != tg_id and not is_admin(tg_id)):
+    if not game or (game.organizer_id != tg_id and not is_admin(tg_id)):
         bot.answer_callback_query(call.id, "У вас нет прав.")
         return
         
-    db_execute("DELETE FROM pairs WHERE game_id = ?", (game_id,), commit=True)
-    db_execute("DELETE FROM wishes WHERE game_id = ?", (game_id,), commit=True)
-    db_execute("DELETE FROM games WHERE id = ?", (game_id,), commit=True)
+    delete_game(game_id)
     
-    bot.edit_message_text(f"🗑️ Игра <b>'{game[1]}'</b> и все связанные данные удалены.", tg_id, call.message.message_id, parse_mode='HTML')
+    edit_message(bot, f"🗑️ Игра <b>'{game.name}'</b> и все связанные данные удалены.", tg_id, call.message.message_id, parse_mode='HTML')
 
 def prompt_wish_text(bot, call, game_id, user_states):
     tg_id = call.from_user.id
@@ -223,8 +220,7 @@ def prompt_wish_text(bot, call, game_id, user_states):
     
     game = get_game_info(game_id)
     
-    participants = json.loads(game[4]) if game else []
-    if tg_id not in participants:
+    if not game or not is_game_participant(game_id, tg_id):
          bot.answer_callback_query(call.id, "Вы не участвуете в этой игре.")
          return
 
@@ -237,13 +233,13 @@ def prompt_wish_text(bot, call, game_id, user_states):
     wish_text = current_wish[0] if current_wish else "пока не указаны"
     
     text = (
-        f"🎁 <b>Игра: {game[1]}</b>\n\n"
+        f"🎁 <b>Игра: {game.name}</b>\n\n"
         f"Ваши текущие пожелания:\n"
         f"<i>{wish_text}</i>\n\n"
         f"<b>Введите новые пожелания</b> (это полностью заменит старые). Нажмите /cancel для отмены."
     )
     
-    bot.edit_message_text(text, tg_id, call.message.message_id, parse_mode='HTML')
+    edit_message(bot, text, tg_id, call.message.message_id, parse_mode='HTML')
     user_states[tg_id] = ('waiting_wish_text', {'game_id': game_id})
     
 def handle_wish_text(bot, message, user_states):
@@ -257,18 +253,21 @@ def handle_wish_text(bot, message, user_states):
     game_id = context['game_id']
     wish_text = message.text.strip()
     
+    # Upsert, а не INSERT OR REPLACE: запись сохраняет id, и триггеры FTS-индекса
+    # видят обычный UPDATE (удаление при REPLACE триггеры не вызывает)
     query = """
-        INSERT OR REPLACE INTO wishes (user_tg_id, game_id, text) 
+        INSERT INTO wishes (user_tg_id, game_id, text) 
         VALUES (?, ?, ?)
+        ON CONFLICT(user_tg_id, game_id) DO UPDATE SET text = excluded.text
     """
     db_execute(query, (tg_id, game_id, wish_text), commit=True)
     
-    del user_states[tg_id]
+    user_states.discard(tg_id)
     
     game = get_game_info(game_id)
     send(
         bot, tg_id, 
-        f"✅ Ваши пожелания для игры <b>'{game[1]}'</b> сохранены.", 
+        f"✅ Ваши пожелания для игры <b>'{game.name}'</b> сохранены.", 
         parse_mode='HTML', 
         reply_markup=main_menu_markup()
     )
@@ -280,11 +279,9 @@ def delete_game_action_admin(bot, game_id, tg_id):
         # Эта ошибка будет обработана в main.py
         return "У вас нет прав администратора или игра не найдена.", False
 
-    game_name = game[1]
+    game_name = game.name
 
-    # Удаление всех связанных данных: пары, пожелания, сама игра
-    db_execute("DELETE FROM pairs WHERE game_id = ?", (game_id,), commit=True)
-    db_execute("DELETE FROM wishes WHERE game_id = ?", (game_id,), commit=True)
-    db_execute("DELETE FROM games WHERE id = ?", (game_id,), commit=True)
+    # Удаление всех связанных данных: пары, пожелания, участники, сама игра
+    delete_game(game_id)
     
     return f"🗑️ Игра <b>'{game_name}'</b> (ID: {game_id}) и все связанные данные удалены.", True
\ No newline at end of file
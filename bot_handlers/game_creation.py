@@ -1,7 +1,6 @@
-import json
 from telebot import types
-from db_manager import db_execute, get_game_info, is_fantom
-from bot_handlers.common import CURRENCIES, generate_invite_code, send
+from db_manager import db_execute, get_game_info, is_fantom, add_game_participant, transaction
+from bot_handlers.common import CURRENCIES, generate_invite_code, send, edit_message
 from bot_handlers.game_panels import organizer_panel # Импорт панели организатора
 
 def create_game_start(bot, message, user_states):
@@ -45,18 +44,17 @@ def handle_budget(bot, message, user_states):
     
     prompt_currency_select(bot, tg_id, budget)
 
-def handle_currency_select_callback(bot, call, user_states):
+def handle_currency_select_callback(bot, call, currency_code, user_states):
     tg_id = call.from_user.id
     
     if is_fantom(tg_id):
         bot.answer_callback_query(call.id, "❌ Вам запрещено использовать этот бот.", show_alert=True)
         return
     
-    if tg_id not in user_states or user_states[tg_id][0] != 'waiting_currency':
+    if user_states.state_of(tg_id) != 'waiting_currency':
         bot.answer_callback_query(call.id, "Истекло время ожидания или неверный контекст.")
         return
         
-    currency_code = call.data.split('_')[2]
     context = user_states[tg_id][1]
     
     if currency_code not in CURRENCIES:
@@ -70,15 +68,18 @@ def handle_currency_select_callback(bot, call, user_states):
         if not db_execute("SELECT id FROM games WHERE invite_code = ?", (invite_code,), fetch_one=True):
             break
 
-    query = "INSERT INTO games (name, budget, organizer_id, participants_json, invite_code, currency) VALUES (?, ?, ?, ?, ?, ?)"
-    db_execute(query, (context['name'], context['budget'], tg_id, json.dumps([tg_id]), invite_code, context['currency']), commit=True)
-    
-    game_info = db_execute("SELECT id FROM games WHERE name = ?", (context['name'],), fetch_one=True)
-    game_id = game_info[0]
+    # Игра и её организатор в game_participants появляются вместе или не появляются вовсе
+    with transaction():
+        query = "INSERT INTO games (name, budget, organizer_id, invite_code, currency) VALUES (?, ?, ?, ?, ?)"
+        db_execute(query, (context['name'], context['budget'], tg_id, invite_code, context['currency']), commit=True)
+        
+        game_info = db_execute("SELECT id FROM games WHERE name = ?", (context['name'],), fetch_one=True)
+        game_id = game_info[0]
+        add_game_participant(game_id, tg_id)
     
-    del user_states[tg_id]
+    user_states.discard(tg_id)
     
-    bot.edit_message_text(
+    edit_message(bot,
         f"🎉 Игра <b>'{context['name']}'</b> создана с бюджетом <b>{context['budget']} {context['currency']}</b>.",
         tg_id,
         call.message.message_id,
@@ -1,27 +1,34 @@
-import json
 from telebot import types
-from db_manager import db_execute, get_game_info, is_fantom
-from bot_handlers.common import get_user_link, main_menu_markup, send
+from db_manager import db_execute, get_game_info, is_fantom, get_game_participants, is_game_participant, get_user_games
+from bot_handlers.common import get_user_link, get_user_links, get_invite_link, main_menu_markup, send, edit_message
+from bot_handlers.callback_codec import packed
 
 # Функция для вызова из других модулей, чтобы избежать циклической зависимости
 def organizer_panel(bot, tg_id, game_id, message_id=None):
     game = get_game_info(game_id)
     if not game:
         if message_id:
-             bot.edit_message_text("Ошибка: Игра не найдена.", tg_id, message_id)
+             edit_message(bot, "Ошибка: Игра не найдена.", tg_id, message_id)
         else:
              send(bot, tg_id, "Ошибка: Игра не найдена.")
         return
         
-    if game[3] != tg_id:
+    if game.organizer_id != tg_id:
         send(bot, tg_id, "У вас нет прав на управление этой игрой.")
         return
 
-    game_name, budget, organizer_id, participants_json, status, invite_code, currency = game[1], game[2], game[3], game[4], game[5], game[6], game[7]
-    participants = json.loads(participants_json)
+    game_name, budget, status, invite_code, currency = game.name, game.budget, game.status, game.invite_code, game.currency
+    participants = get_game_participants(game_id)
     
-    invite_link = f"https://t.me/{bot.get_me().username}?start={invite_code}"
-    participants_list = "\n".join([f"- {get_user_link(p_id)}" for p_id in participants])
+    pairs = []
+    if status == 'running':
+        pairs = db_execute("SELECT santa_tg_id, recipient_tg_id, is_admin_pair FROM pairs WHERE game_id = ?", (game_id,), fetch_all=True)
+    
+    # Все имена для панели — одним запросом
+    links = get_user_links(participants + [p_id for pair in pairs for p_id in pair[:2]])
+    
+    invite_link = get_invite_link(bot, invite_code)
+    participants_list = "\n".join([f"- {links[p_id]}" for p_id in participants])
     
     text = (
         f"👑 <b>Панель Организатора: {game_name}</b>\n\n"
@@ -33,12 +40,11 @@ def organizer_panel(bot, tg_id, game_id, message_id=None):
     )
 
     if status == 'running':
-        pairs = db_execute("SELECT santa_tg_id, recipient_tg_id, is_admin_pair FROM pairs WHERE game_id = ?", (game_id,), fetch_all=True)
         if pairs:
             text += "\n--- 👥 <b>Пары</b> ---\n"
             for santa_id, recipient_id, is_admin_pair in pairs:
-                santa_link = get_user_link(santa_id)
-                recipient_link = get_user_link(recipient_id)
+                santa_link = links[santa_id]
+                recipient_link = links[recipient_id]
                 source = " (Ручн.)" if is_admin_pair else ""
                 text += f"🎅 {santa_link} ➡️ 🎁 {recipient_link}{source}\n"
         else:
@@ -54,21 +60,20 @@ def organizer_panel(bot, tg_id, game_id, message_id=None):
     if len(participants) < 2 and status == 'setup':
          markup.add(types.InlineKeyboardButton("🚫 Нельзя начать (нужно минимум 2)", callback_data='noop'))
     elif status == 'setup':
-        markup.add(types.InlineKeyboardButton(f"🎲 Провести жеребьёвку", callback_data=f'draw_{game_id}'))
+        markup.add(types.InlineKeyboardButton(f"🎲 Провести жеребьёвку", callback_data=packed('dr', game_id)))
     elif status == 'running':
-        markup.add(types.InlineKeyboardButton("🔄 Пережеребьёвка", callback_data=f'draw_{game_id}'))
-        markup.add(types.InlineKeyboardButton("🎁 Завершить игру", callback_data=f'finish_game_{game_id}'))
+        markup.add(types.InlineKeyboardButton("🔄 Пережеребьёвка", callback_data=packed('dr', game_id)))
+        markup.add(types.InlineKeyboardButton("🎁 Завершить игру", callback_data=packed('fg', game_id)))
     
-    markup.add(types.InlineKeyboardButton("✏️ Мои пожелания", callback_data=f'wish_game_{game_id}'))
-    markup.add(types.InlineKeyboardButton("🗑️️ Удалить игру", callback_data=f'delete_game_{game_id}'))
+    if status == 'setup':
+        markup.add(types.InlineKeyboardButton("📥 Импорт участников из файла", callback_data=packed('ip', game_id)))
+    
+    markup.add(types.InlineKeyboardButton("✏️ Мои пожелания", callback_data=packed('wg', game_id)))
+    markup.add(types.InlineKeyboardButton("🗑️️ Удалить игру", callback_data=packed('dg', game_id)))
     markup.add(types.InlineKeyboardButton("⬅️ Назад в Мои игры", callback_data='my_games'))
     
     if message_id:
-        try:
-            bot.edit_message_text(text, tg_id, message_id, reply_markup=markup, parse_mode='HTML')
-        except telebot.apihelper.ApiTelegramException as e:
-            if 'message is not modified' not in str(e):
-                raise e
+        edit_message(bot, text, tg_id, message_id, reply_markup=markup, parse_mode='HTML')
     else:
         send(bot, tg_id, text, reply_markup=markup, parse_mode='HTML')
 
@@ -80,10 +85,9 @@ def participant_game_view(bot, call, game_id):
         bot.answer_callback_query(call.id, "Игра не найдена.", show_alert=True)
         return
 
-    game_name, budget, organizer_id, participants_json, status, invite_code, currency = game[1], game[2], game[3], game[4], game[5], game[6], game[7]
-    participants = json.loads(participants_json)
+    game_name, budget, organizer_id, status, currency = game.name, game.budget, game.organizer_id, game.status, game.currency
     
-    if tg_id not in participants:
+    if not is_game_participant(game_id, tg_id):
         bot.answer_callback_query(call.id, "Вы не являетесь участником этой игры.", show_alert=True)
         return
         
@@ -123,28 +127,22 @@ def participant_game_view(bot, call, game_id):
         text += "\n--- ✅ ---\n"
         text += "Игра завершена."
         
-    markup.add(types.InlineKeyboardButton("✏️ Мои пожелания", callback_data=f'wish_game_{game_id}'))
+    markup.add(types.InlineKeyboardButton("✏️ Мои пожелания", callback_data=packed('wg', game_id)))
     markup.add(types.InlineKeyboardButton("⬅️ Назад в Мои игры", callback_data='my_games'))
     
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
+    edit_message(bot, text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
+
+MY_GAMES_PAGE_SIZE = 20
 
-def my_games_panel(bot, call):
+def my_games_panel(bot, call, before_game_id=None):
     tg_id = call.from_user.id 
     message_id = call.message.message_id
     
-    org_games = db_execute("SELECT id, name, status FROM games WHERE organizer_id = ?", (tg_id,), fetch_all=True)
-    all_games = db_execute("SELECT id, name, participants_json, organizer_id, status FROM games", fetch_all=True)
+    games, has_more = get_user_games(tg_id, before_game_id, MY_GAMES_PAGE_SIZE)
     
-    participant_games = []
-    wish_games = []
-    
-    for game_id, name, participants_json, organizer_id, status in all_games:
-        participants = json.loads(participants_json)
-        if tg_id in participants:
-            if organizer_id != tg_id:
-                participant_games.append((game_id, name))
-            if status != 'finished':
-                 wish_games.append((game_id, name))
+    org_games = [(game_id, name, status) for game_id, name, status, is_org, is_part, wish_editable in games if is_org]
+    participant_games = [(game_id, name) for game_id, name, status, is_org, is_part, wish_editable in games if is_part and not is_org]
+    wish_games = [(game_id, name) for game_id, name, status, is_org, is_part, wish_editable in games if wish_editable]
 
     text = "🗓️ <b>Ваши игры Тайного Санты</b>\n"
     markup = types.InlineKeyboardMarkup()
@@ -153,25 +151,26 @@ def my_games_panel(bot, call):
         text += "\n👑 <b>Организатор:</b>\n"
         for game_id, name, status in org_games:
             status_emoji = '⚙️' if status == 'setup' else '🏃'
-            markup.add(types.InlineKeyboardButton(f"{status_emoji} {name} (Орг)", callback_data=f'org_panel_{game_id}'))
+            markup.add(types.InlineKeyboardButton(f"{status_emoji} {name} (Орг)", callback_data=packed('op', game_id)))
             
     if participant_games:
         text += "\n👥 <b>Участник (Просмотр):</b>\n"
         for game_id, name in participant_games:
-            markup.add(types.InlineKeyboardButton(f"🎁 {name} (Уч.)", callback_data=f'view_game_{game_id}'))
+            markup.add(types.InlineKeyboardButton(f"🎁 {name} (Уч.)", callback_data=packed('vg', game_id)))
             
     # if wish_games:
     #     text += "\n📝 <b>Написать/изменить пожелание:</b>\n"
     #     for game_id, name in wish_games:
-    #         markup.add(types.InlineKeyboardButton(f"✏️ {name}", callback_data=f'wish_game_{game_id}'))
+    #         markup.add(types.InlineKeyboardButton(f"✏️ {name}", callback_data=packed('wg', game_id)))
             
     if not org_games and not participant_games and not wish_games:
         text += "\nУ вас пока нет активных игр."
 
+    if has_more:
+        markup.add(types.InlineKeyboardButton("Ещё игры ➡️", callback_data=packed('mg', games[-1][0])))
+    if before_game_id is not None:
+        markup.add(types.InlineKeyboardButton("⬆️ К последним играм", callback_data='my_games'))
+
     markup.add(types.InlineKeyboardButton("⬅️ Главное меню", callback_data='menu'))
 
-    try:
-        bot.edit_message_text(text, tg_id, message_id, reply_markup=markup, parse_mode='HTML')
-    except telebot.apihelper.ApiTelegramException as e:
-        if 'message is not modified' not in str(e):
-            raise e
\ No newline at end of file
+    edit_message(bot, text, tg_id, message_id, reply_markup=markup, parse_mode='HTML')
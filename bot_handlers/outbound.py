@@ -0,0 +1,333 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+import telebot
+from db_manager import claim_due_outbox, mark_outbox_sent, mark_outbox_skipped, mark_outbox_failed, reset_inflight_outbox, complete_outbox_batch
+from bot_handlers.common import send, escape_html
+from bot_handlers.context import RequestContext, current_context, use_context
+
+# Лимиты Telegram Bot API: ~30 сообщений в секунду суммарно и ~1 в секунду в один чат
+GLOBAL_RATE = 25
+GLOBAL_BURST = 25
+PER_CHAT_INTERVAL = 1.0
+WORKER_COUNT = 4
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 2.0
+
+OUTBOX_POLL_INTERVAL = 5.0
+OUTBOX_MAX_IN_FLIGHT = 200
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BASE_DELAY = 30.0
+
+
+class TokenBucket:
+    """Потокобезопасный token bucket: rate токенов в секунду, не более capacity в запасе."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Дождаться и забрать один токен."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def block_for(self, seconds):
+        """Не выдавать токены seconds секунд (глобальный flood wait от Telegram)."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class _OutboundMessage:
+    __slots__ = ('chat_id', 'text', 'reply_markup', 'parse_mode', 'attempts', 'max_attempts', 'on_result', 'context')
+
+    def __init__(self, chat_id, text, reply_markup, parse_mode, on_result, context, max_attempts):
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_markup = reply_markup
+        self.parse_mode = parse_mode
+        self.on_result = on_result
+        # Контекст апдейта, поставившего сообщение: воркер отправляет в нём (sudo-перенаправление)
+        self.context = context
+        self.attempts = 0
+        self.max_attempts = max_attempts
+
+
+class DeliverySkipped(Exception):
+    """Сообщение намеренно не отправлено: common.send вернул None (получатель — фантом)."""
+
+
+def get_retry_after(error):
+    """Вернуть retry_after из ответа 429 Too Many Requests или None."""
+    if getattr(error, 'error_code', None) != 429:
+        return None
+    parameters = (getattr(error, 'result_json', None) or {}).get('parameters') or {}
+    return parameters.get('retry_after', 1)
+
+
+def is_permanent_error(error):
+    """Ошибки, после которых повторять отправку бессмысленно (бот заблокирован, чат не найден и т.п.)."""
+    return isinstance(error, telebot.apihelper.ApiTelegramException) and error.error_code in (400, 403)
+
+
+class OutboundQueue:
+    """
+    Очередь исходящих сообщений с фоновыми воркерами.
+
+    Соблюдает глобальный лимит (token bucket) и интервал между сообщениями в
+    один чат, на 429 ждёт retry_after, сетевые ошибки повторяет с экспоненциальной
+    задержкой. Отправка идёт через common.send, поэтому проверки fantom/sudo сохраняются.
+
+    Сам common.send остаётся синхронным: им отвечают в чат текущего апдейта (одно
+    сообщение на действие пользователя, лимиты не грозят), и вызывающему часто
+    нужен отправленный Message (например, message_id для последующих правок).
+    Сообщения в другие чаты и рассылки идут через send_later или outbox.
+    """
+
+    def __init__(self, bot, workers=WORKER_COUNT, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 per_chat_interval=PER_CHAT_INTERVAL):
+        self.bot = bot
+        self.bucket = TokenBucket(global_rate, global_burst)
+        self.per_chat_interval = per_chat_interval
+        self._heap = []
+        self._seq = itertools.count()
+        self._chat_next_at = {}
+        self._cond = threading.Condition()
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"outbound-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def enqueue(self, chat_id, text, reply_markup=None, parse_mode=None, on_result=None, context=None,
+                max_attempts=MAX_ATTEMPTS):
+        """
+        Поставить сообщение в очередь на отправку.
+
+        Args:
+            context: RequestContext для отправки; по умолчанию — контекст текущего апдейта
+            max_attempts: Сколько раз пробовать при временных ошибках (ожидание по 429 не считается);
+                1 — когда повторами управляет вызывающий (outbox)
+            on_result: Колбэк on_result(chat_id, error) после доставки или окончательной ошибки;
+                error — DeliverySkipped, если сообщение намеренно не отправлено
+        """
+        if context is None:
+            context = current_context()
+        self._push(_OutboundMessage(chat_id, text, reply_markup, parse_mode, on_result, context, max_attempts), time.monotonic())
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _push(self, item, ready_at):
+        with self._cond:
+            heapq.heappush(self._heap, (ready_at, next(self._seq), item))
+            self._cond.notify()
+
+    def _pop(self):
+        """Взять сообщение, которое уже можно отправлять, с учётом интервала для его чата."""
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                ready_at, _, item = self._heap[0]
+                now = time.monotonic()
+                if ready_at > now:
+                    self._cond.wait(ready_at - now)
+                    continue
+                heapq.heappop(self._heap)
+                chat_next_at = self._chat_next_at.get(item.chat_id, 0.0)
+                if chat_next_at > now:
+                    # Чат ещё «остывает» — откладываем, не занимая воркер
+                    heapq.heappush(self._heap, (chat_next_at, next(self._seq), item))
+                    continue
+                self._chat_next_at[item.chat_id] = now + self.per_chat_interval
+                if len(self._chat_next_at) > 10000:
+                    self._chat_next_at = {
+                        chat_id: at for chat_id, at in self._chat_next_at.items() if at > now
+                    }
+                return item
+
+    def _worker(self):
+        while True:
+            item = self._pop()
+            self.bucket.acquire()
+            item.attempts += 1
+            try:
+                sent = self._send(item)
+            except Exception as e:
+                retry_after = get_retry_after(e)
+                if retry_after is not None:
+                    with self._cond:
+                        self._chat_next_at[item.chat_id] = time.monotonic() + retry_after
+                    self.bucket.block_for(retry_after)
+                    self._push(item, time.monotonic() + retry_after)
+                elif not is_permanent_error(e) and item.attempts < item.max_attempts:
+                    self._push(item, time.monotonic() + RETRY_BASE_DELAY * 2 ** (item.attempts - 1))
+                else:
+                    self._finish(item, e)
+                continue
+            self._finish(item, None if sent is not None else DeliverySkipped(item.chat_id))
+
+    def _send(self, item):
+        if item.context is None:
+            return send(self.bot, item.chat_id, item.text, reply_markup=item.reply_markup, parse_mode=item.parse_mode)
+        with use_context(item.context):
+            return send(self.bot, item.chat_id, item.text, reply_markup=item.reply_markup, parse_mode=item.parse_mode)
+
+    def _finish(self, item, error):
+        if item.on_result:
+            try:
+                item.on_result(item.chat_id, error)
+            except Exception:
+                pass
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_outbound_queue(bot):
+    """Общая очередь исходящих сообщений (создаётся при первом обращении)."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = OutboundQueue(bot)
+        return _queue
+
+
+def send_later(bot, chat_id, text, reply_markup=None, parse_mode=None):
+    """Асинхронный аналог common.send: сообщение уйдёт из очереди с соблюдением лимитов."""
+    get_outbound_queue(bot).enqueue(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+
+
+class OutboxWorker:
+    """
+    Фоновый разборщик персистентного outbox (таблица outbox в db_manager).
+
+    Забирает сообщения, срок отправки которых наступил, и отдаёт их в OutboundQueue.
+    Успешные помечаются 'sent' сразу после отправки, поэтому после перезапуска
+    повторно уходят только прерванные. Повторами управляет только outbox (очередь
+    делает одну попытку): временные ошибки откладываются с экспоненциальной
+    задержкой, постоянные и исчерпавшие OUTBOX_MAX_ATTEMPTS переводятся в 'dead'.
+    Когда рассылка завершена, её инициатор получает итог.
+    """
+
+    def __init__(self, bot, queue, poll_interval=OUTBOX_POLL_INTERVAL):
+        self.bot = bot
+        self.queue = queue
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+
+    def start(self):
+        reset_inflight_outbox()
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                self._drain()
+            except Exception:
+                traceback.print_exc()
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                capacity = OUTBOX_MAX_IN_FLIGHT - self._in_flight
+            if capacity <= 0:
+                return
+            rows = claim_due_outbox(capacity)
+            if not rows:
+                return
+            with self._lock:
+                self._in_flight += len(rows)
+            for message_id, batch_id, chat_id, text, parse_mode, attempts, sudo_admin in rows:
+                context = None
+                if sudo_admin is not None:
+                    # Рассылку запустили в /sudo от имени chat_id: письмо ему уходит администратору
+                    context = RequestContext(chat_id, sudo_target=chat_id, sudo_admin=sudo_admin)
+                self.queue.enqueue(
+                    chat_id, text, parse_mode=parse_mode, context=context, max_attempts=1,
+                    on_result=self._result_handler(message_id, batch_id, attempts)
+                )
+
+    def _result_handler(self, message_id, batch_id, attempts):
+        def on_result(chat_id, error):
+            try:
+                if error is None:
+                    mark_outbox_sent(message_id)
+                elif isinstance(error, DeliverySkipped):
+                    mark_outbox_skipped(message_id)
+                elif is_permanent_error(error) or attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                    mark_outbox_failed(message_id, str(error))
+                else:
+                    retry_at = time.time() + OUTBOX_RETRY_BASE_DELAY * 2 ** attempts
+                    mark_outbox_failed(message_id, str(error), retry_at)
+                if batch_id is not None:
+                    self._report_if_complete(batch_id)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                self._wake.set()
+        return on_result
+
+    def _report_if_complete(self, batch_id):
+        result = complete_outbox_batch(batch_id)
+        if not result:
+            return
+        notify_chat_id, title, sent, dead, skipped = result
+        if notify_chat_id is None:
+            return
+        text = f"📬 Рассылка <b>{escape_html(title or 'сообщений')}</b> завершена.\nДоставлено: {sent}. Не удалось доставить: {dead}."
+        if skipped:
+            text += f"\nПропущено (заблокированные ботом пользователи-фантомы): {skipped}."
+        if dead:
+            text += "\nНедоставленные можно повторить из админ-панели."
+        self.queue.enqueue(notify_chat_id, text, parse_mode='HTML')
+
+
+_outbox_worker = None
+
+
+def start_outbox_worker(bot):
+    """Запустить разбор outbox (при старте бота, после init_db)."""
+    global _outbox_worker
+    queue = get_outbound_queue(bot)
+    with _queue_lock:
+        if _outbox_worker is None:
+            _outbox_worker = OutboxWorker(bot, queue)
+            _outbox_worker.start()
+    return _outbox_worker
+
+
+def wake_outbox():
+    """Сообщить воркеру, что в outbox появились новые сообщения."""
+    if _outbox_worker is not None:
+        _outbox_worker.wake()
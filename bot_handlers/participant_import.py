@@ -0,0 +1,203 @@
+"""
+Массовое добавление участников в игру из файла (CSV/TXT) или текста сообщения.
+
+В каждой строке берётся первое непустое поле (разделители ',', ';', Tab):
+tg_id, @username, username или ссылка t.me/username. Строки разбираются
+одним проходом, ссылки сопоставляются с users порциями по IMPORT_BATCH_SIZE,
+найденные пользователи добавляются в игру одной транзакцией. Повторный импорт
+того же списка ничего не дублирует. Пользователи, которые ещё не писали боту,
+не найдутся: им нужно нажать /start или войти по ссылке-приглашению.
+"""
+import io
+import re
+import sqlite3
+import traceback
+import urllib.request
+from telebot import types
+from db_manager import get_game_info, add_game_participants, find_registered_tg_ids, find_tg_ids_by_usernames, SQL_IN_CHUNK
+from bot_handlers.common import send, edit_message, escape_html
+from bot_handlers.callback_codec import packed
+
+IMPORT_BATCH_SIZE = SQL_IN_CHUNK
+# Ограничение Bot API на скачивание файлов
+MAX_IMPORT_FILE_SIZE = 20 * 1024 * 1024
+UNRESOLVED_REPORT_LIMIT = 20
+DOWNLOAD_TIMEOUT = 30
+# tg_id хранится в INTEGER SQLite — знаковом 64-битном
+MAX_TG_ID = 2 ** 63 - 1
+
+_FIELD_SEPARATORS = re.compile(r'[,;\t]')
+_TG_ID = re.compile(r'\d{1,19}')
+_USERNAME = re.compile(r'(?:https?://)?(?:t\.me/|telegram\.me/|@)?([A-Za-z][A-Za-z0-9_]{3,31})/?')
+_HEADER_WORDS = {'tg_id', 'id', 'telegram_id', 'username', 'user', 'login', 'telegram'}
+
+
+def parse_participant_ref(line):
+    """
+    Разобрать строку файла.
+
+    Returns:
+        tuple: ('id', tg_id), ('username', username в нижнем регистре),
+            ('empty', None) для пустой строки или (None, поле) для нераспознанной
+    """
+    for field in _FIELD_SEPARATORS.split(line):
+        field = field.strip().strip('"\'').strip()
+        if not field:
+            continue
+        if _TG_ID.fullmatch(field) and int(field) <= MAX_TG_ID:
+            return 'id', int(field)
+        found = _USERNAME.fullmatch(field)
+        if found:
+            return 'username', found.group(1).lower()
+        return None, field
+    return 'empty', None
+
+
+class ParticipantImport:
+    """Один проход импорта: накапливает порции ссылок и результат сопоставления."""
+
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.tg_ids = {}
+        self.unresolved = []
+        self.duplicates = 0
+        self._pending_ids = []
+        self._pending_usernames = []
+
+    def feed(self, lines):
+        for line_no, line in enumerate(lines, 1):
+            kind, value = parse_participant_ref(line)
+            if kind == 'empty':
+                continue
+            if line_no == 1 and str(value).lower() in _HEADER_WORDS:
+                # Заголовок CSV
+                continue
+            if kind is None:
+                self.unresolved.append((line_no, line.strip()))
+                continue
+            pending = self._pending_ids if kind == 'id' else self._pending_usernames
+            pending.append((line_no, line.strip(), value))
+            if len(pending) >= self.batch_size:
+                self._resolve()
+        self._resolve()
+
+    def _resolve(self):
+        if self._pending_ids:
+            found = find_registered_tg_ids(value for _, _, value in self._pending_ids)
+            self._collect(self._pending_ids, lambda value: value if value in found else None)
+            self._pending_ids = []
+        if self._pending_usernames:
+            found = find_tg_ids_by_usernames({value for _, _, value in self._pending_usernames})
+            self._collect(self._pending_usernames, found.get)
+            self._pending_usernames = []
+
+    def _collect(self, pending, lookup):
+        for line_no, raw, value in pending:
+            tg_id = lookup(value)
+            if tg_id is None:
+                self.unresolved.append((line_no, raw))
+            elif tg_id in self.tg_ids:
+                self.duplicates += 1
+            else:
+                self.tg_ids[tg_id] = line_no
+
+
+def import_participants(game_id, lines):
+    """
+    Импортировать участников игры из итерируемого набора строк.
+
+    Returns:
+        dict: added, already (уже были в игре), duplicates (повторы в списке),
+            unresolved (список (номер строки, строка), отсортированный по номеру)
+    """
+    result = ParticipantImport()
+    result.feed(lines)
+    added = add_game_participants(game_id, result.tg_ids) if result.tg_ids else 0
+    return {
+        'added': added,
+        'already': len(result.tg_ids) - added,
+        'duplicates': result.duplicates,
+        'unresolved': sorted(result.unresolved),
+    }
+
+
+def format_import_report(game_name, report):
+    text = (
+        f"📥 <b>Импорт участников: {escape_html(game_name)}</b>\n\n"
+        f"Добавлено: <b>{report['added']}</b>\n"
+        f"Уже были в игре: {report['already']}\n"
+        f"Повторы в списке: {report['duplicates']}\n"
+        f"Не найдены: <b>{len(report['unresolved'])}</b>"
+    )
+    if report['unresolved']:
+        shown = report['unresolved'][:UNRESOLVED_REPORT_LIMIT]
+        text += "\n\n" + "\n".join(f"стр. {line_no}: <code>{escape_html(raw[:64])}</code>" for line_no, raw in shown)
+        if len(report['unresolved']) > len(shown):
+            text += f"\n… и ещё {len(report['unresolved']) - len(shown)}"
+        text += "\n\n<i>Не найденные пользователи должны сначала написать боту /start.</i>"
+    return text
+
+
+def prompt_participants_import(bot, call, game_id, user_states):
+    game = get_game_info(game_id)
+    if not game or game.status != 'setup':
+        bot.answer_callback_query(call.id, "Импорт возможен только до жеребьёвки.")
+        return
+
+    text = (
+        f"📥 <b>Импорт участников в игру {escape_html(game.name)}</b>\n\n"
+        f"Пришлите файл CSV/TXT или сообщение со списком: по одному участнику в строке — "
+        f"Telegram ID, @username или ссылка t.me/username (в CSV берётся первая колонка).\n"
+        f"Нажмите /cancel, чтобы отменить."
+    )
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("⬅️ Назад к игре", callback_data=packed('op', game_id)))
+    edit_message(bot, text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='HTML')
+    user_states[call.from_user.id] = ('waiting_participants_import', {'game_id': game_id})
+
+
+def _open_import_lines(bot, message):
+    """
+    Открыть строки файла или текста сообщения.
+
+    Файл не загружается в память целиком: строки читаются по мере разбора
+    прямо из ответа на запрос к file URL. Результат нужно закрыть (with).
+    """
+    if message.document is not None:
+        if message.document.file_size and message.document.file_size > MAX_IMPORT_FILE_SIZE:
+            raise ValueError("Файл больше 20 МБ — Telegram не даёт боту его скачать.")
+        response = urllib.request.urlopen(bot.get_file_url(message.document.file_id), timeout=DOWNLOAD_TIMEOUT)
+        return io.TextIOWrapper(response, encoding='utf-8-sig', errors='replace')
+    return io.StringIO(message.text or '')
+
+
+def handle_participants_import(bot, message, user_states):
+    tg_id = message.chat.id
+    game_id = user_states[tg_id][1]['game_id']
+
+    game = get_game_info(game_id)
+    if not game or game.status != 'setup':
+        user_states.discard(tg_id)
+        send(bot, tg_id, "❌ Игра не найдена или жеребьёвка уже проведена.")
+        return
+
+    try:
+        with _open_import_lines(bot, message) as lines:
+            report = import_participants(game_id, lines)
+    except ValueError as e:
+        send(bot, tg_id, f"❌ {e}")
+        return
+    except OSError:
+        traceback.print_exc()
+        send(bot, tg_id, "❌ Не удалось скачать файл, пришлите его ещё раз.")
+        return
+    except (OverflowError, sqlite3.Error):
+        traceback.print_exc()
+        user_states.discard(tg_id)
+        send(bot, tg_id, "❌ Не удалось импортировать участников, попробуйте позже.")
+        return
+
+    user_states.discard(tg_id)
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("👑 К панели игры", callback_data=packed('op', game_id)))
+    send(bot, tg_id, format_import_report(game.name, report), reply_markup=markup, parse_mode='HTML')
@@ -0,0 +1,202 @@
+"""
+Табличный роутер callback-запросов inline-кнопок.
+
+Маршрут задаётся шаблоном callback_data, например 'org_panel_{game_id:int}' или
+'admin_db_table_{table_name}_{page:int}'. Маршруты без аргументов ищутся в
+словаре по точному совпадению, остальные — по литеральному префиксу до первого
+аргумента (он должен заканчиваться на '_'): кандидаты-префиксы перебираются по
+позициям '_' в callback_data от длинного к короткому, каждый — один поиск в
+словаре. Аргументы разбираются регулярным выражением только для найденного
+маршрута и приводятся к типам конвертеров.
+
+Компактные маршруты (add_packed / add_token) принимают callback_data,
+построенные bot_handlers.callback_codec.
+
+Для каждого маршрута считаются число вызовов, ошибки и время обработки.
+"""
+import re
+import threading
+import time
+from bot_handlers.callback_codec import decode_ints, resolve_token, register_inline, decode_inline
+
+# Конвертеры аргументов: имя -> (регулярное выражение, функция преобразования)
+CONVERTERS = {
+    'int': (r'-?\d+', int),
+    'str': (r'.+?', str),
+    'packed': (r'[A-Za-z0-9_-]*', decode_ints),
+    'token': (r'[A-Za-z0-9_-]+', resolve_token),
+    # Сырой inline-формат tokenized: разбирается в expand маршрута, где известен тег
+    'inline': (r'[A-Za-z0-9_.-]*\.[A-Za-z0-9_-]*', str),
+}
+
+_PLACEHOLDER = re.compile(r'\{(\w+)(?::(\w+))?\}')
+
+
+class _Route:
+    def __init__(self, pattern, handler, guard, prefix, regex, converters, expand=None):
+        self.pattern = pattern
+        self.handler = handler
+        self.guard = guard
+        self.prefix = prefix
+        self.regex = regex
+        self.converters = converters
+        # Преобразование разобранных аргументов в именованные (для компактных маршрутов)
+        self.expand = expand
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+
+class CallbackRouter:
+    """
+    Роутер callback_data -> обработчик.
+
+    Обработчик вызывается как handler(bot, call, **args). Необязательный guard
+    с той же сигнатурой проверяет права до вызова: если он вернул False,
+    обработчик не вызывается (ответ пользователю — забота guard).
+    """
+
+    def __init__(self):
+        self.converters = dict(CONVERTERS)
+        self._static = {}
+        self._prefixed = {}
+        self._routes = []
+        self._lock = threading.Lock()
+
+    def add_converter(self, name, regex, func):
+        """Зарегистрировать тип аргумента: func получает совпавшую строку и возвращает значение или бросает ValueError."""
+        self.converters[name] = (regex, func)
+
+    def add(self, pattern, handler, guard=None, expand=None):
+        """Зарегистрировать маршрут."""
+        first = _PLACEHOLDER.search(pattern)
+        if not first:
+            if pattern in self._static:
+                raise ValueError(f"Маршрут '{pattern}' уже зарегистрирован")
+            route = _Route(pattern, handler, guard, pattern, None, {}, expand)
+            self._static[pattern] = route
+            self._routes.append(route)
+            return route
+
+        prefix = pattern[:first.start()]
+        if not prefix.endswith('_'):
+            raise ValueError(f"Префикс маршрута '{pattern}' должен заканчиваться на '_'")
+
+        regex_parts = []
+        converters = {}
+        position = first.start()
+        for placeholder in _PLACEHOLDER.finditer(pattern, first.start()):
+            name, kind = placeholder.group(1), placeholder.group(2) or 'str'
+            if kind not in self.converters:
+                raise ValueError(f"Неизвестный тип аргумента '{kind}' в маршруте '{pattern}'")
+            regex_parts.append(re.escape(pattern[position:placeholder.start()]))
+            regex_parts.append(f"(?P<{name}>{self.converters[kind][0]})")
+            converters[name] = self.converters[kind][1]
+            position = placeholder.end()
+        regex_parts.append(re.escape(pattern[position:]))
+
+        route = _Route(pattern, handler, guard, prefix, re.compile(''.join(regex_parts)), converters, expand)
+        self._prefixed.setdefault(prefix, []).append(route)
+        self._routes.append(route)
+        return route
+
+    def add_packed(self, tag, fields, handler, guard=None):
+        """Маршрут для callback_codec.packed(tag, ...): целые аргументы по порядку fields."""
+        fields = tuple(fields)
+
+        def expand(args):
+            values = args['values']
+            if len(values) != len(fields):
+                raise ValueError(f"Ожидалось {len(fields)} аргументов, получено {len(values)}")
+            return dict(zip(fields, values))
+
+        return self.add(f"{tag}_{{values:packed}}", handler, guard, expand)
+
+    def add_token(self, tag, handler, guard=None, inline=None):
+        """
+        Маршрут для callback_codec.tokenized(tag, **payload): аргументы — поля нагрузки.
+
+        inline=(строковые поля, целые поля) объявляет inline-формат тега: такие
+        кнопки кодируются без записи в callback_tokens.
+        """
+        if inline is not None:
+            register_inline(tag, *inline)
+            self.add(f"{tag}_{{raw:inline}}", handler, guard, lambda args: decode_inline(tag, args['raw']))
+        return self.add(f"{tag}_{{payload:token}}", handler, guard, lambda args: args['payload'])
+
+    def route(self, pattern, guard=None):
+        """Декоратор для add()."""
+        def decorator(handler):
+            self.add(pattern, handler, guard)
+            return handler
+        return decorator
+
+    def match(self, data):
+        """
+        Найти маршрут для callback_data.
+
+        Returns:
+            tuple: (route, args) или (None, None), если маршрут не найден
+
+        Raises:
+            ValueError: Маршрут найден, но аргументы не удалось преобразовать
+        """
+        route = self._static.get(data)
+        if route is not None:
+            return route, {}
+
+        end = len(data)
+        while True:
+            end = data.rfind('_', 0, end)
+            if end < 0:
+                return None, None
+            for route in self._prefixed.get(data[:end + 1], ()):
+                found = route.regex.fullmatch(data, end + 1)
+                if found:
+                    args = {name: route.converters[name](value) for name, value in found.groupdict().items()}
+                    return route, route.expand(args) if route.expand else args
+
+    def dispatch(self, bot, call):
+        """
+        Обработать callback-запрос.
+
+        Returns:
+            bool: False, если маршрут не найден или его аргументы некорректны
+        """
+        try:
+            route, args = self.match(call.data or '')
+        except (ValueError, TypeError):
+            return False
+        if route is None:
+            return False
+
+        started = time.perf_counter()
+        try:
+            if route.guard is None or route.guard(bot, call, **args):
+                route.handler(bot, call, **args)
+        except Exception:
+            with self._lock:
+                route.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                route.calls += 1
+                route.total_time += elapsed
+                route.max_time = max(route.max_time, elapsed)
+        return True
+
+    def metrics(self):
+        """Метрики маршрутов: число вызовов, ошибок, среднее и максимальное время (сек)."""
+        with self._lock:
+            return [
+                {
+                    'pattern': route.pattern,
+                    'calls': route.calls,
+                    'errors': route.errors,
+                    'avg_time': route.total_time / route.calls if route.calls else 0.0,
+                    'max_time': route.max_time,
+                }
+                for route in self._routes
+            ]
@@ -0,0 +1,96 @@
+"""
+Выгрузка таблицы БД администратору файлом (CSV или JSONL, по желанию .gz).
+
+Строки читаются курсором порциями (db_manager.iter_table_rows) и сразу
+пишутся во временный файл, поэтому память не зависит от размера таблицы.
+Выгрузка идёт в отдельном потоке, чтобы не занимать очередь апдейтов чата.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import traceback
+from db_manager import get_table_meta, iter_table_rows
+from bot_handlers.common import send
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+# Ограничение Telegram на размер документа, отправляемого ботом
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+
+def _csv_lines(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+        # Одна строка в буфере за раз
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _jsonl_lines(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + '\n'
+
+
+def export_lines(table_name, fmt):
+    """
+    Генератор строк выгрузки таблицы в формате fmt ('csv' или 'jsonl').
+
+    Raises:
+        ValueError: Неизвестный формат или таблица
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    meta = get_table_meta(table_name)
+    if meta is None:
+        raise ValueError(f"Таблица '{table_name}' не найдена")
+    rows = iter_table_rows(table_name)
+    if fmt == 'csv':
+        return _csv_lines(meta['columns'], rows)
+    return _jsonl_lines(meta['columns'], rows)
+
+
+def write_export(path, table_name, fmt, compress=False):
+    """Записать выгрузку в файл path (gzip, если compress)."""
+    opener = gzip.open if compress else open
+    with opener(path, 'wt', encoding='utf-8', newline='') as file:
+        file.writelines(export_lines(table_name, fmt))
+
+
+def export_table(bot, chat_id, table_name, fmt, compress=False):
+    """Выгрузить таблицу и отправить файл в chat_id."""
+    filename = f"{table_name}.{fmt}" + ('.gz' if compress else '')
+    with tempfile.TemporaryDirectory(prefix='export-') as directory:
+        # Имя файла во временном каталоге — то, что увидит администратор в Telegram
+        path = os.path.join(directory, filename)
+        write_export(path, table_name, fmt, compress)
+        size = os.path.getsize(path)
+        if size > MAX_DOCUMENT_SIZE:
+            send(bot, chat_id, f"❌ Файл {filename} занимает {size // (1024 * 1024)} МБ — больше лимита Telegram. Попробуйте сжатую выгрузку.")
+            return
+        with open(path, 'rb') as document:
+            bot.send_document(chat_id, document, caption=f"📤 Таблица {table_name}")
+
+
+def start_table_export(bot, chat_id, table_name, fmt, compress=False):
+    """Запустить export_table в фоновом потоке; ошибки сообщаются в chat_id."""
+    def target():
+        try:
+            export_table(bot, chat_id, table_name, fmt, compress)
+        except Exception as e:
+            traceback.print_exc()
+            try:
+                send(bot, chat_id, f"❌ Ошибка выгрузки таблицы {table_name}: {e}")
+            except Exception:
+                traceback.print_exc()
+
+    thread = threading.Thread(target=target, name=f"export-{table_name}", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,175 @@
+"""
+Фоновое обновление профилей пользователей (username, имя, фамилия) из Telegram.
+
+Запросы get_chat_member идут из пула потоков через общий с исходящими
+сообщениями token bucket, результаты порции записываются одной транзакцией
+вместе с курсором (последний обработанный tg_id) в background_jobs. После
+перезапуска задача продолжается с курсора. Пользователи, заблокировавшие бота
+или удалённые, помечаются users.is_reachable = 0 и при следующих обновлениях
+пропускаются; флаг снимается любым следующим апдейтом от пользователя
+и ставится по my_chat_member при блокировке бота (common.note_user_activity).
+"""
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import telebot
+from telebot import types
+from db_manager import get_job, start_job, update_job, get_user_ids_after, count_users, apply_user_refresh
+from bot_handlers.common import edit_message
+from bot_handlers.outbound import get_outbound_queue, get_retry_after
+
+JOB_NAME = 'user_refresh'
+REFRESH_WORKERS = 8
+REFRESH_BATCH_SIZE = 200
+REFRESH_MAX_ATTEMPTS = 3
+PROGRESS_INTERVAL = 3.0
+
+# Ответы 400, означающие, что пользователь недоступен боту (а не ошибку запроса)
+UNREACHABLE_MARKERS = ('not found', 'is not a member', 'PARTICIPANT_ID_INVALID', 'chat not found')
+
+
+def is_unreachable_error(error):
+    if not isinstance(error, telebot.apihelper.ApiTelegramException):
+        return False
+    if error.error_code == 403:
+        return True
+    return error.error_code == 400 and any(marker in str(error) for marker in UNREACHABLE_MARKERS)
+
+
+class UserRefreshJob:
+    """Один проход обновления; состояние хранится в background_jobs под именем JOB_NAME."""
+
+    def __init__(self, bot, workers=REFRESH_WORKERS, batch_size=REFRESH_BATCH_SIZE):
+        self.bot = bot
+        self.workers = workers
+        self.batch_size = batch_size
+        self.bucket = get_outbound_queue(bot).bucket
+        self._last_report = 0.0
+
+    def _fetch(self, tg_id):
+        """Вернуть ('ok', профиль), ('unreachable', tg_id) или ('failed', tg_id)."""
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                user = self.bot.get_chat_member(tg_id, tg_id).user
+                return 'ok', (user.username, user.first_name, user.last_name, tg_id)
+            except Exception as e:
+                retry_after = get_retry_after(e)
+                if retry_after is not None:
+                    # Flood wait не считается попыткой: ждут все потоки
+                    self.bucket.block_for(retry_after)
+                    continue
+                if is_unreachable_error(e):
+                    return 'unreachable', tg_id
+                attempt += 1
+                if attempt >= REFRESH_MAX_ATTEMPTS:
+                    return 'failed', tg_id
+                time.sleep(2 ** attempt)
+
+    def run(self):
+        job = get_job(JOB_NAME)
+        if not job or job['status'] != 'running':
+            return
+        self._report(job, force=True)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='user-refresh') as pool:
+            while True:
+                tg_ids = get_user_ids_after(job['cursor'], self.batch_size)
+                if not tg_ids:
+                    break
+                profiles, unreachable = [], []
+                for status, value in pool.map(self._fetch, tg_ids):
+                    if status == 'ok':
+                        profiles.append(value)
+                    elif status == 'unreachable':
+                        unreachable.append(value)
+                    else:
+                        job['failed'] += 1
+                job['cursor'] = tg_ids[-1]
+                job['processed'] += len(tg_ids)
+                job['updated'] += len(profiles)
+                job['unreachable'] += len(unreachable)
+                apply_user_refresh(
+                    profiles, unreachable, JOB_NAME,
+                    cursor=job['cursor'], processed=job['processed'], updated=job['updated'],
+                    unreachable=job['unreachable'], failed=job['failed']
+                )
+                self._report(job)
+
+        job['status'] = 'done'
+        update_job(JOB_NAME, status='done')
+        self._report(job, force=True)
+
+    def _report(self, job, force=False):
+        """Обновить сообщение с прогрессом у администратора (не чаще PROGRESS_INTERVAL)."""
+        if not job.get('chat_id') or not job.get('message_id'):
+            return
+        now = time.monotonic()
+        if not force and now - self._last_report < PROGRESS_INTERVAL:
+            return
+        self._last_report = now
+
+        total = max(job['total'], job['processed'])
+        percent = job['processed'] * 100 // total if total else 100
+        title = "✅ <b>Обновление пользователей завершено</b>" if job['status'] == 'done' else "🔄 <b>Обновление пользователей...</b>"
+        text = (
+            f"{title}\n\n"
+            f"Обработано: <b>{job['processed']}</b> из {total} ({percent}%)\n"
+            f"Обновлено: {job['updated']}\n"
+            f"Недоступны (заблокировали бота/удалены): {job['unreachable']}\n"
+            f"Ошибки: {job['failed']}"
+        )
+        markup = None
+        if job['status'] == 'done':
+            markup = types.InlineKeyboardMarkup()
+            markup.add(types.InlineKeyboardButton("⬅️ Назад в Админ-панель", callback_data='admin_menu'))
+        try:
+            edit_message(self.bot, text, job['chat_id'], job['message_id'], reply_markup=markup, parse_mode='HTML')
+        except Exception:
+            traceback.print_exc()
+
+
+_job_thread = None
+_job_lock = threading.Lock()
+
+
+def _spawn(bot):
+    global _job_thread
+
+    def target():
+        try:
+            UserRefreshJob(bot).run()
+        except Exception:
+            traceback.print_exc()
+
+    _job_thread = threading.Thread(target=target, name="user-refresh-job", daemon=True)
+    _job_thread.start()
+
+
+def start_user_refresh(bot, chat_id, message_id):
+    """
+    Запустить обновление (или продолжить прерванное) с прогрессом в сообщении message_id.
+
+    Returns:
+        bool: False, если обновление уже выполняется
+    """
+    with _job_lock:
+        if _job_thread is not None and _job_thread.is_alive():
+            return False
+        job = get_job(JOB_NAME)
+        if job and job['status'] == 'running':
+            update_job(JOB_NAME, chat_id=chat_id, message_id=message_id)
+        else:
+            start_job(JOB_NAME, count_users(), chat_id, message_id)
+        _spawn(bot)
+    return True
+
+
+def resume_user_refresh(bot):
+    """Продолжить прерванное перезапуском обновление (вызывается при старте бота)."""
+    with _job_lock:
+        job = get_job(JOB_NAME)
+        if job and job['status'] == 'running' and (_job_thread is None or not _job_thread.is_alive()):
+            _spawn(bot)
@@ -1,13 +1,79 @@
 import sqlite3
 import os
+import re
 import json
+import threading
+import time
+import atexit
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple
 
 DB_NAME = os.getenv('DB_NAME', 'secret_santa.db') 
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
+# Пул соединений: одно долгоживущее соединение на поток (telebot обрабатывает
+# апдейты в нескольких потоках, а sqlite3-соединение нельзя делить между ними).
+_local = threading.local()
+_all_connections = []
+_pool_lock = threading.Lock()
+
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+)
+
+def _open_connection(db_name):
+    conn = sqlite3.connect(db_name, timeout=5, check_same_thread=False)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def get_connection():
+    """
+    Получить соединение текущего потока.
+    Соединение открывается один раз (WAL + настроенные PRAGMA) и переиспользуется.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'db_name', None) != DB_NAME:
+        if conn is not None:
+            _close_connection(conn)
+        conn = _open_connection(DB_NAME)
+        _local.conn = conn
+        _local.db_name = DB_NAME
+        with _pool_lock:
+            _all_connections.append(conn)
+    return conn
+
+def _close_connection(conn):
+    with _pool_lock:
+        if conn in _all_connections:
+            _all_connections.remove(conn)
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+def close_all_connections():
+    """Закрыть все соединения пула (при остановке бота)."""
+    with _pool_lock:
+        connections = list(_all_connections)
+        _all_connections.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    _local.__dict__.clear()
+
+atexit.register(close_all_connections)
+
+# --- МИГРАЦИИ СХЕМЫ ---
+# Версия схемы хранится в PRAGMA user_version. Миграция N переводит БД из версии N-1 в N;
+# каждая применяется один раз в собственной транзакции. Новые миграции добавляются только в конец.
+
+def _migration_base_schema(cursor):
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY,
@@ -53,71 +119,1186 @@ def init_db():
             UNIQUE(recipient_tg_id, game_id)
         )
     """)
+
+def _migration_game_participants(cursor):
+    """Таблица участников игр с переносом данных из устаревшего games.participants_json."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS game_participants (
+            id INTEGER PRIMARY KEY,
+            game_id INTEGER NOT NULL,
+            tg_id INTEGER NOT NULL,
+            UNIQUE(game_id, tg_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_game_participants_tg_id ON game_participants(tg_id)")
+    
+    games = cursor.execute("SELECT id, participants_json FROM games").fetchall()
+    rows = []
+    for game_id, participants_json in games:
+        try:
+            participants = json.loads(participants_json or '[]')
+        except ValueError:
+            participants = []
+        rows.extend((game_id, tg_id) for tg_id in participants)
+    cursor.executemany("INSERT OR IGNORE INTO game_participants (game_id, tg_id) VALUES (?, ?)", rows)
+
+def _migration_secondary_indexes(cursor):
+    """Индексы для панелей организатора, выбора игр в статусе 'setup' и выборок пар/пожеланий по игре."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_games_organizer_id ON games(organizer_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_games_status ON games(status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pairs_game_id ON pairs(game_id, is_admin_pair)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_wishes_game_id ON wishes(game_id)")
+
+def _migration_game_exclusions(cursor):
+    """Запреты пар: участники tg_id_a и tg_id_b не дарят друг другу (хранится с tg_id_a < tg_id_b)."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS game_exclusions (
+            id INTEGER PRIMARY KEY,
+            game_id INTEGER NOT NULL,
+            tg_id_a INTEGER NOT NULL,
+            tg_id_b INTEGER NOT NULL,
+            UNIQUE(game_id, tg_id_a, tg_id_b)
+        )
+    """)
+
+def _migration_outbox(cursor):
+    """Персистентный outbox исходящих сообщений и рассылки (batch), к которым они относятся."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS outbox_batches (
+            id INTEGER PRIMARY KEY,
+            batch_key TEXT,
+            notify_chat_id INTEGER,
+            title TEXT,
+            created_at REAL NOT NULL,
+            reported INTEGER DEFAULT 0
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_batches_key ON outbox_batches(batch_key)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            batch_id INTEGER,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            sent_at REAL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(status, next_attempt_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_batch_id ON outbox(batch_id, status)")
+
+def _migration_user_states(cursor):
+    """Состояния диалогов пользователей (создание игры, ввод пожеланий и т.п.) с истечением срока."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_states (
+            tg_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            context_json TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_states_expires_at ON user_states(expires_at)")
+
+def _migration_callback_tokens(cursor):
+    """Серверная таблица токенов для callback_data, не помещающихся в 64 байта."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS callback_tokens (
+            token TEXT PRIMARY KEY,
+            payload_json TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_callback_tokens_created_at ON callback_tokens(created_at)")
+
+def _migration_user_refresh(cursor):
+    """Флаг доступности пользователя и состояние фоновых задач (курсор для возобновления)."""
+    cursor.execute("ALTER TABLE users ADD COLUMN is_reachable INTEGER DEFAULT 1")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS background_jobs (
+            name TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            cursor INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            processed INTEGER DEFAULT 0,
+            updated INTEGER DEFAULT 0,
+            unreachable INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            chat_id INTEGER,
+            message_id INTEGER,
+            started_at REAL,
+            updated_at REAL
+        )
+    """)
+
+def _migration_username_nocase_index(cursor):
+    """Индекс для поиска пользователей по username без учёта регистра (импорт участников)."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE)")
+
+# Полнотекстовый индекс (FTS5, внешнее содержимое): строки хранятся только в
+# users/wishes, триггеры повторяют каждое изменение в индексе.
+FTS_TABLES = ('users_fts', 'wishes_fts')
+
+def _migration_fts_search(cursor):
+    """FTS5-индексы users (username, имя, фамилия) и wishes.text для поиска в админ-панели."""
+    options = {row[0] for row in cursor.execute("PRAGMA compile_options")}
+    if 'ENABLE_FTS5' not in options:
+        # SQLite без FTS5: поиск работает через LIKE (см. search_users/search_wishes)
+        return
+    
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            username, first_name, last_name,
+            content='users', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, username, first_name, last_name)
+            VALUES (new.id, new.username, new.first_name, new.last_name);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username, first_name, last_name)
+            VALUES ('delete', old.id, old.username, old.first_name, old.last_name);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF id, username, first_name, last_name ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username, first_name, last_name)
+            VALUES ('delete', old.id, old.username, old.first_name, old.last_name);
+            INSERT INTO users_fts (rowid, username, first_name, last_name)
+            VALUES (new.id, new.username, new.first_name, new.last_name);
+        END
+    """)
+    
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS wishes_fts USING fts5(
+            text,
+            content='wishes', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS wishes_fts_insert AFTER INSERT ON wishes BEGIN
+            INSERT INTO wishes_fts (rowid, text) VALUES (new.id, new.text);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS wishes_fts_delete AFTER DELETE ON wishes BEGIN
+            INSERT INTO wishes_fts (wishes_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS wishes_fts_update AFTER UPDATE OF id, text ON wishes BEGIN
+            INSERT INTO wishes_fts (wishes_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO wishes_fts (rowid, text) VALUES (new.id, new.text);
+        END
+    """)
+    
+    cursor.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO wishes_fts (wishes_fts) VALUES ('rebuild')")
+
+def _migration_drop_participants_json(cursor):
+    """Удалить games.participants_json: после переноса в game_participants колонка не обновляется."""
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        cursor.execute("ALTER TABLE games DROP COLUMN participants_json")
+        return
+    
+    # SQLite без DROP COLUMN: пересоздать таблицу без колонки
+    cursor.execute("""
+        CREATE TABLE games_new (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            budget REAL,
+            organizer_id INTEGER,
+            status TEXT DEFAULT 'setup',
+            invite_code TEXT UNIQUE,
+            currency TEXT DEFAULT 'RUB'
+        )
+    """)
+    cursor.execute("""
+        INSERT INTO games_new (id, name, budget, organizer_id, status, invite_code, currency)
+        SELECT id, name, budget, organizer_id, status, invite_code, currency FROM games
+    """)
+    cursor.execute("DROP TABLE games")
+    cursor.execute("ALTER TABLE games_new RENAME TO games")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_games_organizer_id ON games(organizer_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_games_status ON games(status)")
+
+def _migration_outbox_sudo(cursor):
+    """Администратор /sudo для сообщений outbox, адресованных цели sudo (перенаправление переживает перезапуск)."""
+    cursor.execute("ALTER TABLE outbox ADD COLUMN sudo_admin INTEGER")
+
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_game_participants,
+    _migration_secondary_indexes,
+    _migration_game_exclusions,
+    _migration_outbox,
+    _migration_user_states,
+    _migration_callback_tokens,
+    _migration_user_refresh,
+    _migration_username_nocase_index,
+    _migration_fts_search,
+    _migration_drop_participants_json,
+    _migration_outbox_sudo,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def get_schema_version():
+    return get_connection().execute("PRAGMA user_version").fetchone()[0]
+
+def init_db():
+    """
+    Привести схему БД к актуальной версии.
+    Если версия уже актуальна, никакой DDL не выполняется.
+    
+    Raises:
+        RuntimeError: Если БД создана более новой версией бота
+    """
+    conn = get_connection()
+    version = get_schema_version()
+    
+    if version == SCHEMA_VERSION:
+        return
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Версия схемы БД ({version}) новее поддерживаемой ботом ({SCHEMA_VERSION})")
+    
+    if conn.in_transaction:
+        conn.rollback()
+    
+    for target_version in range(version + 1, SCHEMA_VERSION + 1):
+        migration = MIGRATIONS[target_version - 1]
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Другой процесс мог применить миграцию, пока мы ждали блокировку
+            if cursor.execute("PRAGMA user_version").fetchone()[0] >= target_version:
+                conn.rollback()
+                continue
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {target_version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+    invalidate_table_meta()
+
+def _in_transaction():
+    return getattr(_local, 'tx_depth', 0) > 0
+
+@contextmanager
+def transaction():
+    """
+    Выполнить группу запросов одной атомарной транзакцией.
     
-    conn.commit()
-    conn.close()
+    Внутри блока db_execute/db_executemany не коммитят сами (commit=True игнорируется),
+    всё фиксируется одним COMMIT при выходе или откатывается при исключении.
+    Вложенные блоки оформляются как SAVEPOINT.
+    
+    Пример:
+        with transaction():
+            db_execute("DELETE FROM pairs WHERE game_id = ?", (game_id,))
+            db_executemany("INSERT INTO pairs (...) VALUES (?, ?, ?)", rows)
+    """
+    conn = get_connection()
+    depth = getattr(_local, 'tx_depth', 0)
+    savepoint = f"sp_{depth}"
+    
+    if depth == 0:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute("BEGIN IMMEDIATE")
+    else:
+        conn.execute(f"SAVEPOINT {savepoint}")
+    
+    _local.tx_depth = depth + 1
+    try:
+        yield conn
+    except BaseException:
+        _local.tx_depth = depth
+        if depth == 0:
+            conn.rollback()
+        else:
+            conn.execute(f"ROLLBACK TO {savepoint}")
+            conn.execute(f"RELEASE {savepoint}")
+        raise
+    else:
+        _local.tx_depth = depth
+        if depth == 0:
+            conn.commit()
+        else:
+            conn.execute(f"RELEASE {savepoint}")
 
 def db_execute(query, params=(), fetch_one=False, fetch_all=False, commit=False):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
+    in_transaction = _in_transaction()
     cursor = conn.cursor()
     try:
         cursor.execute(query, params)
-        if commit:
+        if commit and not in_transaction:
             conn.commit()
         if fetch_one:
             return cursor.fetchone()
         elif fetch_all:
             return cursor.fetchall()
+    except Exception:
+        if not in_transaction and conn.in_transaction:
+            conn.rollback()
+        raise
     finally:
-        conn.close()
+        cursor.close()
+        # Раньше незакоммиченные изменения отбрасывались при закрытии соединения;
+        # соединение теперь живёт дольше запроса, поэтому откатываем явно.
+        if not commit and not in_transaction and conn.in_transaction:
+            conn.rollback()
 
-def get_table_data(table_name, page_num=0, page_size=10):
-    conn = sqlite3.connect(DB_NAME)
+def db_executemany(query, params_seq, commit=False):
+    """
+    Выполнить запрос для каждого набора параметров одним вызовом executemany.
+    
+    Returns:
+        int: Число затронутых строк
+    """
+    conn = get_connection()
+    in_transaction = _in_transaction()
     cursor = conn.cursor()
+    try:
+        cursor.executemany(query, params_seq)
+        if commit and not in_transaction:
+            conn.commit()
+        return cursor.rowcount
+    except Exception:
+        if not in_transaction and conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        if not commit and not in_transaction and conn.in_transaction:
+            conn.rollback()
+
+# --- ПРОСМОТР ТАБЛИЦ (АДМИН-ПАНЕЛЬ) ---
+# Схема таблиц (колонки и ключ) кэшируется до следующей миграции, число строк —
+# приблизительное: считается COUNT(*) не чаще раза в ROW_COUNT_TTL секунд и
+# поправляется через adjust_table_row_count при изменениях из админ-панели.
+# Страницы листаются по ключу (keyset): WHERE key > ? ORDER BY key LIMIT ?,
+# поэтому последняя страница большой таблицы читается так же быстро, как первая.
+ROW_COUNT_TTL = 300
+
+_table_meta = {}
+_row_counts = {}
+_table_cache_lock = threading.Lock()
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def get_table_meta(table_name):
+    """
+    Колонки и ключ таблицы: единственная колонка PRIMARY KEY, иначе rowid.
     
-    count = cursor.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+    Returns:
+        dict: {'columns': [...], 'key': имя ключа, 'key_sql': ключ для подстановки в SQL}
+            или None, если таблицы нет
+    """
+    with _table_cache_lock:
+        meta = _table_meta.get(table_name)
+    if meta is not None:
+        return meta
+    
+    exists = db_execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,), fetch_one=True
+    )
+    if not exists:
+        return None
+    info = db_execute(f"PRAGMA table_info({quote_identifier(table_name)})", fetch_all=True)
+    pk_columns = [row[1] for row in sorted(info, key=lambda row: row[5]) if row[5]]
+    key = pk_columns[0] if len(pk_columns) == 1 else 'rowid'
+    meta = {
+        'columns': [row[1] for row in info],
+        'key': key,
+        'key_sql': key if key == 'rowid' else quote_identifier(key),
+    }
+    with _table_cache_lock:
+        _table_meta[table_name] = meta
+    return meta
+
+def invalidate_table_meta():
+    """Сбросить кэш схемы и числа строк (после миграций)."""
+    with _table_cache_lock:
+        _table_meta.clear()
+        _row_counts.clear()
+
+def get_table_row_count(table_name):
+    """Приблизительное число строк таблицы."""
+    now = time.monotonic()
+    with _table_cache_lock:
+        cached = _row_counts.get(table_name)
+    if cached is not None and now - cached[1] < ROW_COUNT_TTL:
+        return cached[0]
+    count = db_execute(f"SELECT COUNT(*) FROM {quote_identifier(table_name)}", fetch_one=True)[0]
+    with _table_cache_lock:
+        _row_counts[table_name] = (count, now)
+    return count
+
+def adjust_table_row_count(table_name, delta):
+    """Поправить закэшированное число строк без пересчёта (delta — число добавленных/удалённых строк)."""
+    with _table_cache_lock:
+        cached = _row_counts.get(table_name)
+        if cached is not None:
+            _row_counts[table_name] = (max(cached[0] + delta, 0), cached[1])
+
+def get_table_page(table_name, after=None, before=None, page_size=10):
+    """
+    Страница таблицы по ключу: строки с ключом больше after (или меньше before — шаг назад).
+    Без курсоров — первая страница.
     
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    columns = [row[1] for row in cursor.fetchall()]
+    Returns:
+        tuple: (columns, [(key, row), ...], has_prev, has_next) или None, если таблицы нет
+    """
+    meta = get_table_meta(table_name)
+    if meta is None:
+        return None
+    table = quote_identifier(table_name)
+    key = meta['key_sql']
     
-    offset = page_num * page_size
-    data = cursor.execute(f"SELECT * FROM {table_name} LIMIT {page_size} OFFSET {offset}").fetchall()
+    if before is not None:
+        rows = db_execute(
+            f"SELECT {key}, * FROM {table} WHERE {key} < ? ORDER BY {key} DESC LIMIT ?",
+            (before, page_size + 1), fetch_all=True
+        )
+        has_prev, has_next = len(rows) > page_size, True
+        rows = rows[:page_size][::-1]
+    else:
+        if after is not None:
+            rows = db_execute(
+                f"SELECT {key}, * FROM {table} WHERE {key} > ? ORDER BY {key} LIMIT ?",
+                (after, page_size + 1), fetch_all=True
+            )
+        else:
+            rows = db_execute(f"SELECT {key}, * FROM {table} ORDER BY {key} LIMIT ?", (page_size + 1,), fetch_all=True)
+        has_prev, has_next = after is not None, len(rows) > page_size
+        rows = rows[:page_size]
     
-    conn.close()
-    return columns, data, count
+    return meta['columns'], [(row[0], row[1:]) for row in rows], has_prev, has_next
 
 def get_single_record(table_name, record_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    """
+    Запись таблицы по значению ключа (см. get_table_meta).
     
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    columns = [row[1] for row in cursor.fetchall()]
+    Returns:
+        tuple: (columns, record); record равен None, если записи или таблицы нет
+    """
+    meta = get_table_meta(table_name)
+    if meta is None:
+        return [], None
+    record = db_execute(
+        f"SELECT * FROM {quote_identifier(table_name)} WHERE {meta['key_sql']} = ?", (record_id,), fetch_one=True
+    )
+    return meta['columns'], record
+
+def get_browsable_tables():
+    """Таблицы для просмотра в админ-панели: без служебных sqlite_* и таблиц FTS-индексов."""
+    rows = db_execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'",
+        fetch_all=True
+    )
+    return [name for (name,) in rows if not name.startswith(FTS_TABLES)]
+
+def iter_table_rows(table_name, batch_size=1000):
+    """
+    Все строки таблицы по порядку ключа, порциями fetchmany(batch_size).
     
-    record = cursor.execute(f"SELECT * FROM {table_name} WHERE {columns[0]} = ?", (record_id,)).fetchone()
+    Читает через отдельное соединение: курсор держит снимок БД (WAL) всё время
+    обхода и не мешает транзакциям соединения текущего потока. Соединение
+    закрывается, когда генератор исчерпан или закрыт.
     
-    conn.close()
-    return columns, record
+    Raises:
+        ValueError: Таблицы нет
+    """
+    meta = get_table_meta(table_name)
+    if meta is None:
+        raise ValueError(f"Таблица '{table_name}' не найдена")
+    conn = _open_connection(DB_NAME)
+    try:
+        cursor = conn.execute(f"SELECT * FROM {quote_identifier(table_name)} ORDER BY {meta['key_sql']}")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+# --- КЭШ ПРОФИЛЕЙ ПОЛЬЗОВАТЕЛЕЙ ---
+# Ограниченный LRU-кэш строк users по tg_id. Кэшируются только найденные
+# пользователи; любые изменения users должны вызывать invalidate_user_cache.
+USER_CACHE_SIZE = 5000
+SQL_IN_CHUNK = 500
+
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+
+# Колонки выбираются по имени: порядок не зависит от того, в каком порядке миграции добавляли их в users
+UserInfo = namedtuple('UserInfo', ('id', 'tg_id', 'username', 'first_name', 'last_name', 'role', 'is_reachable'))
+_USER_SELECT = f"SELECT {', '.join(UserInfo._fields)} FROM users"
+
+def _cache_users(rows):
+    with _user_cache_lock:
+        for row in rows:
+            _user_cache[row[1]] = row
+            _user_cache.move_to_end(row[1])
+        while len(_user_cache) > USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+
+def invalidate_user_cache(tg_id=None):
+    """Сбросить кэш профиля пользователя (или весь кэш, если tg_id не указан)."""
+    with _user_cache_lock:
+        if tg_id is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(tg_id, None)
 
 def get_user_info(tg_id):
-    return db_execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,), fetch_one=True)
+    with _user_cache_lock:
+        user = _user_cache.get(tg_id)
+        if user is not None:
+            _user_cache.move_to_end(tg_id)
+            return user
+    row = db_execute(f"{_USER_SELECT} WHERE tg_id = ?", (tg_id,), fetch_one=True)
+    if not row:
+        return None
+    user = UserInfo(*row)
+    _cache_users([user])
+    return user
+
+def get_users_info(tg_ids):
+    """
+    Получить профили сразу для списка пользователей: из кэша и одним запросом
+    WHERE tg_id IN (...) на каждые SQL_IN_CHUNK недостающих.
+    
+    Returns:
+        dict: tg_id -> строка users (ненайденные пользователи отсутствуют)
+    """
+    result = {}
+    missing = []
+    with _user_cache_lock:
+        for tg_id in dict.fromkeys(tg_ids):
+            user = _user_cache.get(tg_id)
+            if user is not None:
+                _user_cache.move_to_end(tg_id)
+                result[tg_id] = user
+            else:
+                missing.append(tg_id)
+    
+    for start in range(0, len(missing), SQL_IN_CHUNK):
+        chunk = missing[start:start + SQL_IN_CHUNK]
+        rows = [UserInfo(*row) for row in db_execute(
+            f"{_USER_SELECT} WHERE tg_id IN ({', '.join('?' * len(chunk))})",
+            chunk,
+            fetch_all=True
+        )]
+        _cache_users(rows)
+        for row in rows:
+            result[row[1]] = row
+    return result
+
+GameInfo = namedtuple('GameInfo', ('id', 'name', 'budget', 'organizer_id', 'participants_count', 'status', 'invite_code', 'currency'))
 
 def get_game_info(game_id):
-    return db_execute("SELECT id, name, budget, organizer_id, participants_json, status, invite_code, currency FROM games WHERE id = ?", (game_id,), fetch_one=True)
+    """
+    Получить игру (GameInfo) или None. participants_count считается по game_participants.
+    """
+    row = db_execute(
+        """SELECT id, name, budget, organizer_id,
+                  (SELECT COUNT(*) FROM game_participants WHERE game_id = games.id),
+                  status, invite_code, currency
+           FROM games WHERE id = ?""",
+        (game_id,),
+        fetch_one=True
+    )
+    return GameInfo(*row) if row else None
+
+def get_game_participants(game_id):
+    """Список tg_id участников игры в порядке присоединения."""
+    rows = db_execute(
+        "SELECT tg_id FROM game_participants WHERE game_id = ? ORDER BY id",
+        (game_id,),
+        fetch_all=True
+    )
+    return [row[0] for row in rows]
+
+def is_game_participant(game_id, tg_id):
+    return db_execute(
+        "SELECT 1 FROM game_participants WHERE game_id = ? AND tg_id = ?",
+        (game_id, tg_id),
+        fetch_one=True
+    ) is not None
+
+def get_user_games(tg_id, before_game_id=None, limit=20):
+    """
+    Игры пользователя (организатор или участник) одним запросом по индексам,
+    от новых к старым, с keyset-пагинацией по id игры.
+    
+    Args:
+        tg_id (int): Telegram ID пользователя
+        before_game_id (int): Вернуть только игры с id меньше этого (следующая страница)
+        limit (int): Размер страницы
+        
+    Returns:
+        tuple: (rows, has_more), где rows — список
+            (game_id, name, status, is_organizer, is_participant, wish_editable)
+    """
+    rows = db_execute(
+        """SELECT g.id, g.name, g.status,
+                  g.organizer_id = ? AS is_organizer,
+                  EXISTS(SELECT 1 FROM game_participants WHERE game_id = g.id AND tg_id = ?) AS is_participant
+           FROM games g
+           WHERE g.id IN (
+               SELECT id FROM games WHERE organizer_id = ?
+               UNION
+               SELECT game_id FROM game_participants WHERE tg_id = ?
+           )
+           AND g.id < ?
+           ORDER BY g.id DESC
+           LIMIT ?""",
+        (tg_id, tg_id, tg_id, tg_id, before_game_id if before_game_id is not None else 2 ** 63 - 1, limit + 1),
+        fetch_all=True
+    )
+    has_more = len(rows) > limit
+    games = [
+        (game_id, name, status, bool(is_organizer), bool(is_participant), bool(is_participant) and status != 'finished')
+        for game_id, name, status, is_organizer, is_participant in rows[:limit]
+    ]
+    return games, has_more
+
+def add_game_participant(game_id, tg_id):
+    """
+    Добавить участника в игру.
+    
+    Returns:
+        bool: True, если участник добавлен, False если уже был в игре
+    """
+    added = db_executemany(
+        "INSERT OR IGNORE INTO game_participants (game_id, tg_id) VALUES (?, ?)",
+        [(game_id, tg_id)],
+        commit=True
+    )
+    return added > 0
+
+def add_game_participants(game_id, tg_ids):
+    """
+    Добавить участников в игру одной транзакцией; уже участвующие пропускаются.
+    
+    Returns:
+        int: Число добавленных участников
+    """
+    with transaction():
+        return db_executemany(
+            "INSERT OR IGNORE INTO game_participants (game_id, tg_id) VALUES (?, ?)",
+            [(game_id, tg_id) for tg_id in tg_ids]
+        )
+
+def find_registered_tg_ids(tg_ids):
+    """Из списка tg_id — те, что есть в users (по SQL_IN_CHUNK за запрос)."""
+    found = set()
+    tg_ids = list(tg_ids)
+    for start in range(0, len(tg_ids), SQL_IN_CHUNK):
+        chunk = tg_ids[start:start + SQL_IN_CHUNK]
+        rows = db_execute(
+            f"SELECT tg_id FROM users WHERE tg_id IN ({', '.join('?' * len(chunk))})",
+            chunk,
+            fetch_all=True
+        )
+        found.update(row[0] for row in rows)
+    return found
+
+def find_tg_ids_by_usernames(usernames):
+    """
+    tg_id пользователей по username без учёта регистра (индекс idx_users_username_nocase).
+    
+    Returns:
+        dict: username в нижнем регистре -> tg_id (ненайденные отсутствуют)
+    """
+    found = {}
+    usernames = list(usernames)
+    for start in range(0, len(usernames), SQL_IN_CHUNK):
+        chunk = usernames[start:start + SQL_IN_CHUNK]
+        rows = db_execute(
+            f"SELECT username, tg_id FROM users WHERE username COLLATE NOCASE IN ({', '.join('?' * len(chunk))})",
+            chunk,
+            fetch_all=True
+        )
+        found.update((username.lower(), tg_id) for username, tg_id in rows)
+    return found
+
+def get_game_exclusions(game_id):
+    """Список запретов игры: пары (tg_id_a, tg_id_b), которые не дарят друг другу."""
+    return db_execute(
+        "SELECT tg_id_a, tg_id_b FROM game_exclusions WHERE game_id = ? ORDER BY id",
+        (game_id,),
+        fetch_all=True
+    ) or []
+
+def toggle_game_exclusion(game_id, tg_id_1, tg_id_2):
+    """
+    Добавить запрет пары, а если он уже есть — снять.
+    
+    Returns:
+        bool: True, если запрет добавлен, False если снят
+    """
+    tg_id_a, tg_id_b = sorted((tg_id_1, tg_id_2))
+    with transaction():
+        removed = db_executemany(
+            "DELETE FROM game_exclusions WHERE game_id = ? AND tg_id_a = ? AND tg_id_b = ?",
+            [(game_id, tg_id_a, tg_id_b)]
+        )
+        if removed:
+            return False
+        db_execute(
+            "INSERT INTO game_exclusions (game_id, tg_id_a, tg_id_b) VALUES (?, ?, ?)",
+            (game_id, tg_id_a, tg_id_b)
+        )
+    return True
+
+def delete_game(game_id):
+    """Удалить игру вместе с парами, пожеланиями и участниками одной транзакцией."""
+    with transaction():
+        db_execute("DELETE FROM pairs WHERE game_id = ?", (game_id,))
+        db_execute("DELETE FROM wishes WHERE game_id = ?", (game_id,))
+        db_execute("DELETE FROM game_participants WHERE game_id = ?", (game_id,))
+        db_execute("DELETE FROM game_exclusions WHERE game_id = ?", (game_id,))
+        db_execute("DELETE FROM games WHERE id = ?", (game_id,))
+
+# --- РЕЕСТР РОЛЕЙ ---
+# Множества tg_id администраторов и фантомов в памяти: проверки ролей на каждом
+# апдейте не ходят в БД. Загружается при старте (load_roles), дальше обновляется
+# сквозной записью через set_cached_role; после прямых правок users.role — load_roles().
+SPECIAL_ROLES = ('admin', 'fantom')
+
+_roles = None
+_roles_lock = threading.Lock()
+
+def load_roles():
+    """(Пере)загрузить реестр ролей из таблицы users."""
+    global _roles
+    rows = db_execute(
+        f"SELECT tg_id, role FROM users WHERE role IN ({', '.join('?' * len(SPECIAL_ROLES))})",
+        SPECIAL_ROLES,
+        fetch_all=True
+    )
+    roles = {role: set() for role in SPECIAL_ROLES}
+    for tg_id, role in rows:
+        roles[role].add(tg_id)
+    with _roles_lock:
+        _roles = {role: frozenset(ids) for role, ids in roles.items()}
+
+def set_cached_role(tg_id, role):
+    """Сквозная запись роли пользователя в реестр (role=None — пользователь удалён)."""
+    global _roles
+    if _roles is None:
+        load_roles()
+        return
+    with _roles_lock:
+        _roles = {
+            special_role: (ids | {tg_id}) if special_role == role else (ids - {tg_id})
+            for special_role, ids in _roles.items()
+        }
+
+def _has_role(tg_id, role):
+    roles = _roles
+    if roles is None:
+        load_roles()
+        roles = _roles
+    return tg_id in roles[role]
 
 def is_admin(tg_id):
-    user = get_user_info(tg_id)
-    return user and user[5] == 'admin'
+    return _has_role(tg_id, 'admin')
 
 def is_fantom(tg_id):
     """Проверить, имеет ли пользователь роль 'fantom'."""
-    user = get_user_info(tg_id)
-    return user and user[5] == 'fantom'
+    return _has_role(tg_id, 'fantom')
 
 # Добавлено для устранения ошибки импорта в main.py
 def get_game_id_by_code(invite_code):
     result = db_execute("SELECT id FROM games WHERE invite_code = ?", (invite_code,), fetch_one=True)
     return result[0] if result else None
 
+# --- СОСТОЯНИЯ ДИАЛОГОВ ---
+
+def load_user_state(tg_id):
+    """Состояние диалога из БД: (state, context, expires_at) или None."""
+    row = db_execute(
+        "SELECT state, context_json, expires_at FROM user_states WHERE tg_id = ?",
+        (tg_id,),
+        fetch_one=True
+    )
+    if not row:
+        return None
+    return row[0], json.loads(row[1]), row[2]
+
+def save_user_states(changes):
+    """
+    Записать изменения состояний одной транзакцией.
+    
+    Args:
+        changes (dict): tg_id -> (state, context, expires_at) или None для удаления
+    """
+    upserts = [
+        (tg_id, entry[0], json.dumps(entry[1], ensure_ascii=False), entry[2])
+        for tg_id, entry in changes.items() if entry is not None
+    ]
+    deletes = [(tg_id,) for tg_id, entry in changes.items() if entry is None]
+    with transaction() as conn:
+        if upserts:
+            conn.executemany(
+                """INSERT INTO user_states (tg_id, state, context_json, expires_at) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(tg_id) DO UPDATE SET
+                       state = excluded.state, context_json = excluded.context_json, expires_at = excluded.expires_at""",
+                upserts
+            )
+        if deletes:
+            conn.executemany("DELETE FROM user_states WHERE tg_id = ?", deletes)
+
+def purge_expired_user_states(now=None):
+    """Удалить истёкшие состояния. Возвращает число удалённых."""
+    with transaction() as conn:
+        return conn.execute(
+            "DELETE FROM user_states WHERE expires_at <= ?", (now if now is not None else time.time(),)
+        ).rowcount
+
+# --- ТОКЕНЫ CALLBACK_DATA ---
+
+def save_callback_token(token, payload_json):
+    db_execute(
+        """INSERT INTO callback_tokens (token, payload_json, created_at) VALUES (?, ?, ?)
+           ON CONFLICT(token) DO UPDATE SET created_at = excluded.created_at""",
+        (token, payload_json, time.time()),
+        commit=True
+    )
+
+def save_callback_tokens(tokens, created_at):
+    """Сохранить пары (token, payload_json) одним executemany в транзакции."""
+    with transaction():
+        db_executemany(
+            """INSERT INTO callback_tokens (token, payload_json, created_at) VALUES (?, ?, ?)
+               ON CONFLICT(token) DO UPDATE SET created_at = excluded.created_at""",
+            [(token, payload_json, created_at) for token, payload_json in tokens]
+        )
+
+def load_callback_token(token):
+    """(JSON полезной нагрузки, время последней записи) или None."""
+    return db_execute("SELECT payload_json, created_at FROM callback_tokens WHERE token = ?", (token,), fetch_one=True)
+
+def purge_callback_tokens(older_than):
+    """Удалить токены, созданные раньше older_than (unix time). Возвращает число удалённых."""
+    with transaction() as conn:
+        return conn.execute("DELETE FROM callback_tokens WHERE created_at < ?", (older_than,)).rowcount
+
+# --- ФОНОВЫЕ ЗАДАЧИ ---
+
+JOB_COLUMNS = ('status', 'cursor', 'total', 'processed', 'updated', 'unreachable', 'failed', 'chat_id', 'message_id', 'started_at', 'updated_at')
+
+def get_job(name):
+    """Состояние фоновой задачи (dict) или None."""
+    row = db_execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM background_jobs WHERE name = ?", (name,), fetch_one=True)
+    return dict(zip(JOB_COLUMNS, row)) if row else None
+
+def start_job(name, total, chat_id=None, message_id=None):
+    """Начать (или перезапустить с нуля) фоновую задачу."""
+    now = time.time()
+    db_execute(
+        """INSERT OR REPLACE INTO background_jobs
+               (name, status, cursor, total, processed, updated, unreachable, failed, chat_id, message_id, started_at, updated_at)
+           VALUES (?, 'running', 0, ?, 0, 0, 0, 0, ?, ?, ?, ?)""",
+        (name, total, chat_id, message_id, now, now),
+        commit=True
+    )
+
+def update_job(name, **fields):
+    """Обновить поля задачи (только из JOB_COLUMNS)."""
+    unknown = set(fields) - set(JOB_COLUMNS)
+    if unknown:
+        raise ValueError(f"Неизвестные поля задачи: {unknown}")
+    fields['updated_at'] = time.time()
+    assignments = ', '.join(f"{column} = ?" for column in fields)
+    db_execute(
+        f"UPDATE background_jobs SET {assignments} WHERE name = ?",
+        tuple(fields.values()) + (name,),
+        commit=True
+    )
+
+def get_user_ids_after(after_tg_id, limit, reachable_only=True):
+    """Следующая порция tg_id по возрастанию (keyset-курсор для фоновых проходов по пользователям)."""
+    query = "SELECT tg_id FROM users WHERE tg_id > ?"
+    if reachable_only:
+        query += " AND is_reachable = 1"
+    rows = db_execute(query + " ORDER BY tg_id LIMIT ?", (after_tg_id, limit), fetch_all=True)
+    return [row[0] for row in rows]
+
+def count_users(reachable_only=True):
+    query = "SELECT COUNT(*) FROM users"
+    if reachable_only:
+        query += " WHERE is_reachable = 1"
+    return db_execute(query, fetch_one=True)[0]
+
+def set_user_reachable(tg_id, reachable=True):
+    db_execute("UPDATE users SET is_reachable = ? WHERE tg_id = ?", (1 if reachable else 0, tg_id), commit=True)
+    invalidate_user_cache(tg_id)
+
+def apply_user_refresh(profiles, unreachable_ids, job_name=None, **job_fields):
+    """
+    Записать результаты порции обновления одной транзакцией (вместе с курсором задачи).
+    
+    Args:
+        profiles (list): Кортежи (username, first_name, last_name, tg_id)
+        unreachable_ids (list): tg_id пользователей, недоступных боту
+        job_name (str): Задача, чьи поля job_fields обновляются в той же транзакции
+    """
+    with transaction():
+        if job_name is not None:
+            update_job(job_name, **job_fields)
+        db_executemany(
+            "UPDATE users SET username = ?, first_name = ?, last_name = ?, is_reachable = 1 WHERE tg_id = ?",
+            profiles
+        )
+        db_executemany("UPDATE users SET is_reachable = 0 WHERE tg_id = ?", [(tg_id,) for tg_id in unreachable_ids])
+    for profile in profiles:
+        invalidate_user_cache(profile[3])
+    for tg_id in unreachable_ids:
+        invalidate_user_cache(tg_id)
+
+# --- ПОЛНОТЕКСТОВЫЙ ПОИСК ---
+# Результаты идут от новых записей к старым (обход индекса по rowid останавливается
+# на LIMIT), а не по релевантности: ORDER BY rank считает bm25 для всех совпадений,
+# что для частого имени на сотнях тысяч пользователей занимает ~100 мс.
+SEARCH_LIMIT = 20
+
+def has_fts_search():
+    return db_execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_fts'", fetch_one=True
+    ) is not None
+
+def _fts_match_query(text):
+    """Запрос MATCH: каждое слово — префиксный поиск, все слова должны встретиться."""
+    return ' '.join(f'"{term}"*' for term in re.findall(r'\w+', text))
+
+def _like_pattern(text):
+    return '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def search_users(text, limit=SEARCH_LIMIT):
+    """
+    Пользователи по username, имени или фамилии (префиксы слов); число — поиск по tg_id.
+    
+    Returns:
+        list: Кортежи (id, tg_id, username, first_name, last_name), новые записи первыми
+    """
+    text = text.strip().lstrip('@')
+    if text.isdigit():
+        return db_execute(
+            "SELECT id, tg_id, username, first_name, last_name FROM users WHERE tg_id = ?",
+            (int(text),), fetch_all=True
+        )
+    
+    if has_fts_search():
+        match = _fts_match_query(text)
+        if not match:
+            return []
+        return db_execute(
+            """SELECT u.id, u.tg_id, u.username, u.first_name, u.last_name
+               FROM users_fts JOIN users u ON u.id = users_fts.rowid
+               WHERE users_fts MATCH ? ORDER BY users_fts.rowid DESC LIMIT ?""",
+            (match, limit), fetch_all=True
+        )
+    
+    pattern = _like_pattern(text)
+    return db_execute(
+        """SELECT id, tg_id, username, first_name, last_name FROM users
+           WHERE username LIKE ? ESCAPE '\\' OR first_name LIKE ? ESCAPE '\\' OR last_name LIKE ? ESCAPE '\\'
+           LIMIT ?""",
+        (pattern, pattern, pattern, limit), fetch_all=True
+    )
+
+def search_wishes(text, limit=SEARCH_LIMIT):
+    """
+    Пожелания по словам текста (префиксы слов).
+    
+    Returns:
+        list: Кортежи (id, user_tg_id, game_id, фрагмент текста с совпадением), новые записи первыми
+    """
+    if has_fts_search():
+        match = _fts_match_query(text)
+        if not match:
+            return []
+        return db_execute(
+            """SELECT w.id, w.user_tg_id, w.game_id, snippet(wishes_fts, 0, '', '', '…', 8)
+               FROM wishes_fts JOIN wishes w ON w.id = wishes_fts.rowid
+               WHERE wishes_fts MATCH ? ORDER BY wishes_fts.rowid DESC LIMIT ?""",
+            (match, limit), fetch_all=True
+        )
+    
+    return db_execute(
+        "SELECT id, user_tg_id, game_id, substr(text, 1, 60) FROM wishes WHERE text LIKE ? ESCAPE '\\' LIMIT ?",
+        (_like_pattern(text.strip()), limit), fetch_all=True
+    )
+
+# --- OUTBOX ---
+# Статусы сообщений: pending (ждёт отправки), sending (взято воркером), sent,
+# skipped (не отправлено намеренно: получатель — фантом), dead (окончательно
+# не доставлено), cancelled (рассылка заменена более новой).
+
+def create_outbox_batch(messages, notify_chat_id=None, title=None, batch_key=None, sudo=None):
+    """
+    Записать рассылку в outbox. Вызывается внутри transaction() вместе с данными,
+    ради которых она делается (например, с парами жеребьёвки).
+    
+    Args:
+        messages (list): Кортежи (chat_id, text, parse_mode)
+        notify_chat_id (int): Кому прислать итог рассылки (опционально)
+        title (str): Название рассылки для итогового сообщения
+        batch_key (str): Ключ рассылки; недоставленные сообщения прежних рассылок
+            с тем же ключом отменяются (например, при пережеребьёвке)
+        sudo (tuple): (цель, администратор) /sudo, если рассылка запущена в нём:
+            сообщения цели будут отправлены администратору
+            
+    Returns:
+        int: ID рассылки
+    """
+    now = time.time()
+    with transaction() as conn:
+        if batch_key is not None:
+            conn.execute(
+                """UPDATE outbox SET status = 'cancelled'
+                   WHERE status IN ('pending', 'sending')
+                     AND batch_id IN (SELECT id FROM outbox_batches WHERE batch_key = ?)""",
+                (batch_key,)
+            )
+            conn.execute("UPDATE outbox_batches SET reported = 1 WHERE batch_key = ?", (batch_key,))
+        batch_id = conn.execute(
+            "INSERT INTO outbox_batches (batch_key, notify_chat_id, title, created_at) VALUES (?, ?, ?, ?)",
+            (batch_key, notify_chat_id, title, now)
+        ).lastrowid
+        conn.executemany(
+            """INSERT INTO outbox (batch_id, chat_id, text, parse_mode, next_attempt_at, created_at, sudo_admin)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            [
+                (batch_id, chat_id, text, parse_mode, now, now, sudo[1] if sudo and chat_id == sudo[0] else None)
+                for chat_id, text, parse_mode in messages
+            ]
+        )
+    return batch_id
+
+def claim_due_outbox(limit=100):
+    """Забрать до limit сообщений, срок отправки которых наступил, пометив их 'sending'."""
+    with transaction() as conn:
+        rows = conn.execute(
+            """SELECT id, batch_id, chat_id, text, parse_mode, attempts, sudo_admin FROM outbox
+               WHERE status = 'pending' AND next_attempt_at <= ?
+               ORDER BY next_attempt_at, id LIMIT ?""",
+            (time.time(), limit)
+        ).fetchall()
+        conn.executemany("UPDATE outbox SET status = 'sending' WHERE id = ?", [(row[0],) for row in rows])
+    return rows
+
+def mark_outbox_sent(message_id):
+    db_execute(
+        "UPDATE outbox SET status = 'sent', attempts = attempts + 1, sent_at = ?, last_error = NULL WHERE id = ? AND status = 'sending'",
+        (time.time(), message_id),
+        commit=True
+    )
+
+def mark_outbox_skipped(message_id):
+    db_execute(
+        "UPDATE outbox SET status = 'skipped', attempts = attempts + 1, last_error = NULL WHERE id = ? AND status = 'sending'",
+        (message_id,),
+        commit=True
+    )
+
+def mark_outbox_failed(message_id, error, retry_at=None):
+    """Зафиксировать неудачу: вернуть в очередь на retry_at или, если он не задан, перевести в dead."""
+    if retry_at is None:
+        db_execute(
+            "UPDATE outbox SET status = 'dead', attempts = attempts + 1, last_error = ? WHERE id = ? AND status = 'sending'",
+            (error, message_id),
+            commit=True
+        )
+    else:
+        db_execute(
+            "UPDATE outbox SET status = 'pending', attempts = attempts + 1, last_error = ?, next_attempt_at = ? WHERE id = ? AND status = 'sending'",
+            (error, retry_at, message_id),
+            commit=True
+        )
+
+def reset_inflight_outbox():
+    """После перезапуска вернуть в очередь сообщения, отправка которых была прервана."""
+    db_execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'", commit=True)
+
+def complete_outbox_batch(batch_id):
+    """
+    Если в рассылке не осталось сообщений в работе, однократно пометить её завершённой.
+    
+    Returns:
+        tuple: (notify_chat_id, title, sent, dead, skipped) для только что завершённой рассылки или None
+    """
+    with transaction() as conn:
+        claimed = conn.execute(
+            """UPDATE outbox_batches SET reported = 1
+               WHERE id = ? AND reported = 0
+                 AND NOT EXISTS (SELECT 1 FROM outbox WHERE batch_id = ? AND status IN ('pending', 'sending'))""",
+            (batch_id, batch_id)
+        ).rowcount
+        if not claimed:
+            return None
+        notify_chat_id, title = conn.execute(
+            "SELECT notify_chat_id, title FROM outbox_batches WHERE id = ?", (batch_id,)
+        ).fetchone()
+        counts = dict(conn.execute(
+            "SELECT status, COUNT(*) FROM outbox WHERE batch_id = ? GROUP BY status", (batch_id,)
+        ).fetchall())
+    return notify_chat_id, title, counts.get('sent', 0), counts.get('dead', 0), counts.get('skipped', 0)
+
+def get_dead_outbox(limit=10):
+    """Недоставленные сообщения: (total, [(id, chat_id, attempts, last_error, created_at), ...])."""
+    total = db_execute("SELECT COUNT(*) FROM outbox WHERE status = 'dead'", fetch_one=True)[0]
+    rows = db_execute(
+        "SELECT id, chat_id, attempts, last_error, created_at FROM outbox WHERE status = 'dead' ORDER BY id DESC LIMIT ?",
+        (limit,),
+        fetch_all=True
+    )
+    return total, rows
+
+def requeue_dead_outbox(message_id=None):
+    """
+    Вернуть недоставленные сообщения в очередь (одно по id или все).
+    
+    Returns:
+        int: Сколько сообщений поставлено в очередь повторно
+    """
+    now = time.time()
+    if message_id is None:
+        params = [(now,)]
+        query = "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ? WHERE status = 'dead'"
+    else:
+        params = [(now, message_id)]
+        query = "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ? WHERE status = 'dead' AND id = ?"
+    with transaction():
+        count = db_executemany(query, params)
+        # Повторная доставка должна снова завершиться итоговым отчётом для рассылки
+        db_execute(
+            """UPDATE outbox_batches SET reported = 0
+               WHERE id IN (SELECT DISTINCT batch_id FROM outbox WHERE status = 'pending' AND batch_id IS NOT NULL)"""
+        )
+    return count
+
 class User:
     """
     Класс для управления пользователями в системе Secret Santa.
@@ -155,13 +1336,13 @@ class User:
     def get_fantom(tg_id):
         """
         Получить фантома - специального пользователя с заданым id.
-        Если его нет в БД, создать.
+        Если его нет в БД, создать. Роль уже существующего пользователя не меняется.
         
         Returns:
-            User: Объект пользователя-фантома
+            User: Созданный фантом или существующий пользователь с этим id
         """
         try:
-            return User(tg_id=0)
+            return User(tg_id=tg_id)
         except ValueError:
             return User.create_user(tg_id=tg_id, username='fantom', first_name='Fantom', role='fantom')
 
@@ -200,6 +1381,8 @@ class User:
             (tg_id, username, first_name, last_name, role),
             commit=True
         )
+        invalidate_user_cache(tg_id)
+        set_cached_role(tg_id, role)
         
         # Возвращаем объект User с загруженными данными
         return User(tg_id=tg_id)
@@ -254,6 +1437,10 @@ class User:
     
     def save(self):
         """Сохранить/обновить данные пользователя в БД."""
+        previous = None
+        if self.id is not None:
+            previous = db_execute("SELECT tg_id FROM users WHERE id = ?", (self.id,), fetch_one=True)
+        
         if self.id is None:
             # Новый пользователь - вставляем
             db_execute(
@@ -278,6 +1465,14 @@ class User:
                 (self.tg_id, self.username, self.first_name, self.last_name, self.role, self.id),
                 commit=True
             )
+        
+        # tg_id мог измениться — сбрасываем и старую, и новую запись кэша
+        invalidate_user_cache(self.tg_id)
+        if previous:
+            invalidate_user_cache(previous[0])
+            if previous[0] != self.tg_id:
+                set_cached_role(previous[0], None)
+        set_cached_role(self.tg_id, self.role or 'user')
     
     def is_admin(self):
         """Проверить, является ли пользователь администратором."""
@@ -314,23 +1509,22 @@ class User:
     
     def get_games_as_participant(self):
         """Получить список игр, где пользователь является участником."""
-        all_games = db_execute(
-            "SELECT id, name, participants_json, organizer_id, status FROM games",
+        games = db_execute(
+            """SELECT g.id, g.name, g.status
+               FROM game_participants gp JOIN games g ON g.id = gp.game_id
+               WHERE gp.tg_id = ?
+               ORDER BY g.id DESC""",
+            (self.tg_id,),
             fetch_all=True
         )
-        
-        participant_games = []
-        for game_id, name, participants_json, organizer_id, status in all_games:
-            participants = json.loads(participants_json)
-            if self.tg_id in participants:
-                participant_games.append((game_id, name, status))
-        
-        return participant_games
+        return games or []
     
     def delete(self):
         """Удалить пользователя из БД."""
         if self.id is not None:
             db_execute("DELETE FROM users WHERE id = ?", (self.id,), commit=True)
+            invalidate_user_cache(self.tg_id)
+            set_cached_role(self.tg_id, None)
             self.id = None
     
     def __repr__(self):
@@ -0,0 +1,150 @@
+"""
+Диспетчер апдейтов: строгий порядок внутри одного чата, параллельность между чатами.
+
+Апдейты раскладываются по «полосам» (lanes) по хэшу chat id. Каждую полосу
+обрабатывает один поток, поэтому сообщения одного пользователя (например,
+шаги создания игры waiting_game_name -> waiting_budget -> waiting_currency)
+обрабатываются по очереди, а разные чаты — параллельно.
+"""
+import queue
+import threading
+import time
+import traceback
+
+LANE_COUNT = 8
+LANE_CAPACITY = 1000
+
+
+def _field_id(update_json, field, owner):
+    """update_json[field][owner]['id'] или None, если какого-то уровня нет или он не объект."""
+    value = update_json.get(field)
+    for key in (owner, 'id'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def update_chat_id(update_json):
+    """
+    Ключ упорядочивания для апдейта Telegram (dict): id чата или пользователя.
+    Для апдейта без этих полей (в том числе повреждённого) — update_id.
+    """
+    for field in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        chat_id = _field_id(update_json, field, 'chat')
+        if chat_id is not None:
+            return chat_id
+    for field in ('callback_query', 'inline_query', 'chosen_inline_result', 'shipping_query',
+                  'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request'):
+        user_id = _field_id(update_json, field, 'from')
+        if user_id is not None:
+            return user_id
+    return update_json.get('update_id', 0)
+
+
+class _Lane:
+    def __init__(self, index, capacity):
+        self.index = index
+        self.queue = queue.Queue(maxsize=capacity)
+        self.processed = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.lock = threading.Lock()
+
+
+class LaneDispatcher:
+    """
+    Пул полос обработки.
+
+    Args:
+        handler: Функция handler(item), вызываемая в потоке полосы
+        lanes (int): Число полос (потоков)
+        lane_capacity (int): Ёмкость очереди одной полосы
+    """
+
+    def __init__(self, handler, lanes=LANE_COUNT, lane_capacity=LANE_CAPACITY):
+        self.handler = handler
+        self.lanes = [_Lane(i, lane_capacity) for i in range(lanes)]
+        for lane in self.lanes:
+            threading.Thread(target=self._run, args=(lane,), name=f"lane-{lane.index}", daemon=True).start()
+
+    def submit(self, key, item, block=False, timeout=None):
+        """
+        Поставить элемент в полосу, соответствующую key.
+
+        Returns:
+            bool: False, если полоса заполнена (при block=False) или не освободилась за timeout
+        """
+        lane = self.lanes[hash(key) % len(self.lanes)]
+        try:
+            lane.queue.put((time.monotonic(), item), block=block, timeout=timeout)
+        except queue.Full:
+            return False
+        depth = lane.queue.qsize()
+        with lane.lock:
+            lane.max_depth = max(lane.max_depth, depth)
+        return True
+
+    def _run(self, lane):
+        while True:
+            enqueued_at, item = lane.queue.get()
+            wait = time.monotonic() - enqueued_at
+            with lane.lock:
+                lane.wait_total += wait
+                lane.wait_max = max(lane.wait_max, wait)
+            try:
+                self.handler(item)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with lane.lock:
+                    lane.processed += 1
+                lane.queue.task_done()
+
+    def metrics(self):
+        """Метрики по полосам: текущая/максимальная глубина, число обработанных, ожидание в очереди (сек)."""
+        result = []
+        for lane in self.lanes:
+            with lane.lock:
+                result.append({
+                    'lane': lane.index,
+                    'depth': lane.queue.qsize(),
+                    'max_depth': lane.max_depth,
+                    'processed': lane.processed,
+                    'wait_avg': lane.wait_total / lane.processed if lane.processed else 0.0,
+                    'wait_max': lane.wait_max,
+                })
+        return result
+
+
+def run_polling(bot, dispatcher, timeout=30):
+    """
+    Long polling с раздачей апдейтов по полосам диспетчера (замена bot.polling).
+    Если полоса заполнена, опрос ждёт, пока она освободится.
+    """
+    offset = None
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=timeout, long_polling_timeout=timeout)
+        except Exception:
+            traceback.print_exc()
+            time.sleep(3)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            dispatcher.submit(_parsed_update_chat_id(update), update, block=True)
+
+
+def _parsed_update_chat_id(update):
+    """Ключ упорядочивания для уже разобранного telebot.types.Update."""
+    for field in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        message = getattr(update, field, None)
+        if message:
+            return message.chat.id
+    for field in ('callback_query', 'inline_query', 'chosen_inline_result', 'shipping_query',
+                  'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request'):
+        event = getattr(update, field, None)
+        if event:
+            return event.from_user.id
+    return update.update_id
@@ -2,13 +2,22 @@ import telebot
 from telebot import types
 from dotenv import load_dotenv
 import os
-from db_manager import init_db, get_game_id_by_code, is_admin, get_game_info, is_fantom, User
+from db_manager import init_db, load_roles, get_game_id_by_code, is_admin, get_game_info, is_fantom, add_game_participant, User
 import bot_handlers.common as common
-from bot_handlers.common import send
+from bot_handlers.common import send, edit_message
 import bot_handlers.game_creation as gc
 import bot_handlers.game_panels as gp
 import bot_handlers.game_actions as ga
 import bot_handlers.admin_panel as ap
+import bot_handlers.participant_import as pi
+from bot_handlers.outbound import start_outbox_worker
+from bot_handlers.context import current_context, request_context, sudo_context, update_user_id
+from webhook_server import WebhookServer
+from dispatcher import LaneDispatcher, run_polling
+from state_store import StateStore, StateDispatcher
+from bot_handlers.router import CallbackRouter
+from bot_handlers.callback_codec import purge_expired_tokens
+from bot_handlers.user_refresh import resume_user_refresh
 
 load_dotenv()
 TOKEN = os.getenv('BOT_TOKEN') 
@@ -16,10 +25,32 @@ TOKEN = os.getenv('BOT_TOKEN')
 if not TOKEN:
     raise ValueError("BOT_TOKEN не найден в переменных окружения или файле .env")
 
-bot = telebot.TeleBot(TOKEN)
-user_states = {}
+# Режим получения апдейтов: 'polling' (по умолчанию) или 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Публичный адрес; без него webhook не регистрируется (локальный режим)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Полосы диспетчера: апдейты одного чата обрабатываются по порядку, разных чатов — параллельно
+UPDATE_LANES = int(os.getenv('UPDATE_LANES', '8'))
+UPDATE_LANE_CAPACITY = int(os.getenv('UPDATE_LANE_CAPACITY', '1000'))
+
+if BOT_MODE not in ('polling', 'webhook'):
+    raise ValueError(f"Неизвестный BOT_MODE: {BOT_MODE} (ожидается 'polling' или 'webhook')")
+
+# Обработка идёт в полосах LaneDispatcher, собственные потоки telebot не нужны
+bot = telebot.TeleBot(TOKEN, threaded=False)
+user_states = StateStore()
 
 init_db()
+load_roles()
+purge_expired_tokens()
+try:
+    common.load_bot_identity(bot)
+except Exception:
+    # Не критично: данные бота будут запрошены при первой отрисовке панели
+    pass
 
 # --- COMMAND HANDLERS ---
 @bot.message_handler(commands=['start'])
@@ -33,26 +64,16 @@ def handle_start(message):
         game_id = get_game_id_by_code(invite_code)
         if game_id:
             # Если мы в sudo контексте, добавляем пользователя напрямую без подтверждения
-            if common.SUDO_CONTEXT:
-                import json
+            ctx = current_context()
+            if ctx and ctx.sudo_admin is not None:
                 game = get_game_info(game_id)
                 if game:
-                    participants_json = game[4]
-                    participants = json.loads(participants_json)
                     tg_id = message.from_user.id
                     
-                    if tg_id not in participants:
-                        participants.append(tg_id)
-                        new_participants_json = json.dumps(participants)
-                        from db_manager import db_execute
-                        db_execute(
-                            "UPDATE games SET participants_json = ? WHERE id = ?",
-                            (new_participants_json, game_id),
-                            commit=True
-                        )
-                        send(bot, common.SUDO_CONTEXT['admin'], f"✅ Пользователь {tg_id} добавлен в игру {game[1]}")
+                    if add_game_participant(game_id, tg_id):
+                        send(bot, ctx.sudo_admin, f"✅ Пользователь {tg_id} добавлен в игру {game.name}")
                     else:
-                        send(bot, common.SUDO_CONTEXT['admin'], f"ℹ️ Пользователь {tg_id} уже в игре {game[1]}")
+                        send(bot, ctx.sudo_admin, f"ℹ️ Пользователь {tg_id} уже в игре {game.name}")
             else:
                 ga.join_game_prompt(bot, message, game_id)
             return
@@ -69,8 +90,11 @@ def handle_fantom(message):
         if len(message.text.split(' ')) < 2:
             send(bot, message.chat.id, "Использование: /fantom <id пользователя>")
             return
-        User.get_fantom(int(message.text.split(' ')[1]))
-        send(bot, message.chat.id, "Фантом создан.")
+        user = User.get_fantom(int(message.text.split(' ')[1]))
+        if user.is_fantom():
+            send(bot, message.chat.id, "Фантом создан.")
+        else:
+            send(bot, message.chat.id, f"Пользователь {user.tg_id} уже зарегистрирован с ролью '{user.role}' — фантомом не сделан.")
     else:
         send(bot, message.chat.id, "У вас нет прав администратора.")
 
@@ -122,54 +146,53 @@ def handle_sudo(message):
 
     cmd = command_text.split()[0].lstrip('/').lower()
 
-    # Установим sudo-контекст, чтобы send() перенаправлял сообщения, адресованные цели, админу
-    common.set_sudo_context(target_id, message.chat.id)
-    try:
-        # Вызов напрямую для известных команд
-        if cmd == 'start':
-            handle_start(fake_msg)
-            send(bot, message.chat.id, f"Выполнено: /start от {target_id}")
-            return
-        if cmd == 'fantom':
-            handle_fantom(fake_msg)
-            send(bot, message.chat.id, f"Выполнено: /fantom от {target_id}")
-            return
-        if cmd == 'admin':
-            handle_admin(fake_msg)
-            send(bot, message.chat.id, f"Выполнено: /admin от {target_id}")
-            return
-        if cmd in ('admin_action', 'trigger'):
-            handle_admin_action(fake_msg)
-            send(bot, message.chat.id, f"Выполнено: /admin_action от {target_id}")
-            return
-        if cmd == 'update_users':
-            handle_update_users(fake_msg)
-            send(bot, message.chat.id, f"Выполнено: /update_users от {target_id}")
-            return
-        if cmd == 'cancel':
-            handle_cancel(fake_msg)
-            send(bot, message.chat.id, f"Выполнено: /cancel от {target_id}")
-            return
-
-        # Попытка передать сообщение в движок telebot
+    # Sudo-контекст действует только внутри этого апдейта: send() перенаправляет
+    # сообщения, адресованные цели, админу, не затрагивая параллельные апдейты
+    with sudo_context(target_id, message.chat.id):
         try:
-            bot.process_new_messages([fake_msg])
-            send(bot, message.chat.id, f"Попытка обработать сообщение '{command_text}' от {target_id} отправлена в процесс бота.")
-            return
+            # Вызов напрямую для известных команд
+            if cmd == 'start':
+                handle_start(fake_msg)
+                send(bot, message.chat.id, f"Выполнено: /start от {target_id}")
+                return
+            if cmd == 'fantom':
+                handle_fantom(fake_msg)
+                send(bot, message.chat.id, f"Выполнено: /fantom от {target_id}")
+                return
+            if cmd == 'admin':
+                handle_admin(fake_msg)
+                send(bot, message.chat.id, f"Выполнено: /admin от {target_id}")
+                return
+            if cmd in ('admin_action', 'trigger'):
+                handle_admin_action(fake_msg)
+                send(bot, message.chat.id, f"Выполнено: /admin_action от {target_id}")
+                return
+            if cmd == 'update_users':
+                handle_update_users(fake_msg)
+                send(bot, message.chat.id, f"Выполнено: /update_users от {target_id}")
+                return
+            if cmd == 'cancel':
+                handle_cancel(fake_msg)
+                send(bot, message.chat.id, f"Выполнено: /cancel от {target_id}")
+                return
+
+            # Попытка передать сообщение в движок telebot
+            try:
+                bot.process_new_messages([fake_msg])
+                send(bot, message.chat.id, f"Попытка обработать сообщение '{command_text}' от {target_id} отправлена в процесс бота.")
+                return
+            except Exception:
+                import traceback
+                tb = traceback.format_exc()
+                send(bot, message.chat.id, f"Не удалось выполнить команду: {tb}")
+                return
+
         except Exception:
             import traceback
             tb = traceback.format_exc()
-            send(bot, message.chat.id, f"Не удалось выполнить команду: {tb}")
+            send(bot, message.chat.id, f"Ошибка при выполнении sudo: {tb}")
             return
 
-    except Exception:
-        import traceback
-        tb = traceback.format_exc()
-        send(bot, message.chat.id, f"Ошибка при выполнении sudo: {tb}")
-        return
-    finally:
-        common.clear_sudo_context()
-
 
 @bot.message_handler(commands=['admin'])
 def handle_admin(message):
@@ -215,7 +238,7 @@ def handle_admin_action(message):
         game = get_game_info(game_id)
         if game:
             ga.finish_game_action_admin(bot, game_id, tg_id)
-            send(bot, tg_id, f"Игра '{game[1]}' завершена.")
+            send(bot, tg_id, f"Игра '{game.name}' завершена.")
         else:
             send(bot, tg_id, "Игра не найдена.")
             
@@ -232,126 +255,172 @@ def handle_update_users(message):
         return
     
     if is_admin(message.from_user.id):
-        result_text, success = ap.admin_update_all_users_data(bot, message)
-        send(bot, message.chat.id, result_text, parse_mode='Markdown')
+        result_text, success = ap.admin_update_all_users_data(bot, message.chat.id, message.from_user.id)
+        if not success:
+            send(bot, message.chat.id, result_text)
     else:
         send(bot, message.chat.id, "У вас нет прав администратора.")
 
+@bot.message_handler(commands=['search'])
+def handle_search(message):
+    if not is_admin(message.from_user.id):
+        send(bot, message.chat.id, "У вас нет прав администратора.")
+        return
+    
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        send(bot, message.chat.id, "Использование: /search <username, имя, Telegram ID или слова из пожелания>")
+        return
+    ap.admin_search(bot, message.chat.id, parts[1])
+
+@bot.message_handler(commands=['stats'])
+def handle_stats(message):
+    if not is_admin(message.from_user.id):
+        send(bot, message.chat.id, "У вас нет прав администратора.")
+        return
+    
+    lines = ["<b>Полосы обработки апдейтов</b>", "<code>#  очередь  макс  обработано  ожид.ср/макс, мс</code>"]
+    for lane in dispatcher.metrics():
+        lines.append(
+            f"<code>{lane['lane']:<2} {lane['depth']:>7} {lane['max_depth']:>5} {lane['processed']:>11}"
+            f"  {lane['wait_avg'] * 1000:.0f}/{lane['wait_max'] * 1000:.0f}</code>"
+        )
+    
+    routes = sorted((route for route in router.metrics() if route['calls']), key=lambda route: -route['calls'])
+    if routes:
+        lines += ["", "<b>Маршруты callback</b>", "<code>вызовы  ошибки  ср/макс, мс  маршрут</code>"]
+        for route in routes[:20]:
+            lines.append(
+                f"<code>{route['calls']:>6} {route['errors']:>7}  {route['avg_time'] * 1000:.0f}/{route['max_time'] * 1000:.0f}"
+                f"  {common.escape_html(route['pattern'])}</code>"
+            )
+    send(bot, message.chat.id, "\n".join(lines), parse_mode='HTML')
+
 @bot.message_handler(commands=['cancel'])
 def handle_cancel(message):
     if common.check_fantom(bot, message.chat.id):
         return
     
     if message.chat.id in user_states:
-        del user_states[message.chat.id]
+        user_states.discard(message.chat.id)
         send(bot, message.chat.id, "Действие отменено.", reply_markup=common.main_menu_markup())
 
 # --- MESSAGE HANDLERS (for states) ---
-@bot.message_handler(func=lambda message: user_states.get(message.chat.id) and user_states[message.chat.id][0] == 'waiting_game_name')
-def handle_game_name(message):
-    if common.check_fantom(bot, message.chat.id):
-        return
-    gc.handle_game_name(bot, message, user_states)
+states = StateDispatcher(user_states, gate=lambda bot, message: common.check_fantom(bot, message.chat.id))
+states.register('waiting_game_name', gc.handle_game_name)
+states.register('waiting_budget', gc.handle_budget)
+states.register('waiting_wish_text', ga.handle_wish_text)
+states.register('waiting_admin_edit', ap.handle_admin_edit_input)
+states.register('waiting_admin_search', ap.handle_admin_search_input)
+states.register('waiting_participants_import', pi.handle_participants_import, content_types=('text', 'document'))
+
+@bot.message_handler(func=lambda message: True)
+def handle_state_message(message):
+    # Текст без активного состояния диалога игнорируется
+    states.dispatch(bot, message)
+
+@bot.message_handler(content_types=['document'])
+def handle_state_document(message):
+    # Файл дойдёт до обработчика, только если состояние объявило content_types с 'document'
+    states.dispatch(bot, message)
 
-@bot.message_handler(func=lambda message: user_states.get(message.chat.id) and user_states[message.chat.id][0] == 'waiting_budget')
-def handle_budget(message):
-    if common.check_fantom(bot, message.chat.id):
-        return
-    gc.handle_budget(bot, message, user_states)
+# --- CALLBACK QUERY HANDLER ---
+router = CallbackRouter()
 
-@bot.message_handler(func=lambda message: user_states.get(message.chat.id) and user_states[message.chat.id][0] == 'waiting_wish_text')
-def handle_wish_text(message):
-    if common.check_fantom(bot, message.chat.id):
-        return
-    ga.handle_wish_text(bot, message, user_states)
+def organizer_only(bot, call, game_id):
+    """Guard: действие доступно организатору игры и администраторам."""
+    tg_id = call.from_user.id
+    game = get_game_info(game_id)
+    if game and (game.organizer_id == tg_id or is_admin(tg_id)):
+        return True
+    bot.answer_callback_query(call.id, "У вас нет прав организатора/администратора.")
+    return False
+
+@router.route('menu')
+def show_main_menu(bot, call):
+    edit_message(bot,
+        "Привет! Я бот для игры в Тайного Санту. Выбери действие:", 
+        call.from_user.id, 
+        call.message.message_id, 
+        reply_markup=common.main_menu_markup()
+    )
 
-@bot.message_handler(func=lambda message: user_states.get(message.chat.id) and user_states[message.chat.id][0] == 'waiting_admin_edit')
-def handle_admin_edit_input(message):
-    if common.check_fantom(bot, message.chat.id):
-        return
-    ap.handle_admin_edit_input(bot, message, user_states)
+@router.route('create_game')
+def create_game(bot, call):
+    bot.delete_message(call.from_user.id, call.message.message_id)
+    gc.create_game_start(bot, call.message, user_states)
+
+def show_organizer_panel(bot, call, game_id):
+    gp.organizer_panel(bot, call.from_user.id, game_id, call.message.message_id)
+
+def draw(bot, call, game_id):
+    tg_id = call.from_user.id
+    result_message, success = ga.draw_pairs(bot, game_id, tg_id)
+    bot.answer_callback_query(call.id, result_message)
+    gp.organizer_panel(bot, tg_id, game_id, call.message.message_id)
+
+def prompt_wish(bot, call, game_id):
+    ga.prompt_wish_text(bot, call, game_id, user_states)
+
+router.add('my_games', gp.my_games_panel)
+router.add('select_currency_{currency_code}', lambda bot, call, currency_code: gc.handle_currency_select_callback(bot, call, currency_code, user_states))
+router.add('noop', lambda bot, call: bot.answer_callback_query(call.id))
+
+# Кнопки строятся через callback_codec.packed(tag, game_id)
+GAME_ROUTES = (
+    # тег, старый префикс (кнопки в уже отправленных сообщениях), обработчик, guard
+    ('j', 'join_', ga.join_game_action, None),
+    ('op', 'org_panel_', show_organizer_panel, organizer_only),
+    ('vg', 'view_game_', gp.participant_game_view, None),
+    ('dr', 'draw_', draw, organizer_only),
+    ('wg', 'wish_game_', prompt_wish, None),
+    ('dg', 'delete_game_', ga.delete_game_confirm, organizer_only),
+    ('cd', 'confirm_delete_', ga.delete_game_action, organizer_only),
+    ('fg', 'finish_game_', ga.finish_game_action, organizer_only),
+)
+for tag, legacy_prefix, handler, guard in GAME_ROUTES:
+    router.add_packed(tag, ('game_id',), handler, guard=guard)
+    router.add(legacy_prefix + '{game_id:int}', handler, guard=guard)
+router.add_packed('mg', ('before_game_id',), gp.my_games_panel)
+# Кнопки «Ещё игры», отправленные до перехода на packed
+router.add('my_games_{before_game_id:int}', gp.my_games_panel)
+router.add_packed('ip', ('game_id',), lambda bot, call, game_id: pi.prompt_participants_import(bot, call, game_id, user_states), guard=organizer_only)
+ap.register_admin_routes(router, user_states)
 
-# --- CALLBACK QUERY HANDLER ---
 @bot.callback_query_handler(func=lambda call: True)
 def callback_inline(call):
-    data = call.data
-    tg_id = call.from_user.id
-    
-    if common.check_fantom(bot, tg_id):
+    if common.check_fantom(bot, call.from_user.id):
         bot.answer_callback_query(call.id, "❌ Вам запрещено использовать этот бот.", show_alert=True)
         return
     
-    if data.startswith('admin_'):
-        ap.callback_admin_panel(bot, call, user_states)
-        return
-
-    if data == 'menu':
-        bot.edit_message_text(
-            "Привет! Я бот для игры в Тайного Санту. Выбери действие:", 
-            tg_id, 
-            call.message.message_id, 
-            reply_markup=common.main_menu_markup()
-        )
-    elif data == 'create_game':
-        bot.delete_message(tg_id, call.message.message_id)
-        gc.create_game_start(bot, call.message, user_states)
-    elif data == 'my_games':
-        gp.my_games_panel(bot, call)
-    elif data.startswith('join_'):
-        game_id = int(data.split('_')[1])
-        ga.join_game_action(bot, call, game_id)
-    elif data.startswith('select_currency_'):
-        gc.handle_currency_select_callback(bot, call, user_states)
-    elif data.startswith('org_panel_'):
-        game_id = int(data.split('_')[2])
-        game = get_game_info(game_id)
-        if game and (game[3] == tg_id or is_admin(tg_id)):
-            gp.organizer_panel(bot, tg_id, game_id, call.message.message_id)
-        else:
-            bot.answer_callback_query(call.id, "У вас нет прав на управление этой игрой.")
-    elif data.startswith('view_game_'):
-        game_id = int(data.split('_')[2])
-        gp.participant_game_view(bot, call, game_id)
-    elif data.startswith('draw_'):
-        game_id = int(data.split('_')[-1])
-        game = get_game_info(game_id)
-        if game and (game[3] == tg_id or is_admin(tg_id)):
-            result_message, success = ga.draw_pairs(bot, game_id, tg_id)
-            bot.answer_callback_query(call.id, result_message)
-            gp.organizer_panel(bot, tg_id, game_id, call.message.message_id)
-        else:
-            bot.answer_callback_query(call.id, "У вас нет прав организатора/администратора.")
-    elif data.startswith('wish_game_'):
-        game_id = int(data.split('_')[2])
-        ga.prompt_wish_text(bot, call, game_id, user_states)
-    elif data.startswith('delete_game_'):
-        game_id = int(data.split('_')[2])
-        game = get_game_info(game_id)
-        if game and (game[3] == tg_id or is_admin(tg_id)):
-            ga.delete_game_confirm(bot, call, game_id)
-        else:
-            bot.answer_callback_query(call.id, "У вас нет прав организатора/администратора.")
-    elif data.startswith('confirm_delete_'):
-        game_id = int(data.split('_')[2])
-        game = get_game_info(game_id)
-        if game and (game[3] == tg_id or is_admin(tg_id)):
-            ga.delete_game_action(bot, call, game_id)
-        else:
-            bot.answer_callback_query(call.id, "У вас нет прав организатора/администратора.")
-    elif data.startswith('finish_game_'):
-        game_id = int(data.split('_')[2])
-        game = get_game_info(game_id)
-        if game and (game[3] == tg_id or is_admin(tg_id)):
-            ga.finish_game_action(bot, call, game_id)
-        else:
-            bot.answer_callback_query(call.id, "У вас нет прав организатора/администратора.")
-    else:
+    if not router.dispatch(bot, call):
         bot.answer_callback_query(call.id, "Действие не распознано.")
 
+def process_update(update):
+    """Обработать один апдейт (JSON из webhook или уже разобранный из polling) в потоке полосы."""
+    if isinstance(update, dict):
+        update = types.Update.de_json(update)
+    with request_context(update_user_id(update)) as ctx:
+        common.note_user_activity(update, ctx.user_id)
+        bot.process_new_updates([update])
+
+dispatcher = LaneDispatcher(process_update, lanes=UPDATE_LANES, lane_capacity=UPDATE_LANE_CAPACITY)
+
 if __name__ == '__main__':
-    user_states.clear() 
+    user_states.start()
+    start_outbox_worker(bot)
+    common.start_bot_identity_refresh(bot)
+    resume_user_refresh(bot)
     try:
-        bot.polling(none_stop=True)
+        if BOT_MODE == 'webhook':
+            server = WebhookServer(dispatcher, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+            if WEBHOOK_URL:
+                bot.remove_webhook()
+                bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+            server.serve_forever()
+        else:
+            bot.remove_webhook()
+            run_polling(bot, dispatcher)
     except Exception as e:
         import traceback, sys
         traceback.print_exc()
@@ -0,0 +1,240 @@
+import random
+from collections import defaultdict
+
+
+class PairingError(ValueError):
+    """Невозможно составить пары для заданных участников и ручных назначений."""
+
+
+def _build_segments(participants, manual_pairs):
+    """
+    Разбить участников на цепочки по ручным парам.
+
+    Ручные пары santa -> recipient образуют цепочки (a -> b -> c) и, возможно,
+    замкнутые циклы. Замкнутые циклы уже полностью распределены и в жеребьёвке
+    не участвуют. Каждая незамкнутая цепочка (и каждый участник без ручных пар
+    как цепочка из одного человека) представлена кортежем (head, tail):
+    head ещё нужен Санта, tail ещё нужен получатель.
+
+    Raises:
+        PairingError: Если ручные пары противоречат друг другу или составу игры
+    """
+    participant_set = set(participants)
+    next_of = {}
+    prev_of = {}
+
+    for santa, recipient in manual_pairs:
+        if santa not in participant_set or recipient not in participant_set:
+            raise PairingError("В ручных парах есть участники, не входящие в игру.")
+        if santa == recipient:
+            raise PairingError("В ручных парах участник назначен дарить самому себе.")
+        if santa in next_of or recipient in prev_of:
+            raise PairingError("В ручных парах участник назначен дважды.")
+        next_of[santa] = recipient
+        prev_of[recipient] = santa
+
+    segments = []
+    visited = set()
+    for p_id in participants:
+        if p_id in prev_of or p_id in visited:
+            continue
+        # p_id — начало цепочки: идём по ручным парам до конца
+        tail = p_id
+        visited.add(tail)
+        while tail in next_of:
+            tail = next_of[tail]
+            visited.add(tail)
+        segments.append((p_id, tail))
+
+    # Всё, что не попало в цепочки, лежит на замкнутых ручных циклах
+    return segments
+
+
+def build_derangement(participants, manual_pairs=(), rng=random):
+    """
+    Составить пары Санта -> получатель без самоназначений за один линейный проход.
+
+    Цепочки из ручных пар и свободные участники перемешиваются и сшиваются в
+    один случайный цикл (аналог алгоритма Саттоло): хвост каждой цепочки дарит
+    голове следующей. Ручные пары сохраняются как есть.
+
+    Args:
+        participants (list): tg_id всех участников игры
+        manual_pairs (iterable): Ручные пары (santa_tg_id, recipient_tg_id)
+        rng: Источник случайности (random или random.Random)
+
+    Returns:
+        list: Пары (santa_tg_id, recipient_tg_id) для каждого участника, кроме ручных
+
+    Raises:
+        PairingError: Если составить пары невозможно
+    """
+    if len(participants) < 2:
+        raise PairingError("Недостаточно участников для жеребьёвки (нужно минимум 2).")
+
+    segments = _build_segments(participants, manual_pairs)
+
+    if len(segments) == 1:
+        head, tail = segments[0]
+        if head == tail:
+            raise PairingError(
+                "Ручные пары замыкают всех, кроме одного участника: ему некому дарить, кроме самого себя."
+            )
+
+    rng.shuffle(segments)
+    return [
+        (segments[i][1], segments[(i + 1) % len(segments)][0])
+        for i in range(len(segments))
+    ]
+
+
+def _greedy_match(tails_count, forbidden, rng, match_left, match_right):
+    """Случайное жадное паросочетание: каждому хвосту — случайная разрешённая голова из пула."""
+    order = list(range(tails_count))
+    rng.shuffle(order)
+    pool = list(range(tails_count))
+    rng.shuffle(pool)
+
+    for i in order:
+        banned = forbidden.get(i, ())
+        chosen = None
+        for _ in range(min(8, len(pool))):
+            pos = rng.randrange(len(pool))
+            if pool[pos] not in banned:
+                chosen = pos
+                break
+        if chosen is None:
+            # Пул почти целиком запрещён для i — ищем линейно (пул и так перемешан)
+            for pos, j in enumerate(pool):
+                if j not in banned:
+                    chosen = pos
+                    break
+        if chosen is None:
+            continue
+        j = pool[chosen]
+        pool[chosen] = pool[-1]
+        pool.pop()
+        match_left[i] = j
+        match_right[j] = i
+
+
+def _augment(root, tails_count, forbidden, match_left, match_right, free_right):
+    """
+    Найти увеличивающий путь из свободного хвоста root поиском в ширину.
+
+    Граф задан неявно (разрешено всё, кроме forbidden), поэтому непосещённые
+    головы хранятся множеством и каждая снимается с него при первом посещении:
+    один поиск стоит O(n + число запретов).
+
+    Returns:
+        tuple: (True, None, None) при успехе или (False, S, N(S)) — множество хвостов S,
+            которым доступны только головы N(S), причём |N(S)| < |S| (нарушение условия Холла)
+    """
+    unvisited = set(range(tails_count))
+    parent = {}
+    visited_left = [root]
+    queue = [root]
+
+    for u in queue:
+        banned = forbidden.get(u, ())
+        for j in free_right:
+            if j not in banned:
+                # Найдена свободная голова — перекидываем пары вдоль пути
+                free_right.discard(j)
+                while True:
+                    prev_j = match_left.get(u)
+                    match_left[u] = j
+                    match_right[j] = u
+                    if prev_j is None:
+                        break
+                    j = prev_j
+                    u = parent[j]
+                return True, None, None
+        reachable = [j for j in unvisited if j not in banned]
+        unvisited.difference_update(reachable)
+        for j in reachable:
+            parent[j] = u
+            next_u = match_right[j]
+            visited_left.append(next_u)
+            queue.append(next_u)
+
+    visited_right = set(range(tails_count)) - unvisited
+    return False, visited_left, visited_right
+
+
+def solve_pairs(participants, manual_pairs=(), exclusions=(), rng=random):
+    """
+    Составить пары Санта -> получатель с учётом ручных пар и запретов.
+
+    Без запретов используется build_derangement. С запретами цепочки из ручных
+    пар сводятся к двудольному графу «хвост цепочки -> голова цепочки»
+    (самоназначения и запрещённые пары исключены), строится случайное жадное
+    паросочетание и достраивается до совершенного увеличивающими путями, как
+    в алгоритмах Куна / Хопкрофта–Карпа. Граф хранится неявно, через списки
+    запретов, поэтому память и время растут с числом участников и запретов,
+    а не с квадратом числа участников.
+
+    Args:
+        participants (list): tg_id всех участников игры
+        manual_pairs (iterable): Ручные пары (santa_tg_id, recipient_tg_id)
+        exclusions (iterable): Пары (tg_id, tg_id), которые не должны дарить друг другу
+            (в обе стороны)
+        rng: Источник случайности
+
+    Returns:
+        list: Пары (santa_tg_id, recipient_tg_id) для всех участников, кроме ручных
+
+    Raises:
+        PairingError: Если составить пары невозможно. Для нарушения условия Холла
+            атрибуты santas и recipients содержат tg_id участников, которым
+            не хватает допустимых получателей, и этих получателей.
+    """
+    exclusions = [(a, b) for a, b in exclusions if a != b]
+    if not exclusions:
+        return build_derangement(participants, manual_pairs, rng)
+
+    if len(participants) < 2:
+        raise PairingError("Недостаточно участников для жеребьёвки (нужно минимум 2).")
+
+    segments = _build_segments(participants, manual_pairs)
+    n = len(segments)
+    if n == 0:
+        return []
+
+    tails = [tail for head, tail in segments]
+    heads = [head for head, tail in segments]
+    tail_index = {tail: i for i, tail in enumerate(tails)}
+    head_index = {head: j for j, head in enumerate(heads)}
+
+    forbidden = defaultdict(set)
+    for i, (head, tail) in enumerate(segments):
+        if head == tail:
+            forbidden[i].add(i)
+    for a, b in exclusions:
+        i, j = tail_index.get(a), head_index.get(b)
+        if i is not None and j is not None:
+            forbidden[i].add(j)
+        i, j = tail_index.get(b), head_index.get(a)
+        if i is not None and j is not None:
+            forbidden[i].add(j)
+    forbidden = dict(forbidden)
+
+    match_left = {}
+    match_right = {}
+    _greedy_match(n, forbidden, rng, match_left, match_right)
+
+    free_right = {j for j in range(n) if j not in match_right}
+    for i in range(n):
+        if i in match_left:
+            continue
+        ok, santas, recipients = _augment(i, n, forbidden, match_left, match_right, free_right)
+        if not ok:
+            error = PairingError(
+                f"{len(santas)} участник(ов) могут дарить только {len(recipients)} получателям: "
+                f"запреты не оставляют допустимого распределения."
+            )
+            error.santas = [tails[k] for k in santas]
+            error.recipients = [heads[k] for k in sorted(recipients)]
+            raise error
+
+    return [(tails[i], heads[match_left[i]]) for i in range(n)]
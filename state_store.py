@@ -0,0 +1,219 @@
+"""
+Хранилище состояний диалогов (бывший словарь main.user_states).
+
+Состояние пользователя — пара (state, context), например
+('waiting_budget', {'name': 'Новый год'}). Хранилище держит в памяти
+ограниченный LRU-кэш и отложенно (write-behind) сбрасывает изменения в таблицу
+user_states, поэтому после перезапуска пользователи продолжают диалог с того же
+шага. У каждого состояния есть срок жизни: брошенные диалоги истекают и
+вычищаются фоновым проходом.
+
+Кэш в памяти авторитетен для своего процесса: при нескольких процессах апдейты
+одного чата должны попадать в один процесс (так работает LaneDispatcher).
+"""
+import atexit
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from db_manager import load_user_state, save_user_states, purge_expired_user_states
+
+STATE_TTL = 24 * 60 * 60
+STATE_CACHE_SIZE = 10000
+STATE_FLUSH_INTERVAL = 1.0
+STATE_SWEEP_INTERVAL = 10 * 60
+
+_MISSING = object()
+
+
+class StateStore:
+    """
+    Словареподобное хранилище состояний: store[tg_id] = (state, context),
+    store.get(tg_id), tg_id in store, del store[tg_id].
+
+    Args:
+        ttl (float): Срок жизни состояния в секундах (продлевается при каждой записи)
+        max_entries (int): Сколько пользователей держать в памяти
+        flush_interval (float): Период сброса изменений в БД
+        sweep_interval (float): Период удаления истёкших состояний
+    """
+
+    def __init__(self, ttl=STATE_TTL, max_entries=STATE_CACHE_SIZE, flush_interval=STATE_FLUSH_INTERVAL,
+                 sweep_interval=STATE_SWEEP_INTERVAL):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval
+        # tg_id -> (state, context, expires_at) или None (в БД состояния нет)
+        self._cache = OrderedDict()
+        # Изменения, ещё не записанные в БД: tg_id -> запись или None (удаление)
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Запустить фоновый сброс изменений и чистку истёкших состояний."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="state-store", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _remember(self, tg_id, entry):
+        self._cache[tg_id] = entry
+        self._cache.move_to_end(tg_id)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def _entry(self, tg_id):
+        with self._lock:
+            entry = self._dirty.get(tg_id, _MISSING)
+            if entry is _MISSING:
+                entry = self._cache.get(tg_id, _MISSING)
+                if entry is not _MISSING:
+                    self._cache.move_to_end(tg_id)
+        if entry is _MISSING:
+            entry = load_user_state(tg_id)
+            with self._lock:
+                # Пока читали БД, состояние могли изменить в этом же процессе
+                if tg_id in self._dirty:
+                    entry = self._dirty[tg_id]
+                else:
+                    self._remember(tg_id, entry)
+        if entry is not None and entry[2] <= time.time():
+            self.discard(tg_id)
+            return None
+        return entry
+
+    def get(self, tg_id, default=None):
+        """(state, context) пользователя или default."""
+        entry = self._entry(tg_id)
+        if entry is None:
+            return default
+        return entry[0], entry[1]
+
+    def state_of(self, tg_id):
+        """Имя текущего состояния пользователя или None."""
+        entry = self._entry(tg_id)
+        return entry[0] if entry else None
+
+    def set(self, tg_id, state, context=None):
+        entry = (state, dict(context or {}), time.time() + self.ttl)
+        with self._lock:
+            self._remember(tg_id, entry)
+            self._dirty[tg_id] = entry
+
+    def discard(self, tg_id):
+        """Сбросить состояние пользователя (если его нет — ничего не делать)."""
+        with self._lock:
+            self._remember(tg_id, None)
+            self._dirty[tg_id] = None
+
+    def __getitem__(self, tg_id):
+        value = self.get(tg_id)
+        if value is None:
+            raise KeyError(tg_id)
+        return value
+
+    def __setitem__(self, tg_id, value):
+        state, context = value
+        self.set(tg_id, state, context)
+
+    def __delitem__(self, tg_id):
+        self.discard(tg_id)
+
+    def __contains__(self, tg_id):
+        return self._entry(tg_id) is not None
+
+    def flush(self):
+        """Записать накопленные изменения в БД."""
+        with self._flush_lock:
+            with self._lock:
+                changes = dict(self._dirty)
+            if not changes:
+                return
+            save_user_states(changes)
+            # Изменения остаются в _dirty до записи, чтобы чтение не увидело старое значение из БД;
+            # убираем только те, что не были перезаписаны во время сброса
+            with self._lock:
+                for tg_id, entry in changes.items():
+                    if self._dirty.get(tg_id, _MISSING) is entry:
+                        del self._dirty[tg_id]
+
+    def sweep(self):
+        """Удалить истёкшие состояния из памяти и из БД."""
+        now = time.time()
+        with self._lock:
+            expired = [tg_id for tg_id, entry in self._cache.items() if entry is not None and entry[2] <= now]
+            for tg_id in expired:
+                self._cache[tg_id] = None
+                self._dirty[tg_id] = None
+        self.flush()
+        return purge_expired_user_states(now)
+
+    def _run(self):
+        next_sweep = time.monotonic() + self.sweep_interval
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if time.monotonic() >= next_sweep:
+                    next_sweep = time.monotonic() + self.sweep_interval
+                    self.sweep()
+            except Exception:
+                traceback.print_exc()
+
+
+class StateDispatcher:
+    """
+    Реестр обработчиков сообщений по состоянию диалога (по умолчанию — только текстовых).
+
+    Один message_handler вызывает dispatch(): состояние пользователя
+    определяется одним обращением к StateStore, обработчик — одним поиском в
+    словаре. Новое состояние добавляется через register(), без отдельного фильтра.
+
+    Args:
+        store (StateStore): Хранилище состояний
+        gate: Общая проверка gate(bot, message) перед любым обработчиком;
+            если вернула True, сообщение не обрабатывается (например, check_fantom)
+    """
+
+    def __init__(self, store, gate=None):
+        self.store = store
+        self.gate = gate
+        self._handlers = {}
+
+    def register(self, state, handler, content_types=('text',)):
+        """
+        Зарегистрировать handler(bot, message, user_states) для состояния state.
+
+        Сообщения других типов (например, файл, пока бот ждёт текст) в этом
+        состоянии игнорируются, и обработчик может рассчитывать на message.text.
+        """
+        if state in self._handlers:
+            raise ValueError(f"Обработчик состояния '{state}' уже зарегистрирован")
+        self._handlers[state] = (handler, frozenset(content_types))
+
+    def handler(self, state, content_types=('text',)):
+        """Декоратор для register()."""
+        def decorator(func):
+            self.register(state, func, content_types)
+            return func
+        return decorator
+
+    def dispatch(self, bot, message):
+        """
+        Передать сообщение обработчику текущего состояния пользователя.
+
+        Returns:
+            bool: True, если нашёлся обработчик, принимающий сообщения такого типа
+        """
+        entry = self._handlers.get(self.store.state_of(message.chat.id))
+        if entry is None:
+            return False
+        handler, content_types = entry
+        if message.content_type not in content_types:
+            return False
+        if self.gate is None or not self.gate(bot, message):
+            handler(bot, message, self.store)
+        return True
@@ -0,0 +1,193 @@
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import db_manager
+from bot_handlers import callback_codec
+from bot_handlers.callback_codec import (
+    MAX_CALLBACK_DATA, TOKEN_TTL, decode_ints, encode_ints, packed, resolve_token, tokenized
+)
+
+
+class EncodeIntsTest(unittest.TestCase):
+    def test_round_trip(self):
+        cases = [
+            [],
+            [0],
+            [1, -1, 63, -64, 64, -65, 127, 128],
+            [2 ** 31 - 1, -2 ** 31, 2 ** 63 - 1, -2 ** 63],
+            # Реальные tg_id и id игр
+            [7_123_456_789, 42, -1001234567890],
+        ]
+        for values in cases:
+            with self.subTest(values=values):
+                self.assertEqual(decode_ints(encode_ints(values)), values)
+
+    def test_round_trip_random(self):
+        rng = random.Random(18)
+        for _ in range(2000):
+            values = [rng.randint(-2 ** 64, 2 ** 64) for _ in range(rng.randint(0, 5))]
+            self.assertEqual(decode_ints(encode_ints(values)), values)
+
+    def test_output_is_callback_safe(self):
+        encoded = encode_ints([-2 ** 63, 2 ** 63 - 1, 0])
+        self.assertRegex(encoded, r'^[A-Za-z0-9_-]*$')
+        self.assertNotIn('=', encoded)
+
+    def test_truncated_input(self):
+        encoded = encode_ints([2 ** 40])
+        with self.assertRaises(ValueError):
+            decode_ints(encoded[:len(encoded) // 2])
+
+    def test_overlong_number(self):
+        with self.assertRaises(ValueError):
+            decode_ints(callback_codec._b64encode(b'\xff' * 12 + b'\x01'))
+
+
+class SizeLimitTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(callback_codec, 'save_callback_token')
+        self.save = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(callback_codec._token_cache.clear)
+
+    def test_packed_three_tg_ids_fit(self):
+        data = packed('aae', 2 ** 40, 7_123_456_789, 7_987_654_321)
+        self.assertLessEqual(len(data.encode('utf-8')), MAX_CALLBACK_DATA)
+
+    def test_packed_over_limit(self):
+        with self.assertRaises(ValueError):
+            packed('aae', *([2 ** 63] * 6))
+
+    def test_packed_limit_counts_bytes(self):
+        # 32 кириллических символа — 64 байта в UTF-8, вместе с '_' больше лимита
+        with self.assertRaises(ValueError):
+            packed('я' * 32)
+
+    def test_tokenized_length_does_not_depend_on_payload(self):
+        short = tokenized('ape', table_name='users', record_id=1, col_name='role')
+        long = tokenized('ape', table_name='x' * 500, record_id=10 ** 18, col_name='y' * 500)
+        self.assertEqual(len(short), len(long))
+        self.assertLessEqual(len(long.encode('utf-8')), MAX_CALLBACK_DATA)
+
+    def test_tokenized_over_limit(self):
+        with self.assertRaises(ValueError):
+            tokenized('t' * MAX_CALLBACK_DATA, table_name='users')
+
+
+class InlineFormatTest(unittest.TestCase):
+    def setUp(self):
+        callback_codec.register_inline('tst', ('table_name',), ('page', 'after', 'before'))
+        self.addCleanup(callback_codec._inline_formats.pop, 'tst')
+        patcher = mock.patch.object(callback_codec, 'save_callback_token')
+        self.save = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(callback_codec._token_cache.clear)
+
+    def test_round_trip_without_db(self):
+        for payload in (
+            {'table_name': 'game_participants'},
+            {'table_name': 'users', 'page': 3, 'after': 2 ** 63 - 1},
+            {'table_name': 'users', 'page': 0, 'before': -5},
+        ):
+            with self.subTest(payload=payload):
+                data = tokenized('tst', **payload)
+                self.assertTrue(data.startswith('tst_') and '.' in data)
+                self.assertEqual(callback_codec.decode_inline('tst', data[4:]), payload)
+        self.save.assert_not_called()
+
+    def test_falls_back_to_token(self):
+        for payload in (
+            {'table_name': 'users', 'after': 'text-key'},
+            {'table_name': 'таблица'},
+            {'table_name': 'users', 'unknown': 1},
+            {'table_name': 'x' * 60, 'page': 1},
+        ):
+            with self.subTest(payload=payload):
+                self.assertNotIn('.', tokenized('tst', **payload))
+        self.assertEqual(self.save.call_count, 4)
+
+    def test_corrupted(self):
+        with self.assertRaises(ValueError):
+            callback_codec.decode_inline('tst', 'users')
+        with self.assertRaises(ValueError):
+            callback_codec.decode_inline('tst', 'users.' + encode_ints([0b11, 1]))
+
+
+class ResolveTokenTest(unittest.TestCase):
+    def setUp(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.addCleanup(db_manager.close_all_connections)
+        patcher = mock.patch.object(db_manager, 'DB_NAME', path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        db_manager.init_db()
+        callback_codec._token_cache.clear()
+        self.addCleanup(callback_codec._token_cache.clear)
+
+    def _token(self, data):
+        return data.split('_', 1)[1]
+
+    def test_known_token(self):
+        token = self._token(tokenized('adt', table_name='users', after=10, page=1))
+        self.assertEqual(resolve_token(token), {'table_name': 'users', 'after': 10, 'page': 1})
+
+    def test_known_token_after_restart(self):
+        token = self._token(tokenized('adt', table_name='users', page=0))
+        callback_codec._token_cache.clear()
+        self.assertEqual(resolve_token(token), {'table_name': 'users', 'page': 0})
+
+    def test_same_payload_same_token(self):
+        self.assertEqual(
+            tokenized('aer', table_name='users', record_id=5),
+            tokenized('aer', record_id=5, table_name='users'),
+        )
+        self.assertEqual(db_manager.db_execute("SELECT COUNT(*) FROM callback_tokens", fetch_one=True)[0], 1)
+
+    def test_unknown_token(self):
+        with self.assertRaises(ValueError):
+            resolve_token('AAAAAAAAAAAA')
+
+    def test_expired_token(self):
+        token = self._token(tokenized('aer', table_name='users', record_id=5))
+        later = callback_codec.time.time() + TOKEN_TTL + 1
+        with mock.patch.object(callback_codec.time, 'time', return_value=later):
+            with self.assertRaises(ValueError):
+                resolve_token(token)
+
+    def test_expired_token_in_db(self):
+        token = self._token(tokenized('aer', table_name='users', record_id=5))
+        db_manager.db_execute(
+            "UPDATE callback_tokens SET created_at = ? WHERE token = ?",
+            (callback_codec.time.time() - TOKEN_TTL - 1, token),
+            commit=True
+        )
+        callback_codec._token_cache.clear()
+        with self.assertRaises(ValueError):
+            resolve_token(token)
+
+    def test_token_batch_single_write(self):
+        with mock.patch.object(callback_codec, 'save_callback_token') as save:
+            with callback_codec.token_batch():
+                tokens = [self._token(tokenized('aer', table_name='users', record_id=i)) for i in range(5)]
+                self.assertEqual(db_manager.db_execute("SELECT COUNT(*) FROM callback_tokens", fetch_one=True)[0], 0)
+        save.assert_not_called()
+        self.assertEqual(db_manager.db_execute("SELECT COUNT(*) FROM callback_tokens", fetch_one=True)[0], 5)
+        callback_codec._token_cache.clear()
+        self.assertEqual(resolve_token(tokens[3]), {'table_name': 'users', 'record_id': 3})
+
+    def test_purge_removes_expired(self):
+        token = self._token(tokenized('aer', table_name='users', record_id=5))
+        db_manager.db_execute("UPDATE callback_tokens SET created_at = 0", commit=True)
+        self.assertEqual(callback_codec.purge_expired_tokens(), 1)
+        callback_codec._token_cache.clear()
+        with self.assertRaises(ValueError):
+            resolve_token(token)
+
+
+if __name__ == '__main__':
+    unittest.main()
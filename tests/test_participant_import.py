@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import db_manager
+
+try:
+    from bot_handlers import participant_import
+except ImportError:
+    # pyTelegramBotAPI не установлен
+    participant_import = None
+
+
+@unittest.skipIf(participant_import is None, "нужен pyTelegramBotAPI")
+class ParseParticipantRefTest(unittest.TestCase):
+    def test_refs(self):
+        parse = participant_import.parse_participant_ref
+        self.assertEqual(parse('7123456789'), ('id', 7123456789))
+        self.assertEqual(parse(' "@Santa_Claus" ;x'), ('username', 'santa_claus'))
+        self.assertEqual(parse('https://t.me/SantaClaus/'), ('username', 'santaclaus'))
+        self.assertEqual(parse(' ,; '), ('empty', None))
+        self.assertEqual(parse('12ab'), (None, '12ab'))
+
+    def test_id_out_of_sqlite_range(self):
+        parse = participant_import.parse_participant_ref
+        self.assertEqual(parse(str(2 ** 63 - 1)), ('id', 2 ** 63 - 1))
+        self.assertEqual(parse(str(2 ** 63)), (None, str(2 ** 63)))
+        self.assertEqual(parse('9' * 20), (None, '9' * 20))
+
+
+@unittest.skipIf(participant_import is None, "нужен pyTelegramBotAPI")
+class ImportParticipantsTest(unittest.TestCase):
+    def setUp(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.addCleanup(db_manager.close_all_connections)
+        patcher = mock.patch.object(db_manager, 'DB_NAME', path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        db_manager.init_db()
+        db_manager.db_executemany(
+            "INSERT INTO users (tg_id, username) VALUES (?, ?)",
+            [(1, 'alice'), (2, 'Bobby'), (3, None)],
+            commit=True
+        )
+        db_manager.db_execute(
+            "INSERT INTO games (id, name, organizer_id) VALUES (10, 'Тест', 1)",
+            commit=True
+        )
+
+    def test_report(self):
+        lines = ['username', '@alice', '2', 'BOBBY', '3', '404', '9' * 20, 'bad line!']
+        report = participant_import.import_participants(10, lines)
+        self.assertEqual(report['added'], 3)
+        self.assertEqual(report['already'], 0)
+        self.assertEqual(report['duplicates'], 1)
+        self.assertEqual(report['unresolved'], [(6, '404'), (7, '9' * 20), (8, 'bad line!')])
+
+    def test_repeat_import_adds_nothing(self):
+        participant_import.import_participants(10, ['1', '2'])
+        report = participant_import.import_participants(10, ['1', '2'])
+        self.assertEqual((report['added'], report['already']), (0, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
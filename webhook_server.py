@@ -0,0 +1,103 @@
+"""
+Приём апдейтов Telegram через webhook: встроенный HTTP-сервер поверх LaneDispatcher.
+
+Сервер только принимает JSON апдейта и ставит его в полосу диспетчера
+(dispatcher.py); обработка идёт в потоках полос. Если полоса заполнена, сервер
+отвечает 503 с Retry-After, и Telegram повторит доставку позже.
+
+Локальная проверка без Telegram (WEBHOOK_URL не задан, webhook не регистрируется):
+    BOT_MODE=webhook python main.py
+    curl -X POST -H 'Content-Type: application/json' -d @update.json http://127.0.0.1:8443/webhook
+"""
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dispatcher import update_chat_id
+
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookServer:
+    """
+    HTTP-сервер для webhook-режима.
+
+    Args:
+        dispatcher (LaneDispatcher): Диспетчер, обрабатывающий JSON апдейтов
+        host (str): Адрес для прослушивания
+        port (int): Порт
+        path (str): Путь, на который Telegram присылает апдейты
+        secret_token (str): Ожидаемый X-Telegram-Bot-Api-Secret-Token (опционально)
+    """
+
+    def __init__(self, dispatcher, host='0.0.0.0', port=8443, path='/webhook', secret_token=None):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret_token = secret_token
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    def submit(self, update_json):
+        """
+        Поставить апдейт в очередь обработки.
+
+        Returns:
+            bool: False, если полоса чата заполнена (нужно ответить 503)
+        """
+        return self.dispatcher.submit(update_chat_id(update_json), update_json)
+
+    def _make_handler(self):
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def _reply(self, code, body=b'', headers=None):
+                self.send_response(code)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                if self.path != server.path:
+                    self._reply(404)
+                    return
+                if server.secret_token and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != server.secret_token:
+                    self._reply(403)
+                    return
+
+                length = int(self.headers.get('Content-Length') or 0)
+                if length <= 0 or length > MAX_BODY_SIZE:
+                    self._reply(400)
+                    return
+                try:
+                    update_json = json.loads(self.rfile.read(length).decode('utf-8'))
+                    if not isinstance(update_json, dict):
+                        raise ValueError
+                except ValueError:
+                    self._reply(400)
+                    return
+
+                try:
+                    accepted = server.submit(update_json)
+                except (KeyError, TypeError):
+                    # Апдейт не того формата (например, id не число) — повтор не поможет
+                    self._reply(400)
+                    return
+                if accepted:
+                    self._reply(200)
+                else:
+                    # Полоса заполнена: просим Telegram повторить позже
+                    self._reply(503, headers={'Retry-After': '1'})
+
+            def do_GET(self):
+                self._reply(405)
+
+            def log_message(self, format, *args):
+                pass
+
+        return _Handler
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()